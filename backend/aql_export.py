@@ -0,0 +1,320 @@
+"""
+AQL Result Export (CSV / Parquet)
+
+Streams AQL results from EHRbase into CSV or Parquet in fixed-size row
+batches. Pages are pulled from EHRbase with offset/fetch
+(EHRbaseClient.iter_aql_pages), so only one page plus one batch is ever held
+in memory, however large the extract.
+
+Column types come from the AQL `columns` metadata: the last segment of each
+column path decides the type (e.g. `.../magnitude` -> float,
+`.../precision` -> int), everything else is exported as a string.
+
+Parquet support needs the optional `pyarrow` package; CSV has no extra
+dependencies.
+
+Usage (from the backend directory):
+    python aql_export.py "SELECT ... ORDER BY ..." -o vitals.parquet
+    python aql_export.py --file query.aql --format csv -o - > out.csv
+"""
+
+import io
+import os
+import csv
+import sys
+import json
+import logging
+import argparse
+import importlib.util
+
+# Parquet export is optional; pyarrow is slow to import, so it is only loaded
+# by the first Parquet export (see _load_pyarrow)
+pa = None
+pq = None
+_HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'parquet')
+MIMETYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+DEFAULT_BATCH_SIZE = int(os.getenv('AQL_EXPORT_BATCH_SIZE', '5000'))
+
+# Last path segment -> column type
+_FLOAT_SEGMENTS = {'magnitude', 'numerator', 'denominator'}
+_INT_SEGMENTS = {'precision', 'sequence_number', 'ordinal'}
+_BOOL_SEGMENTS = {'is_integral', 'is_queryable', 'is_modifiable'}
+
+
+class ExportError(Exception):
+    """Raised when an export cannot be produced (e.g. Parquet without pyarrow)."""
+    pass
+
+
+def parquet_available():
+    """True if the optional pyarrow dependency is installed."""
+    return _HAS_PYARROW
+
+
+def _load_pyarrow():
+    global pa, pq
+    if pq is None:
+        import pyarrow
+        import pyarrow.parquet
+        pa, pq = pyarrow, pyarrow.parquet
+
+
+def column_type(column):
+    """
+    Infer an export type ('float', 'int', 'bool' or 'string') for one AQL
+    result column from its path.
+    """
+    path = (column.get('path') or column.get('name') or '').rstrip('/')
+    segment = path.rsplit('/', 1)[-1].lower()
+    if segment in _FLOAT_SEGMENTS:
+        return 'float'
+    if segment in _INT_SEGMENTS:
+        return 'int'
+    if segment in _BOOL_SEGMENTS:
+        return 'bool'
+    return 'string'
+
+
+def column_names(columns):
+    """Unique, non-empty header names for the AQL result columns."""
+    names, seen = [], {}
+    for index, column in enumerate(columns):
+        name = column.get('name') or column.get('path') or f"column_{index}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}_{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def iter_row_batches(pages, batch_size=DEFAULT_BATCH_SIZE):
+    """Re-chunk an iterable of AQL result pages into lists of batch_size rows."""
+    batch = []
+    for page in pages:
+        for row in page.get('rows') or []:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _convert(value, kind):
+    """Coerce one cell to the column type; values that don't fit become None."""
+    if value is None:
+        return None
+    try:
+        if kind == 'float':
+            return float(value)
+        if kind == 'int':
+            return int(value)
+        if kind == 'bool':
+            return value if isinstance(value, bool) else str(value).lower() == 'true'
+    except (TypeError, ValueError):
+        return None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _csv_cell(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+# ─── CSV ─────────────────────────────────────────────────────────────
+
+def iter_csv(columns, batches):
+    """Yield CSV text chunks: the header, then one chunk per row batch."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(column_names(columns))
+    yield buffer.getvalue()
+
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_csv_cell(value) for value in row] for row in batch)
+        yield buffer.getvalue()
+
+
+# ─── Parquet ─────────────────────────────────────────────────────────
+
+_ARROW_TYPES = {
+    'float': lambda: pa.float64(),
+    'int': lambda: pa.int64(),
+    'bool': lambda: pa.bool_(),
+    'string': lambda: pa.string(),
+}
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands written bytes back in chunks."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parquet_schema(columns):
+    """Arrow schema for the AQL result columns."""
+    if not parquet_available():
+        raise ExportError("Parquet export requires the 'pyarrow' package.")
+    _load_pyarrow()
+    return pa.schema([
+        pa.field(name, _ARROW_TYPES[column_type(column)]())
+        for name, column in zip(column_names(columns), columns)
+    ])
+
+
+def iter_parquet(columns, batches):
+    """Yield Parquet bytes: one row group per row batch, then the footer."""
+    schema = parquet_schema(columns)
+    kinds = [column_type(column) for column in columns]
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    try:
+        for batch in batches:
+            arrays = [
+                pa.array([_convert(row[i] if i < len(row) else None, kind) for row in batch],
+                         type=schema.field(i).type)
+                for i, kind in enumerate(kinds)
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+# ─── Entry points ────────────────────────────────────────────────────
+
+def export_chunks(first_page, pages, fmt='csv', batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Encode AQL result pages as CSV text or Parquet bytes.
+
+    Args:
+        first_page: The first result page (its 'columns' define the schema)
+        pages: Iterator over the remaining pages
+        fmt: 'csv' or 'parquet'
+        batch_size: Rows per CSV chunk / Parquet row group
+
+    Yields:
+        str (CSV) or bytes (Parquet) chunks, ready to write or stream.
+    """
+    if fmt not in FORMATS:
+        raise ExportError(f"Unsupported export format '{fmt}'. Use one of: {', '.join(FORMATS)}")
+    if fmt == 'parquet' and not parquet_available():
+        raise ExportError("Parquet export requires the 'pyarrow' package.")
+
+    columns = first_page.get('columns') or []
+
+    def all_pages():
+        yield first_page
+        yield from pages
+
+    batches = iter_row_batches(all_pages(), batch_size)
+    if fmt == 'parquet':
+        return iter_parquet(columns, batches)
+    return iter_csv(columns, batches)
+
+
+def export_query(client, aql, out, fmt='csv', query_params=None,
+                 page_size=1000, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Run an AQL query and write the full result to a file object.
+
+    Args:
+        client: EHRbaseClient
+        aql: AQL query (should have ORDER BY, no LIMIT/OFFSET)
+        out: Binary file object to write to
+        fmt: 'csv' or 'parquet'
+
+    Returns:
+        int: Number of bytes written
+    """
+    pages = client.iter_aql_pages(aql, query_params, page_size=page_size)
+    first_page = next(pages, {'columns': [], 'rows': []})
+    written = 0
+    try:
+        for chunk in export_chunks(first_page, pages, fmt, batch_size):
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            out.write(chunk)
+            written += len(chunk)
+    finally:
+        pages.close()
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('aql', nargs='?', help='AQL query text')
+    parser.add_argument('--file', help='read the AQL query from a file')
+    parser.add_argument('--params', help='query_parameters as a JSON object')
+    parser.add_argument('--format', choices=FORMATS, help='default: from the output extension, else csv')
+    parser.add_argument('-o', '--output', required=True, help="output path, or '-' for stdout")
+    parser.add_argument('--page-size', type=int, default=1000, help='rows per EHRbase request')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='rows per output batch')
+    args = parser.parse_args(argv)
+
+    if args.file:
+        with open(args.file) as f:
+            aql = f.read()
+    elif args.aql:
+        aql = args.aql
+    else:
+        parser.error('an AQL query or --file is required')
+
+    fmt = args.format or ('parquet' if args.output.endswith('.parquet') else 'csv')
+    params = json.loads(args.params) if args.params else None
+
+    from dotenv import load_dotenv
+    from ehrbase_client import EHRbaseClient
+
+    load_dotenv()
+    client = EHRbaseClient()
+
+    if args.output == '-':
+        written = export_query(client, aql, sys.stdout.buffer, fmt, params, args.page_size, args.batch_size)
+    else:
+        with open(args.output, 'wb') as out:
+            written = export_query(client, aql, out, fmt, params, args.page_size, args.batch_size)
+    print(f"Exported {written} bytes ({fmt}) to {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""
+Named AQL Query Registry
+
+Server-side catalogue of the AQL queries the UI runs. Each entry is a fixed,
+parameterized AQL text that is validated once at import; callers invoke it by
+name and pass only `query_parameters`, which EHRbase binds to the `$name`
+placeholders. Raw AQL never travels from the browser for these queries, and
+because the query text is stable, results can be cached per parameter set.
+
+SAFETY NOTE: Parameters are never interpolated into the AQL text. They are
+type-checked here and bound by EHRbase. The result cache is short-lived and
+is invalidated for an EHR when a composition is submitted to it.
+
+Configuration:
+    NAMED_AQL_CACHE_SIZE   max cached results (default 512)
+"""
+
+import os
+import re
+import json
+import time
+import logging
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+_PARAM_PATTERN = re.compile(r'\$([A-Za-z_][A-Za-z0-9_]*)')
+_UUID_PATTERN = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+_FORBIDDEN_KEYWORDS = ('DELETE', 'UPDATE', 'DROP', 'INSERT', 'ALTER', 'TRUNCATE')
+
+
+class NamedQueryError(Exception):
+    """Raised for unknown queries or invalid query parameters."""
+    pass
+
+
+class NamedQuery:
+    """
+    A registered AQL query.
+
+    Args:
+        name: Registry key (used in the URL)
+        aql: AQL text with `$param` placeholders
+        params: dict of parameter name -> type ('uuid', 'string' or 'int')
+        description: Short human-readable summary
+        cache_ttl: Seconds to cache results per parameter set (0 disables)
+    """
+
+    def __init__(self, name, aql, params=None, description='', cache_ttl=0):
+        self.name = name
+        self.aql = ' '.join(aql.split())
+        self.params = params or {}
+        self.description = description
+        self.cache_ttl = cache_ttl
+
+    def validate(self):
+        """Check the AQL text and its declared parameters; raises ValueError."""
+        upper = self.aql.upper()
+        if not upper.startswith('SELECT ') or ' FROM ' not in upper:
+            raise ValueError(f"Named query '{self.name}' is not a SELECT ... FROM ... query")
+        for keyword in _FORBIDDEN_KEYWORDS:
+            if re.search(rf'\b{keyword}\b', upper):
+                raise ValueError(f"Named query '{self.name}' contains forbidden keyword '{keyword}'")
+        placeholders = set(_PARAM_PATTERN.findall(self.aql))
+        declared = set(self.params)
+        if placeholders != declared:
+            raise ValueError(
+                f"Named query '{self.name}' placeholders {sorted(placeholders)} "
+                f"do not match declared parameters {sorted(declared)}"
+            )
+        for param, kind in self.params.items():
+            if kind not in _CONVERTERS:
+                raise ValueError(f"Named query '{self.name}' parameter '{param}' has unknown type '{kind}'")
+
+    def bind(self, query_params):
+        """
+        Type-check caller parameters against the declaration.
+
+        Returns:
+            dict: Parameters converted to their declared types.
+        """
+        query_params = query_params or {}
+        if not isinstance(query_params, dict):
+            raise NamedQueryError("'query_parameters' must be an object.")
+        unknown = set(query_params) - set(self.params)
+        if unknown:
+            raise NamedQueryError(f"Unknown parameter(s) for '{self.name}': {', '.join(sorted(unknown))}")
+        bound = {}
+        for param, kind in self.params.items():
+            if param not in query_params or query_params[param] in (None, ''):
+                raise NamedQueryError(f"Missing required parameter '{param}' for '{self.name}'.")
+            try:
+                bound[param] = _CONVERTERS[kind](query_params[param])
+            except (TypeError, ValueError):
+                raise NamedQueryError(f"Parameter '{param}' for '{self.name}' must be a valid {kind}.")
+        return bound
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'description': self.description,
+            'parameters': self.params,
+            'aql': self.aql,
+        }
+
+
+def _to_uuid(value):
+    value = str(value).strip()
+    if not _UUID_PATTERN.match(value):
+        raise ValueError(value)
+    return value
+
+
+def _to_string(value):
+    if not isinstance(value, (str, int, float)):
+        raise TypeError(value)
+    value = str(value).strip()
+    if len(value) > 255:
+        raise ValueError(value)
+    return value
+
+
+def _to_int(value):
+    if isinstance(value, bool):
+        raise TypeError(value)
+    return int(value)
+
+
+_CONVERTERS = {'uuid': _to_uuid, 'string': _to_string, 'int': _to_int}
+
+
+# ─── Registered Queries ──────────────────────────────────────────────
+
+QUERIES = {q.name: q for q in (
+    NamedQuery(
+        'patient_history',
+        """
+        SELECT
+            c/uid/value as uid,
+            c/name/value as template_id,
+            c/context/start_time/value as start_time,
+            c/composer/name as composer
+        FROM EHR e [ehr_id/value=$ehr_id]
+        CONTAINS COMPOSITION c
+        ORDER BY c/context/start_time/value DESC
+        """,
+        params={'ehr_id': 'uuid'},
+        description='All compositions in one EHR, newest first (HistoryView).',
+        cache_ttl=10,
+    ),
+    NamedQuery(
+        'latest_vitals',
+        """
+        SELECT
+            c/uid/value as uid,
+            c/context/start_time/value as start_time,
+            o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude as systolic,
+            o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude as diastolic,
+            o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/units as units
+        FROM EHR e [ehr_id/value=$ehr_id]
+        CONTAINS COMPOSITION c
+        CONTAINS OBSERVATION o[openEHR-EHR-OBSERVATION.blood_pressure.v2]
+        ORDER BY c/context/start_time/value DESC
+        LIMIT 1
+        """,
+        params={'ehr_id': 'uuid'},
+        description='Most recent blood pressure reading in one EHR.',
+        cache_ttl=10,
+    ),
+    NamedQuery(
+        'template_counts',
+        """
+        SELECT
+            c/archetype_details/template_id/value as template_id,
+            COUNT(c/uid/value) as compositions
+        FROM EHR e [ehr_id/value=$ehr_id]
+        CONTAINS COMPOSITION c
+        """,
+        params={'ehr_id': 'uuid'},
+        description='Number of compositions per template in one EHR.',
+        cache_ttl=30,
+    ),
+)}
+
+
+def validate_registry():
+    """Validate every registered query. Called once at import; raises ValueError."""
+    for query in QUERIES.values():
+        query.validate()
+    logger.info(f"Validated {len(QUERIES)} named AQL queries")
+
+
+validate_registry()
+
+
+# ─── Execution & Result Cache ────────────────────────────────────────
+
+_results = LRUCache(maxsize=int(os.getenv('NAMED_AQL_CACHE_SIZE', '512')), name='named_aql')
+
+
+def get_query(name):
+    """Look up a registered query; raises NamedQueryError if unknown."""
+    query = QUERIES.get(name)
+    if query is None:
+        raise NamedQueryError(f"Unknown named query '{name}'.")
+    return query
+
+
+def run(client, name, query_params=None):
+    """
+    Execute a named query through an EHRbaseClient, using the result cache.
+
+    Returns:
+        tuple: (result dict, cached bool)
+    """
+    query = get_query(name)
+    bound = query.bind(query_params)
+    key = (name, json.dumps(bound, sort_keys=True))
+
+    if query.cache_ttl:
+        entry = _results.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1], True
+
+    result = client.query_aql(query.aql, bound or None)
+    if query.cache_ttl:
+        _results.put(key, (time.monotonic() + query.cache_ttl, result))
+    return result, False
+
+
+def invalidate_ehr(ehr_id):
+    """Drop cached results of queries that were run for this EHR."""
+    marker = f'"ehr_id": "{ehr_id}"'
+    for key in _results.keys():
+        if marker in key[1]:
+            _results.pop(key)
+
+
+def clear_cache():
+    _results.clear()
@@ -0,0 +1,427 @@
+"""
+Archetype Catalog
+
+In-memory catalog of the CKM archetype XML files under ARCHETYPE_ROOT_DIR
+(exported from the Clinical Knowledge Manager, see readme.txt), ported from
+the original main.py prototype.
+
+- Headers (id, name, file path) for every archetype are scanned once, on
+  first use.
+- Parsed forms are kept as compact FormNode trees (see form_nodes.py) and
+  converted to JSON dicts only when a response is built.
+- Every scan keeps the search index (search_index.py) and the slot
+  resolution graph (slot_index.py) in sync; files whose path and
+  modification time are unchanged are not re-indexed.
+- A changed file (refresh_file(), or a rescan) drops only that archetype's
+  parsed forms and the caches of the templates embedding it
+  (dependency_graph.py).
+- With CATALOG_SNAPSHOT set (see catalog_snapshot.py), the catalog is loaded
+  from a memory-mapped snapshot instead of being scanned: forms in the
+  default language are served straight from the mapping, and the search
+  index is filled from it on first search. Other languages are still parsed
+  per process from the XML (the snapshot holds no other-language terms).
+
+Configuration:
+    ARCHETYPE_ROOT_DIR   directory scanned recursively for *.xml (default ../openEHR_xml)
+"""
+
+import os
+import glob
+import json
+import logging
+import threading
+
+from lxml import etree
+
+import slot_index
+import json_provider
+import catalog_snapshot
+import dependency_graph
+import search_index
+from form_nodes import intern_text, to_dicts
+from term_store import DEFAULT_LANGUAGE
+from archetype_parser import parse_archetype_to_nodes
+
+logger = logging.getLogger(__name__)
+
+ARCHETYPE_ROOT_DIR = os.getenv(
+    'ARCHETYPE_ROOT_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'openEHR_xml')
+)
+NS = {'openEHR': 'http://schemas.openehr.org/v1'}
+
+
+class ArchetypeHeader:
+    """Catalog entry for one archetype file."""
+
+    __slots__ = ('id', 'name', 'path')
+
+    def __init__(self, archetype_id, name, path):
+        self.id = intern_text(archetype_id)
+        self.name = intern_text(name)
+        self.path = path
+
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name}
+
+
+# archetype_id -> ArchetypeHeader
+ARCHETYPE_CACHE = {}
+# (archetype_id, language) -> list[FormNode]
+_forms = {}
+# archetype_id -> (path, mtime) at the last scan
+_signatures = {}
+_lock = threading.Lock()
+_built = False
+# Snapshot currently loaded, the archetypes still served from it, and
+# whether its search fields still have to be indexed
+_snapshot = None
+_from_snapshot = set()
+_search_pending = False
+
+
+def parse_archetype_header(xml_file):
+    """
+    Parses an ADL 1.4 XML file to get its ID, name, and file path.
+    Returns None (and logs) for files that are not usable archetypes.
+    """
+    scanned = scan_archetype(xml_file)
+    return scanned[0] if scanned else None
+
+
+def scan_archetype(xml_file):
+    """
+    Parses an ADL 1.4 XML file once for its catalog header, its search_index
+    fields and its slot definitions.
+
+    Returns:
+        tuple | None: (ArchetypeHeader, search fields, slots), None if unusable.
+    """
+    try:
+        root = etree.parse(xml_file).getroot()
+
+        # 1. Get the Archetype ID (This is mandatory)
+        archetype_id_node = root.find('.//openEHR:archetype_id/openEHR:value', namespaces=NS)
+        if archetype_id_node is None or archetype_id_node.text is None:
+            logger.warning(f"Skipping {xml_file}: Could not find <archetype_id>.")
+            return None
+
+        archetype_id = archetype_id_node.text.strip()
+        name = archetype_id  # Default name is the ID itself
+
+        # 2. Get the human-readable name of the concept (Optional)
+        concept_node = root.find('.//openEHR:concept', namespaces=NS)
+        if concept_node is not None and concept_node.text is not None:
+            name_node = root.find(
+                f".//openEHR:term_definitions[@language='en']/openEHR:items[@code='{concept_node.text.strip()}']"
+                f"/openEHR:items[@id='text']",
+                namespaces=NS)
+            if name_node is not None and name_node.text is not None:
+                name = name_node.text.strip()
+
+        header = ArchetypeHeader(archetype_id, name, xml_file)
+        return header, search_index.archetype_document(root, archetype_id, name), slot_index.archetype_slots(root)
+
+    except etree.XMLSyntaxError:
+        logger.warning(f"XML Syntax Error parsing {xml_file}. Skipping.")
+        return None
+    except Exception as e:
+        logger.warning(f"Generic error on {xml_file}: {e}. Skipping.")
+        return None
+
+
+def build_archetype_cache():
+    """
+    Scans ARCHETYPE_ROOT_DIR and (re)fills ARCHETYPE_CACHE with headers.
+    Only archetypes whose file changed (path/mtime) since the previous scan
+    lose their parsed forms and have dependent templates invalidated.
+    """
+    xml_files = glob.glob(os.path.join(ARCHETYPE_ROOT_DIR, '**', '*.xml'), recursive=True)
+
+    headers = {}
+    documents = []
+    slots = {}
+    signatures = {}
+    for xml_file in xml_files:
+        scanned = scan_archetype(xml_file)
+        if scanned:
+            header, fields, slots[header.id] = scanned
+            headers[header.id] = header
+            signatures[header.id] = _signature(xml_file)
+            documents.append((header.id, header.to_dict(), fields, signatures[header.id]))
+
+    global _built
+    with _lock:
+        was_built = _built
+        changed_ids = {archetype_id for archetype_id in set(headers) | set(_signatures)
+                       if _signatures.get(archetype_id) != signatures.get(archetype_id)}
+        ARCHETYPE_CACHE.clear()
+        ARCHETYPE_CACHE.update(headers)
+        _signatures.clear()
+        _signatures.update(signatures)
+        _drop_forms(changed_ids)
+        _from_snapshot.difference_update(changed_ids)
+        _built = True
+    changed, removed = search_index.INDEX.sync('archetype', documents)
+    slot_index.INDEX.sync(slots)
+    if was_built:
+        for archetype_id in changed_ids:
+            dependency_graph.archetype_changed(archetype_id)
+    logger.info(f"Archetype cache built. Parsed {len(headers)} / {len(xml_files)} archetypes "
+                f"from {ARCHETYPE_ROOT_DIR} ({changed} re-indexed, {removed} dropped from search)")
+    return len(headers)
+
+
+def refresh_file(xml_file):
+    """
+    Re-read one archetype file after it was added or changed, updating only
+    its header, forms, search entry and slots, and the templates embedding it.
+
+    Returns:
+        str | None: The archetype id, or None if the file is not a usable archetype.
+    """
+    ensure_built()
+    scanned = scan_archetype(xml_file)
+    if not scanned:
+        remove_file(xml_file)
+        return None
+    header, fields, slots = scanned
+    signature = _signature(xml_file)
+    # Re-parse the languages that were being served before swapping, so
+    # readers see either the old or the new form, never a cold miss
+    languages = [key[1] for key in list(_forms) if key[0] == header.id]
+    forms = {(header.id, language): parse_archetype_to_nodes(xml_file, language) for language in languages}
+    with _lock:
+        ARCHETYPE_CACHE[header.id] = header
+        _signatures[header.id] = signature
+        _drop_forms({header.id})
+        _forms.update(forms)
+        _from_snapshot.discard(header.id)
+    search_index.INDEX.add('archetype', header.id, header.to_dict(), fields, signature)
+    slot_index.INDEX.update(header.id, slots)
+    dependency_graph.archetype_changed(header.id)
+    return header.id
+
+
+def remove_file(xml_file):
+    """Forget the archetype(s) loaded from a deleted file; returns their ids."""
+    with _lock:
+        removed = [archetype_id for archetype_id, header in ARCHETYPE_CACHE.items() if header.path == xml_file]
+        for archetype_id in removed:
+            del ARCHETYPE_CACHE[archetype_id]
+            _signatures.pop(archetype_id, None)
+            _from_snapshot.discard(archetype_id)
+        _drop_forms(removed)
+    for archetype_id in removed:
+        search_index.INDEX.remove('archetype', archetype_id)
+        slot_index.INDEX.remove(archetype_id)
+        dependency_graph.archetype_changed(archetype_id)
+    return removed
+
+
+def _drop_forms(archetype_ids):
+    # Caller holds _lock
+    for key in [key for key in _forms if key[0] in archetype_ids]:
+        del _forms[key]
+
+
+def _signature(xml_file):
+    try:
+        return xml_file, os.path.getmtime(xml_file)
+    except OSError:
+        return None
+
+
+def ensure_built():
+    """Load the catalog snapshot (or a new generation of it), else scan the archetype directory once."""
+    snapshot = catalog_snapshot.current()
+    if snapshot is not None and snapshot is not _snapshot:
+        load_snapshot(snapshot)
+        return
+    # Concurrent first calls may both scan; the result is the same
+    if not _built:
+        build_archetype_cache()
+
+
+def load_snapshot(snapshot):
+    """
+    Replace the catalog with a mapped snapshot generation. Archetypes whose
+    signature differs from the previous state drop their forms and notify
+    the dependency graph, as in a rescan.
+    """
+    global _built, _snapshot, _search_pending
+    headers = {}
+    signatures = {}
+    for archetype_id, entry in snapshot.archetypes.items():
+        headers[archetype_id] = ArchetypeHeader(archetype_id, entry['name'], entry['path'])
+        signatures[archetype_id] = tuple(entry['signature']) if entry['signature'] else None
+
+    with _lock:
+        was_built = _built
+        changed_ids = {archetype_id for archetype_id in set(headers) | set(_signatures)
+                       if _signatures.get(archetype_id) != signatures.get(archetype_id)}
+        ARCHETYPE_CACHE.clear()
+        ARCHETYPE_CACHE.update(headers)
+        _signatures.clear()
+        _signatures.update(signatures)
+        _drop_forms(changed_ids)
+        _from_snapshot.clear()
+        _from_snapshot.update(headers)
+        _snapshot = snapshot
+        _search_pending = True
+        _built = True
+    slot_index.INDEX.load(json.loads(snapshot.extra('slots')))
+    graph = snapshot.extra('dependencies')
+    if graph is not None:
+        dependency_graph.load_graph(json.loads(graph))
+    if was_built:
+        for archetype_id in changed_ids:
+            dependency_graph.archetype_changed(archetype_id)
+    logger.info(f"Archetype catalog loaded from snapshot generation {snapshot.generation} "
+                f"({len(headers)} archetypes, {len(changed_ids) if was_built else 0} changed)")
+
+
+def ensure_searchable():
+    """Make sure archetypes are in the search index (deferred after a snapshot load)."""
+    global _search_pending
+    ensure_built()
+    if not _search_pending:
+        return
+    snapshot = _snapshot
+    documents = [
+        (archetype_id, ARCHETYPE_CACHE[archetype_id].to_dict(), json.loads(snapshot.blob(entry['search'])),
+         _signatures.get(archetype_id))
+        for archetype_id, entry in snapshot.archetypes.items() if archetype_id in ARCHETYPE_CACHE
+    ]
+    search_index.INDEX.sync('archetype', documents)
+    _search_pending = False
+
+
+def export_snapshot(path):
+    """
+    Scan ARCHETYPE_ROOT_DIR and the OPTs and write a new catalog snapshot
+    generation to `path` (see catalog_snapshot.py). Does not change this
+    process's catalog. Forms are stored in DEFAULT_LANGUAGE only.
+
+    Returns:
+        int: The generation written
+    """
+    archetypes = {}
+    blobs = {}
+    slots_graph = slot_index.SlotIndex()
+    for xml_file in glob.glob(os.path.join(ARCHETYPE_ROOT_DIR, '**', '*.xml'), recursive=True):
+        scanned = scan_archetype(xml_file)
+        if not scanned:
+            continue
+        header, fields, slots = scanned
+        form = to_dicts(parse_archetype_to_nodes(xml_file, DEFAULT_LANGUAGE))
+        archetypes[header.id] = {
+            'name': header.name,
+            'path': header.path,
+            'signature': _signature(xml_file),
+        }
+        slots_graph.update(header.id, slots)
+        blobs[header.id] = {
+            # Same encoder as live responses, so both paths serve identical bytes
+            'form': json_provider.dumps(form),
+            'search': json.dumps(fields, separators=(',', ':')).encode('utf-8'),
+        }
+    extras = {
+        'slots': json.dumps(slots_graph.export(), separators=(',', ':')).encode('utf-8'),
+        'dependencies': json.dumps(dependency_graph.export_graph(), separators=(',', ':')).encode('utf-8'),
+    }
+    return catalog_snapshot.write(path, archetypes, blobs, extras)
+
+
+def list_archetypes():
+    """All catalog entries as dicts, sorted by name."""
+    ensure_built()
+    return sorted((header.to_dict() for header in ARCHETYPE_CACHE.values()), key=lambda h: h['name'])
+
+
+def get_header(archetype_id):
+    ensure_built()
+    return ARCHETYPE_CACHE.get(archetype_id)
+
+
+def get_form_nodes(archetype_id, language=None):
+    """
+    Parsed form of one archetype as FormNode trees (parsed on first use, then kept).
+    Labels are in `language` (default ARCHETYPE_LANGUAGE) where the archetype has it.
+
+    Returns:
+        list | None: None if the archetype is not in the catalog.
+    """
+    header = get_header(archetype_id)
+    if header is None:
+        return None
+    key = (archetype_id, language or DEFAULT_LANGUAGE)
+    nodes = _forms.get(key)
+    if nodes is None:
+        nodes = parse_archetype_to_nodes(header.path, key[1])
+        with _lock:
+            _forms[key] = nodes
+    return nodes
+
+
+def get_form_json(archetype_id, language=None):
+    """
+    The form of one archetype as response-ready JSON bytes, straight from the
+    mapped snapshot. None if it is not served from the snapshot (unknown
+    archetype, changed since the snapshot, or a non-default language).
+    """
+    ensure_built()
+    snapshot = _snapshot
+    if (language or DEFAULT_LANGUAGE) != DEFAULT_LANGUAGE or archetype_id not in _from_snapshot:
+        return None
+    entry = snapshot.archetypes.get(archetype_id)
+    return None if entry is None else snapshot.blob(entry['form'])
+
+
+def get_form(archetype_id, language=None, expand_slots=False):
+    """
+    Parsed form of one archetype as JSON-ready dicts, or None if unknown.
+    With expand_slots, every slot field also lists its 'candidates'
+    ([{id, name}], from slot_index).
+    """
+    payload = get_form_json(archetype_id, language)
+    if payload is not None:
+        form = json.loads(payload)
+    else:
+        nodes = get_form_nodes(archetype_id, language)
+        if nodes is None:
+            return None
+        form = to_dicts(nodes)
+    if expand_slots:
+        _add_slot_candidates(archetype_id, form)
+    return form
+
+
+def get_slots(archetype_id):
+    """Slots of one archetype with their candidates ({id, name}), or None if unknown."""
+    ensure_built()
+    slots = slot_index.INDEX.slots_of(archetype_id)
+    if slots is None:
+        return None
+    for slot in slots.values():
+        slot['candidates'] = _candidate_summaries(slot['candidates'])
+    return slots
+
+
+def _candidate_summaries(archetype_ids):
+    return [ARCHETYPE_CACHE[i].to_dict() for i in archetype_ids if i in ARCHETYPE_CACHE]
+
+
+def _add_slot_candidates(archetype_id, fields):
+    for field in fields:
+        if field.get('type') == 'slot':
+            field['candidates'] = _candidate_summaries(slot_index.INDEX.candidates(archetype_id, field['name']) or ())
+        _add_slot_candidates(archetype_id, field.get('children') or ())
+
+
+def preload_forms():
+    """Parse every archetype in the catalog now (e.g. before forking workers)."""
+    ensure_built()
+    for archetype_id in list(ARCHETYPE_CACHE):
+        get_form_nodes(archetype_id)
+    return len(_forms)
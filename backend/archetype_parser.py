@@ -1,45 +1,35 @@
 from lxml import etree as ET
 import os
 
+from term_store import load_ontology
+from slot_index import is_slot
+from form_nodes import FormNode, intern_text, to_dicts
+
 NAMESPACES = {'openEHR': 'http://schemas.openehr.org/v1'}
 
 
-def build_ontology_map(root):
+def build_ontology_map(root, language=None, source=None):
     """
-    Creates a dictionary mapping 'at' codes (e.g., 'at0001') to their
-    human-readable text from the <ontology> section.
+    Returns the archetype's 'at' codes (e.g., 'at0001') mapped to their
+    human-readable text from the <ontology> section, as a dict-like
+    term_store.Ontology backed by the shared, interned term store.
+    `language` defaults to ARCHETYPE_LANGUAGE ('en'), falling back to the
+    first <term_definitions>; other languages load lazily from `source`.
     """
-    ontology_map = {}
     try:
-        lang_node = root.find(
-            f".//openEHR:ontology/openEHR:term_definitions[@language='en']", namespaces=NAMESPACES)
-
-        if lang_node is None:
-            lang_node = root.find('.//openEHR:ontology/openEHR:term_definitions', namespaces=NAMESPACES)
-
-        if lang_node is None:
+        ontology = load_ontology(root, language, source)
+        if not ontology and not ontology.languages:
             print("Warning: Could not find <term_definitions> in ontology.")
-            return {}
-
-        for item in lang_node.findall('openEHR:items', namespaces=NAMESPACES):
-            code = item.get('code')
-            if not code:
-                continue
-
-            text_item = item.find('openEHR:items[@id="text"]', namespaces=NAMESPACES)
-            if text_item is not None and text_item.text:
-                ontology_map[code] = text_item.text.strip()
-
+        return ontology
     except Exception as e:
         print(f"Error building ontology map: {e}")
-
-    return ontology_map
+        return {}
 
 
 def get_form_field(child, ontology_map):
     """
     Parses a single <children> element from the <definition> and
-    translates it into a form field dictionary.
+    translates it into a FormNode (see form_nodes.py).
     """
     node_id_node = child.find('openEHR:node_id', namespaces=NAMESPACES)
     if node_id_node is None:
@@ -48,9 +38,17 @@ def get_form_field(child, ontology_map):
     node_id = node_id_node.text
     rm_type = child.find('openEHR:rm_type_name', namespaces=NAMESPACES).text
     field_label = ontology_map.get(node_id, node_id)
-    field = {'label': field_label, 'name': node_id}
+    field = FormNode(field_label, node_id)
 
-    if rm_type == 'ELEMENT':
+    if is_slot(child):
+        # Slots are <children xsi:type="ARCHETYPE_SLOT"> with the slot's RM type
+        # (e.g. CLUSTER) as rm_type_name; candidates come from slot_index
+        field.type = 'slot'
+        field.allows = (child.findtext('.//openEHR:includes/openEHR:string_expression', namespaces=NAMESPACES)
+                        or child.findtext('.//openEHR:includes//openEHR:pattern', namespaces=NAMESPACES)
+                        or 'any')
+
+    elif rm_type == 'ELEMENT':
         # --- THIS IS THE FIX ---
         # Find <attributes> node that has a *child* <rm_attribute_name> with text 'value'
         value_node_parent = child.find('openEHR:attributes[openEHR:rm_attribute_name="value"]', namespaces=NAMESPACES)
@@ -62,54 +60,47 @@ def get_form_field(child, ontology_map):
 
         if value_node:
             value_rm_type = value_node.find('openEHR:rm_type_name', namespaces=NAMESPACES).text
-            field['rm_type'] = value_rm_type
+            field.rm_type = intern_text(value_rm_type)
 
             if value_rm_type == 'DV_TEXT':
-                field['type'] = 'text'
+                field.type = 'text'
             elif value_rm_type == 'DV_QUANTITY':
-                field['type'] = 'number'
+                field.type = 'number'
                 try:
                     units = value_node.find('.//openEHR:units', namespaces=NAMESPACES).text
-                    field['units'] = units
+                    field.set_units(units)
                 except AttributeError:
-                    field['units'] = None
+                    field.set_units(None)
             elif value_rm_type == 'DV_DATE_TIME':
-                field['type'] = 'datetime-local'
+                field.type = 'datetime-local'
             elif value_rm_type == 'DV_DATE':
-                field['type'] = 'date'
+                field.type = 'date'
             elif value_rm_type == 'DV_COUNT':
-                field['type'] = 'number'
-                field['step'] = 1
+                field.type = 'number'
+                field.step = 1
             elif value_rm_type == 'DV_BOOLEAN':
-                field['type'] = 'checkbox'
-                field['default'] = False
+                field.type = 'checkbox'
+                field.default = False
             elif value_rm_type == 'DV_CODED_TEXT':
-                field['type'] = 'select'
-                field['options'] = []
+                field.type = 'select'
+                field.options = []
                 try:
                     code_list = value_node.findall('.//openEHR:code_list', namespaces=NAMESPACES)
                     for code_item in code_list:
                         code_val = code_item.text
                         option_label = ontology_map.get(code_val, code_val)
-                        field['options'].append({'value': code_val, 'label': option_label})
+                        field.add_option(code_val, option_label)
                 except Exception as e:
                     print(f"Warning: Could not parse options for {node_id}: {e}")
             else:
-                field['type'] = value_rm_type
+                field.type = field.rm_type
         else:
             print(f"Warning: No 'value' attribute found for ELEMENT {node_id}")
-            field['type'] = 'unsupported_element'
-
-    elif rm_type == 'ARCHETYPE_SLOT':
-        field['type'] = 'slot'
-        try:
-            field['allows'] = child.find('.//openEHR:includes/openEHR:string_expression', namespaces=NAMESPACES).text
-        except AttributeError:
-            field['allows'] = 'any'
+            field.type = 'unsupported_element'
 
     elif rm_type == 'CLUSTER':
-        field['type'] = 'cluster'
-        field['children'] = []
+        field.type = 'cluster'
+        field.children = []
         # --- THIS IS THE FIX ---
         item_attributes = child.find('openEHR:attributes[openEHR:rm_attribute_name="items"]', namespaces=NAMESPACES)
         # -----------------------
@@ -117,18 +108,27 @@ def get_form_field(child, ontology_map):
             for sub_child in item_attributes.findall('openEHR:children', namespaces=NAMESPACES):
                 sub_field = get_form_field(sub_child, ontology_map)
                 if sub_field:
-                    field['children'].append(sub_field)
+                    field.add_child(sub_field)
 
     else:
-        field['type'] = rm_type
+        field.type = intern_text(rm_type)
 
     return field
 
 
-def parse_archetype_to_form(xml_file):
+def parse_archetype_to_form(xml_file, language=None):
     """
     Main function to parse an openEHR XML file and return a list
-    of form field definitions.
+    of form field definitions (JSON-ready dicts).
+    """
+    return to_dicts(parse_archetype_to_nodes(xml_file, language))
+
+
+def parse_archetype_to_nodes(xml_file, language=None):
+    """
+    Parse an openEHR XML file into a list of compact FormNode trees.
+    Use this when keeping parsed forms in memory; convert with to_dicts()
+    only when responding.
     """
     try:
         if not os.path.exists(xml_file):
@@ -138,7 +138,7 @@ def parse_archetype_to_form(xml_file):
         tree = ET.parse(xml_file)
         root = tree.getroot()
 
-        ontology_map = build_ontology_map(root)
+        ontology_map = build_ontology_map(root, language, source=xml_file)
         if not ontology_map:
             print(f"Warning: Ontology map is empty for {xml_file}. Labels may be missing.")
 
@@ -155,12 +155,8 @@ def parse_archetype_to_form(xml_file):
             if root_label == 'Cluster':
                 root_label = os.path.basename(xml_file)
 
-            root_field = {
-                'label': root_label,
-                'name': root_node_id,
-                'type': 'cluster',
-                'children': []
-            }
+            root_field = FormNode(root_label, root_node_id, 'cluster')
+            root_field.children = []
 
             # --- THIS IS THE FIX ---
             cluster_items = definition.find('openEHR:attributes[openEHR:rm_attribute_name="items"]',
@@ -171,10 +167,10 @@ def parse_archetype_to_form(xml_file):
                 for child in cluster_items.findall('openEHR:children', namespaces=NAMESPACES):
                     field = get_form_field(child, ontology_map)
                     if field:
-                        root_field['children'].append(field)
+                        root_field.add_child(field)
 
-            if root_field['children']:
-                form_fields.append(root_field)
+            if root_field.children:
+                form_fields.append(root_field.compact())
             else:
                 # This warning is what you were seeing, it's not a crash
                 print(f"Warning: CLUSTER {root_node_id} had no parsable children.")
@@ -2,7 +2,14 @@
 openEHR Medical Application — Flask Backend
 
 This backend acts as a secure proxy layer between the React/Medblocks-UI frontend
-and the EHRbase Clinical Data Repository. It does NOT store clinical data locally.
+and the EHRbase Clinical Data Repository, which remains the system of record.
+
+Local copies of clinical data: besides the patient_id -> ehr_id mapping, every
+composition EHRbase accepts is mirrored (write-behind, best effort; see
+composition_mirror.py) into the PostgreSQL `ehr_documents` table: its cleaned
+FLAT JSON, ehr_id, template_id, composition uid and composer name
+(recorded_by), with patient_id resolved through the mapping, or 'UNKNOWN'
+when it cannot be resolved. Set COMPOSITION_MIRROR_ENABLED=false to keep no local copy.
 
 SAFETY: All clinical data operations are audit-logged. Input validation is enforced
 on every endpoint that handles patient data.
@@ -10,17 +17,33 @@ on every endpoint that handles patient data.
 
 import os
 import re
-import json
+import time
+import hashlib
 import logging
 from datetime import datetime
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from flask import Flask, jsonify, abort, request
+from flask import Flask, jsonify, abort, request, g, Response
 from flask_cors import CORS
 from werkzeug.exceptions import HTTPException
 from dotenv import load_dotenv
 
-from ehrbase_client import EHRbaseClient, EHRbaseError
+import db
+import metrics
+import services
+import json_provider
+import profiling
+import aql_export
+import aql_registry
+import search_index
+import dependency_graph
+import web_template_index
+import web_template_profiles
+import composition_mirror
+import template_invalidations
+from json_provider import PreSerialized
+from ehrbase_client import EHRbaseClient, EHRbaseError, is_versioned_uid
 
 # Load environment variables from .env file
 load_dotenv()
@@ -35,13 +58,50 @@ logger = logging.getLogger('openehr_backend')
 
 # ─── Flask App Setup ──────────────────────────────────────────────────
 app = Flask(__name__)
+# orjson-backed JSON for every response (stdlib fallback, see json_provider.py)
+app.json = json_provider.FastJSONProvider(app)
 
 # CORS: Restrict to allowed origins only
 cors_origins = os.getenv('CORS_ORIGINS', 'http://localhost:3000').split(',')
 CORS(app, origins=cors_origins)
 
+# Opt-in request profiling (no hooks are installed unless configured)
+profiling.init_app(app)
+
 # ─── EHRbase Client ───────────────────────────────────────────────────
-ehrbase = EHRbaseClient()
+# Created on first use, not at import (see services.py); `ehrbase` stands in for it
+EHRBASE = services.LazyService('ehrbase', EHRbaseClient, close=lambda client: client.session.close(),
+                               after_fork=lambda client: client.reset_session())
+ehrbase = EHRBASE.proxy
+
+
+def _forget_web_template(template_id):
+    # Template updates drop only that template's stale copy (see dependency_graph.py)
+    client = EHRBASE.peek()
+    if client is not None:
+        client.forget_web_template(template_id)
+
+
+dependency_graph.add_listener('template', _forget_web_template)
+
+# Bounded pool for /api/query/batch fan-out (shared by all requests)
+AQL_BATCH_MAX_QUERIES = int(os.getenv('AQL_BATCH_MAX_QUERIES', '10'))
+AQL_BATCH_POOL = services.LazyService(
+    'aql_batch_pool',
+    lambda: ThreadPoolExecutor(
+        max_workers=int(os.getenv('AQL_BATCH_WORKERS', '8')),
+        thread_name_prefix='aql-batch'
+    ),
+    close=lambda pool: pool.shutdown(wait=False),
+)
+aql_batch_pool = AQL_BATCH_POOL.proxy
+
+UUID_PATTERN = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+LANGUAGE_PATTERN = re.compile(r'^[a-z]{2,3}(-[A-Za-z]{2,4})?$')
+COMPOSITION_UID_PATTERN = re.compile(r'^[0-9a-fA-F-]{36}(::[A-Za-z0-9._-]+::\d+)?$')
+
+EHR_BULK_MAX_PATIENTS = int(os.getenv('EHR_BULK_MAX_PATIENTS', '5000'))
+EHR_LOOKUP_MAX_PATIENTS = int(os.getenv('EHR_LOOKUP_MAX_PATIENTS', '500'))
 
 # ─── Rate Limiting ────────────────────────────────────────────────────
 try:
@@ -59,13 +119,39 @@ except ImportError:
     logger.warning("flask-limiter not installed. Rate limiting disabled.")
 
 
+# ─── Request Metrics ──────────────────────────────────────────────────
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Record per-route latency and status; labelled by URL rule, never by raw path."""
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_LATENCY.observe(time.perf_counter() - started, route=route, method=request.method)
+        metrics.HTTP_RESPONSES.inc(route=route, method=request.method, status=response.status_code)
+    return response
+
+
+# ─── Cross-Worker Invalidation ────────────────────────────────────────
+
+@app.before_request
+def apply_published_invalidations():
+    # Templates uploaded by other processes, e.g. upload_templates.py (see template_invalidations.py)
+    template_invalidations.poll()
+
+
 # ─── Error Handlers ───────────────────────────────────────────────────
 
 @app.errorhandler(HTTPException)
 def handle_http_exception(e):
     """Return JSON instead of HTML for HTTP errors."""
     response = e.get_response()
-    response.data = json.dumps({
+    response.data = app.json.dumps({
         "code": e.code,
         "name": e.name,
         "description": e.description,
@@ -85,6 +171,41 @@ def handle_ehrbase_error(e):
     }), status
 
 
+# ─── Response Helpers ─────────────────────────────────────────────────
+
+def stale_response(payload):
+    """
+    Wrap a last-known-good payload served during an EHRbase outage.
+    The body shape is unchanged; staleness is flagged in the headers.
+    A PreSerialized payload (cached JSON bytes) is sent as-is.
+    """
+    response = jsonify(payload)
+    response.headers['Warning'] = '110 - "Response is Stale"'
+    response.headers['X-Served-Stale'] = 'true'
+    return response
+
+
+def is_upstream_outage(error):
+    """True for EHRbase errors that mean 'CDR unavailable' rather than 'bad request'."""
+    return (error.status_code or 502) >= 500
+
+
+def with_display_names(templates):
+    """
+    Enrich template summaries with display-friendly names.
+    The client may share its list with concurrent requests, so this copies.
+    """
+    enriched = []
+    for t in templates:
+        t = dict(t)
+        # Use concept as display name, fallback to template_id
+        name = t.get('concept', t.get('template_id', 'Unknown'))
+        # Convert underscores/dots to spaces and title-case for display
+        t['display_name'] = name.replace('_', ' ').replace('.', ' ').title()
+        enriched.append(t)
+    return enriched
+
+
 # ─── Input Validation Helpers ─────────────────────────────────────────
 
 def validate_patient_id(patient_id):
@@ -116,6 +237,21 @@ def validate_template_id(template_id):
     return True
 
 
+def validate_read_only_aql(aql):
+    """
+    SAFETY: Basic AQL injection prevention.
+    AQL should not contain dangerous keywords for data modification; aborts with 400 if it does.
+    """
+    if not aql or not isinstance(aql, str):
+        abort(400, description="Missing or invalid 'aql' query.")
+    dangerous_patterns = ['DELETE', 'UPDATE', 'DROP', 'INSERT', 'ALTER', 'TRUNCATE']
+    aql_upper = aql.upper()
+    for pattern in dangerous_patterns:
+        if pattern in aql_upper:
+            logger.warning(f"AUDIT: Blocked potentially dangerous AQL query containing '{pattern}'")
+            abort(400, description=f"AQL queries containing '{pattern}' are not allowed.")
+
+
 def sanitize_string(value, max_length=1000):
     """
     SAFETY: Sanitize string inputs by stripping control characters
@@ -137,10 +273,8 @@ def health_check():
     """
     Health check endpoint verifying backend, DB, and EHRbase connectivity.
     """
-    from db import check_db_health
-    
     ehrbase_status = ehrbase.health_check()
-    db_status = 'healthy' if check_db_health() else 'unreachable'
+    db_status = 'healthy' if db.check_db_health() else 'unreachable'
     
     return jsonify({
         'backend': 'healthy',
@@ -150,6 +284,58 @@ def health_check():
     })
 
 
+# ── Metrics ──
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus scrape endpoint: route/upstream latency histograms, status
+    counters, DB pool checkout waits and cache hit ratios. Under gunicorn
+    these are the answering worker's metrics only (see metrics.py).
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+if limiter:
+    limiter.exempt(metrics_endpoint)
+
+
+# ── Profiling ──
+
+@app.route('/api/profiles', methods=['GET'])
+def list_profiles():
+    """
+    Summaries of the most recent request profiles (newest first).
+
+    Query params: limit (default 20, max 200), route (exact URL rule filter).
+    Requires a valid X-Profile-Request signature; without PROFILE_SECRET the
+    profiles are not served at all (403).
+    """
+    require_profiling_access()
+    limit = min(request.args.get('limit', 20, type=int) or 20, 200)
+    return jsonify(profiling.list_summaries(limit=limit, route=request.args.get('route')))
+
+
+@app.route('/api/profiles/<string:profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """Full summary (stage timings and top functions) for one request profile."""
+    require_profiling_access()
+    summary = profiling.get_summary(profile_id)
+    if summary is None:
+        abort(404, description=f"Profile '{profile_id}' not found.")
+    return jsonify(summary)
+
+
+def require_profiling_access():
+    if not profiling.ENABLED:
+        abort(404, description="Request profiling is not enabled.")
+    if not profiling.SECRET:
+        # Sampling alone must not expose timings and routes without authentication
+        abort(403, description="Profile access requires PROFILE_SECRET to be configured.")
+    if not profiling.verify_signature(request.headers.get(profiling.HEADER)):
+        abort(403, description="A valid signed X-Profile-Request header is required.")
+
+
 # ── Template Management ──
 
 @app.route('/api/templates', methods=['GET'])
@@ -169,23 +355,35 @@ def get_templates():
     ]
     """
     try:
-        templates = ehrbase.list_templates()
-
-        # Enrich with display-friendly names
-        for t in templates:
-            # Use concept as display name, fallback to template_id
-            name = t.get('concept', t.get('template_id', 'Unknown'))
-            # Convert underscores/dots to spaces and title-case for display
-            t['display_name'] = name.replace('_', ' ').replace('.', ' ').title()
-
+        templates = with_display_names(ehrbase.list_templates())
+        search_index.sync_templates(templates)
         logger.info(f"Serving {len(templates)} templates to frontend")
         return jsonify(templates)
 
     except EHRbaseError as e:
+        stale = ehrbase.get_stale('list_templates')
+        if stale is not None and is_upstream_outage(e):
+            logger.warning(f"Serving stale template list during EHRbase outage: {e}")
+            return stale_response(with_display_names(stale))
         logger.error(f"Failed to fetch templates: {e}")
         abort(502, description="Could not fetch templates from EHRbase.")
 
 
+@app.route('/api/templates/<path:template_id>/dependencies', methods=['GET'])
+def get_template_dependencies(template_id):
+    """
+    API Endpoint: The archetypes a template embeds, with their AQL paths and
+    (once the web template has been indexed) FLAT path prefixes.
+    """
+    if not validate_template_id(template_id):
+        abort(400, description="Invalid template ID format.")
+    dependency_graph.ensure_loaded()
+    dependencies = dependency_graph.GRAPH.describe(template_id)
+    if dependencies is None:
+        abort(404, description=f"No OPT known for template '{template_id}'.")
+    return jsonify(dependencies)
+
+
 @app.route('/api/web-template/<path:template_id>', methods=['GET'])
 def get_web_template(template_id):
     """
@@ -194,21 +392,170 @@ def get_web_template(template_id):
 
     Args:
         template_id: The template identifier (e.g., 'blood_pressure')
+
+    Query string / headers:
+        ?profile= or X-Web-Template-Profile: full | form | mobile (see web_template_profiles.py)
+        ?lang=de  label language for slimmed profiles (default: the template's default language)
     """
-    if not validate_template_id(template_id):
-        abort(400, description="Invalid template ID format.")
+    with profiling.stage('validate'):
+        if not validate_template_id(template_id):
+            abort(400, description="Invalid template ID format.")
+        profile = (request.args.get('profile') or request.headers.get('X-Web-Template-Profile')
+                   or web_template_profiles.DEFAULT_PROFILE)
+        if profile not in web_template_profiles.PROFILES:
+            abort(400, description=f"Unknown profile '{profile}'. Use one of: "
+                                   f"{', '.join(web_template_profiles.PROFILES)}")
+        language = request.args.get('lang')
+        if language and not LANGUAGE_PATTERN.match(language):
+            abort(400, description="Invalid 'lang'.")
 
     try:
-        web_template = ehrbase.get_web_template(template_id)
-        return jsonify(web_template)
+        # Served from the serialized projection cache (the full document included)
+        payload = web_template_profiles.get_projected(template_id, profile, language, ehrbase.get_web_template)
+        return jsonify(PreSerialized(payload))
 
     except EHRbaseError as e:
         if e.status_code == 404:
             abort(404, description=f"Template '{template_id}' not found in EHRbase.")
+        if is_upstream_outage(e):
+            payload = web_template_profiles.get_stale(template_id, profile, language)
+            if payload is not None:
+                logger.warning(f"Serving stale '{profile}' web template '{template_id}' during EHRbase outage: {e}")
+                return stale_response(PreSerialized(payload))
+        stale = ehrbase.get_stale('web_template', template_id)
+        if stale is not None and is_upstream_outage(e):
+            logger.warning(f"Serving stale web template '{template_id}' during EHRbase outage: {e}")
+            if web_template_profiles.PROFILES[profile] is not None:
+                # Slimmed profiles get the stale full template projected, never the full payload
+                stale = web_template_profiles.project(stale, profile, language)
+            return stale_response(stale)
         logger.error(f"Error fetching web template '{template_id}': {e}")
         abort(502, description="Could not fetch web template from EHRbase.")
 
 
+def load_web_template_index(template_id):
+    """Validate the template id and return its (cached) path index; aborts on errors."""
+    if not validate_template_id(template_id):
+        abort(400, description="Invalid template ID format.")
+    try:
+        index = web_template_index.get_index(template_id, ehrbase.get_web_template)
+        dependency_graph.record_flat_paths(template_id, index)
+        return index
+    except EHRbaseError as e:
+        if e.status_code == 404:
+            abort(404, description=f"Template '{template_id}' not found in EHRbase.")
+        index = web_template_index.get_stale(template_id)
+        if index is not None and is_upstream_outage(e):
+            logger.warning(f"Serving stale web template index '{template_id}' during EHRbase outage: {e}")
+            return index
+        logger.error(f"Error fetching web template '{template_id}': {e}")
+        abort(502, description="Could not fetch web template from EHRbase.")
+
+
+@app.route('/api/web-template/<path:template_id>/outline', methods=['GET'])
+def get_web_template_outline(template_id):
+    """
+    API Endpoint: Template metadata and the top-level nodes of a web template.
+
+    Query string: ?path=<node path> (default: root), ?depth=1..3 (default 1)
+    Each entry carries id, name, rmType, min/max, its 'path' and 'childCount';
+    fetch a subtree with /api/web-template/<id>/node?path=...
+    """
+    depth = request.args.get('depth', 1, type=int)
+    if not 0 <= depth <= 3:
+        abort(400, description="'depth' must be between 0 and 3.")
+    index = load_web_template_index(template_id)
+    with profiling.stage('serialize'):
+        outline = index.outline(request.args.get('path', ''), depth)
+        if outline is None:
+            abort(404, description=f"No node at path '{request.args.get('path')}' in '{template_id}'.")
+        return jsonify(outline)
+
+
+@app.route('/api/web-template/<path:template_id>/node', methods=['GET'])
+def get_web_template_node(template_id):
+    """
+    API Endpoint: One subtree of a web template, addressed by node id path.
+
+    Query string: ?path=vitals/blood_pressure/any_event (leading root id optional)
+    Response: { "templateId": ..., "path": ..., "node": { ...subtree... } }
+    """
+    path = request.args.get('path', '')
+    index = load_web_template_index(template_id)
+    node = index.get(path)
+    if node is None:
+        abort(404, description=f"No node at path '{path}' in '{template_id}'.")
+    with profiling.stage('serialize'):
+        return jsonify({
+            'templateId': index.meta.get('templateId', template_id),
+            'path': index.full_path(path),
+            'node': node,
+        })
+
+
+# ── Archetype Catalog ──
+
+@app.route('/api/archetypes', methods=['GET'])
+def get_archetype_list():
+    """
+    API Endpoint: Returns the catalog of CKM archetypes (id and name), sorted by name.
+    """
+    from archetype_catalog import list_archetypes
+    return jsonify(list_archetypes())
+
+
+@app.route('/api/archetype/form/<path:archetype_id>', methods=['GET'])
+def get_archetype_form(archetype_id):
+    """
+    API Endpoint: Parses a single archetype and returns its form definition.
+    A trailing '.xml' on the id is ignored; ?lang= selects the label language.
+    With ?expand_slots=true, slot fields list the archetypes that fit them.
+    """
+    from archetype_catalog import get_form, get_form_json
+
+    if archetype_id.endswith('.xml'):
+        archetype_id = archetype_id[:-4]
+
+    language = request.args.get('lang')
+    if language and not LANGUAGE_PATTERN.match(language):
+        abort(400, description="Invalid 'lang'.")
+
+    expand_slots = request.args.get('expand_slots', 'false').lower() in ('1', 'true', 'yes')
+    if not expand_slots:
+        # Served as-is from the mapped catalog snapshot when there is one
+        payload = get_form_json(archetype_id, language)
+        if payload is not None and payload != b'[]':
+            return jsonify(PreSerialized(payload))
+
+    form = get_form(archetype_id, language, expand_slots=expand_slots)
+    if form is None:
+        abort(404, description=f"Archetype '{archetype_id}' not found in catalog.")
+    if not form:
+        abort(422, description=f"Archetype '{archetype_id}' could not be parsed into a form.")
+    with profiling.stage('serialize'):
+        return jsonify(form)
+
+
+@app.route('/api/archetype/slots/<path:archetype_id>', methods=['GET'])
+def get_archetype_slots(archetype_id):
+    """
+    API Endpoint: The slots of one archetype, with the archetypes that fit each
+    (precomputed by slot_index; a lookup, not a catalog scan).
+
+    Response:
+    { "at1030": { "rm_type": "CLUSTER", "includes": ["..."], "excludes": [],
+                  "candidates": [{"id": "...", "name": "..."}] } }
+    """
+    from archetype_catalog import get_slots
+
+    if archetype_id.endswith('.xml'):
+        archetype_id = archetype_id[:-4]
+    slots = get_slots(archetype_id)
+    if slots is None:
+        abort(404, description=f"Archetype '{archetype_id}' not found in catalog.")
+    return jsonify(slots)
+
+
 # ── EHR Management ──
 
 @app.route('/api/ehr', methods=['POST'])
@@ -248,6 +595,75 @@ def create_ehr():
         abort(502, description=f"Failed to create/fetch EHR: {e}")
 
 
+@app.route('/api/ehr/bulk', methods=['POST'])
+def bulk_create_ehrs():
+    """
+    API Endpoint: Ensure many patients have an EHR in one call.
+
+    Request body: { "patient_ids": ["PAT-001", "PAT-002", ...] }
+    Response: { "total", "existing", "created", "ehr_ids": {patient_id: ehr_id}, "failed": {patient_id: error} }
+
+    SAFETY: Uses the same one-EHR-per-patient locking as /api/ehr. Re-sending
+    the same list is safe and only creates what is still missing.
+    For very large lists use provision_ehrs.py instead.
+    """
+    patient_ids = (request.get_json(silent=True) or {}).get('patient_ids')
+    if not isinstance(patient_ids, list) or not patient_ids:
+        abort(400, description="'patient_ids' must be a non-empty list.")
+    if len(patient_ids) > EHR_BULK_MAX_PATIENTS:
+        abort(400, description=f"At most {EHR_BULK_MAX_PATIENTS} patient_ids per request.")
+
+    invalid = {str(pid)[:64]: 'Invalid patient_id' for pid in patient_ids if not validate_patient_id(pid)}
+    valid = [pid for pid in patient_ids if validate_patient_id(pid)]
+
+    logger.info(f"AUDIT: Bulk EHR provisioning requested for {len(valid)} patients")
+    try:
+        summary = ehrbase.bulk_create_ehrs(valid) if valid else {
+            'total': 0, 'processed': 0, 'existing': 0, 'created': 0, 'ehr_ids': {}, 'failed': {}}
+    except EHRbaseError as e:
+        logger.error(f"AUDIT: Bulk EHR provisioning failed: {e}")
+        abort(e.status_code if e.status_code == 503 else 502, description=f"Bulk EHR provisioning failed: {e}")
+
+    summary['failed'].update(invalid)
+    summary['total'] += len(invalid)
+    logger.info(f"AUDIT: Bulk EHR provisioning done: {summary['created']} created, "
+                f"{summary['existing']} existing, {len(summary['failed'])} failed")
+    return jsonify(summary)
+
+
+@app.route('/api/ehr/lookup', methods=['POST'])
+def lookup_ehrs():
+    """
+    API Endpoint: Resolve many patients to their EHR ids in one round trip.
+
+    Request body: { "patient_ids": ["PAT-001", ...], "verify": false }
+    Response: { "ehr_ids": {patient_id: ehr_id}, "missing": [...], "invalid": [...] }
+              (+ "unverified": {patient_id: error} when verify is true)
+
+    Served by a single indexed lookup on patient_mapping. With verify=true each
+    mapped EHR is also confirmed against EHRbase (concurrently).
+    """
+    body = request.get_json(silent=True) or {}
+    patient_ids = body.get('patient_ids')
+    if not isinstance(patient_ids, list) or not patient_ids:
+        abort(400, description="'patient_ids' must be a non-empty list.")
+    if len(patient_ids) > EHR_LOOKUP_MAX_PATIENTS:
+        abort(400, description=f"At most {EHR_LOOKUP_MAX_PATIENTS} patient_ids per request.")
+
+    invalid = [str(pid)[:64] for pid in patient_ids if not validate_patient_id(pid)]
+    valid = [pid for pid in patient_ids if validate_patient_id(pid)]
+
+    try:
+        result = ehrbase.lookup_ehrs_by_subjects(valid, verify=bool(body.get('verify'))) if valid else {
+            'ehr_ids': {}, 'missing': []}
+    except EHRbaseError as e:
+        logger.error(f"Batch EHR lookup failed: {e}")
+        abort(503, description="Patient mapping database is unavailable.")
+
+    result['invalid'] = invalid
+    return jsonify(result)
+
+
 @app.route('/api/ehr/<string:patient_id>', methods=['GET'])
 def get_ehr_for_patient(patient_id):
     """
@@ -298,21 +714,23 @@ def submit_composition():
     composition = data.get('composition', {})
 
     # Validate required fields
-    if not ehr_id:
-        abort(400, description="Missing 'ehr_id'.")
-    if not validate_template_id(template_id):
-        abort(400, description="Invalid or missing 'template_id'.")
-    if not composition or not isinstance(composition, dict):
-        abort(400, description="Missing or invalid 'composition' data.")
+    with profiling.stage('validate'):
+        if not ehr_id:
+            abort(400, description="Missing 'ehr_id'.")
+        if not validate_template_id(template_id):
+            abort(400, description="Invalid or missing 'template_id'.")
+        if not composition or not isinstance(composition, dict):
+            abort(400, description="Missing or invalid 'composition' data.")
 
     # Sanitize string values in the composition
-    sanitized_composition = {}
-    for key, value in composition.items():
-        sanitized_key = sanitize_string(key, max_length=500)
-        if isinstance(value, str):
-            sanitized_composition[sanitized_key] = sanitize_string(value)
-        else:
-            sanitized_composition[sanitized_key] = value
+    with profiling.stage('sanitize'):
+        sanitized_composition = {}
+        for key, value in composition.items():
+            sanitized_key = sanitize_string(key, max_length=500)
+            if isinstance(value, str):
+                sanitized_composition[sanitized_key] = sanitize_string(value)
+            else:
+                sanitized_composition[sanitized_key] = value
 
     logger.info(
         f"AUDIT: Composition submission - ehr_id={ehr_id}, "
@@ -328,14 +746,19 @@ def submit_composition():
             f"ehr_id={ehr_id}, template_id={template_id}, uid={comp_uid}"
         )
 
-        return jsonify({
-            'status': 'success',
-            'message': 'Composition saved to EHRbase successfully',
-            'composition_uid': comp_uid,
-            'ehr_id': ehr_id,
-            'template_id': template_id,
-            'timestamp': datetime.utcnow().isoformat() + 'Z'
-        }), 201
+        # Write-behind copy into the local JSONB mirror for fast field searches
+        composition_mirror.enqueue(ehr_id, template_id, comp_uid, sanitized_composition)
+        aql_registry.invalidate_ehr(ehr_id)
+
+        with profiling.stage('serialize'):
+            return jsonify({
+                'status': 'success',
+                'message': 'Composition saved to EHRbase successfully',
+                'composition_uid': comp_uid,
+                'ehr_id': ehr_id,
+                'template_id': template_id,
+                'timestamp': datetime.utcnow().isoformat() + 'Z'
+            }), 201
 
     except EHRbaseError as e:
         logger.error(
@@ -348,6 +771,180 @@ def submit_composition():
         )
 
 
+@app.route('/api/composition/<string:composition_uid>', methods=['GET'])
+def get_composition(composition_uid):
+    """
+    API Endpoint: Read one composition from EHRbase.
+
+    Query string: ?ehr_id=... (required), &format=FLAT (default) | STRUCTURED
+
+    Versioned uids ('<uuid>::<system>::<version>') identify an immutable
+    version: they are cached server-side and sent with an ETag and a long-lived
+    private Cache-Control, so reopening a historical record costs nothing
+    upstream (and a revalidation is answered with 304 without any lookup).
+    Cache entries and ETags are per (ehr_id, uid, format).
+    """
+    if not COMPOSITION_UID_PATTERN.match(composition_uid):
+        abort(400, description="Invalid composition uid.")
+    fmt = request.args.get('format', 'FLAT').upper()
+    if fmt not in ('FLAT', 'STRUCTURED'):
+        abort(400, description="'format' must be FLAT or STRUCTURED.")
+    ehr_id = request.args.get('ehr_id')
+    if not ehr_id:
+        abort(400, description="Missing 'ehr_id'.")
+    if not UUID_PATTERN.match(ehr_id):
+        abort(400, description="Invalid 'ehr_id'.")
+
+    versioned = is_versioned_uid(composition_uid)
+    etag = hashlib.sha256(f"{ehr_id}|{composition_uid}|{fmt}".encode('utf-8')).hexdigest()[:32]
+    if versioned and etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        try:
+            response = jsonify(ehrbase.get_composition(ehr_id, composition_uid, fmt))
+        except EHRbaseError as e:
+            if e.status_code == 404:
+                abort(404, description=f"Composition '{composition_uid}' not found.")
+            logger.error(f"Error reading composition {composition_uid}: {e}")
+            abort(502, description="Could not read composition from EHRbase.")
+
+    if versioned:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        # Unversioned uid means "latest version", which can change
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# ── Catalog Search ──
+
+SEARCH_MAX_LIMIT = 100
+
+
+def refresh_search_templates():
+    """Re-sync template documents into the search index when they are older than the sync TTL."""
+    if not search_index.templates_stale():
+        return
+    try:
+        search_index.sync_templates(with_display_names(ehrbase.list_templates()))
+    except EHRbaseError as e:
+        # Keep searching what is already indexed; retry after the next TTL
+        stale = ehrbase.get_stale('list_templates')
+        if stale is not None:
+            search_index.sync_templates(with_display_names(stale))
+        else:
+            search_index.touch_templates()
+        logger.warning(f"Search: could not refresh templates from EHRbase: {e}")
+
+
+@app.route('/api/search', methods=['GET'])
+def search_catalog():
+    """
+    API Endpoint: Ranked full-text search over archetypes and templates
+    (ids, names, descriptions, ontology terms), with prefix and one-typo
+    matching. See search_index.py.
+
+    Query params:
+        q        search text (empty lists everything by name)
+        kind     'archetype' or 'template' (default: both)
+        limit    page size (default 20, max 100)
+        offset   results to skip (default 0)
+
+    Response:
+    { "query": "...", "total": 42, "offset": 0, "limit": 20, "took_ms": 0.8,
+      "results": [{"kind": "template", "id": "...", "name": "...", "score": 8.0, ...}] }
+    """
+    query = sanitize_string(request.args.get('q', ''), max_length=200) or ''
+    kind = request.args.get('kind') or None
+    if kind is not None and kind not in search_index.KINDS:
+        abort(400, description=f"kind must be one of {', '.join(search_index.KINDS)}.")
+    limit = max(1, min(request.args.get('limit', 20, type=int), SEARCH_MAX_LIMIT))
+    offset = max(0, request.args.get('offset', 0, type=int))
+
+    from archetype_catalog import ensure_searchable
+    if kind in (None, 'archetype'):
+        ensure_searchable()
+    if kind in (None, 'template'):
+        refresh_search_templates()
+
+    started = time.perf_counter()
+    found = search_index.search(query, kind=kind, limit=limit, offset=offset)
+    return jsonify(
+        query=query,
+        total=found['total'],
+        offset=offset,
+        limit=limit,
+        took_ms=round((time.perf_counter() - started) * 1000, 3),
+        results=found['results'],
+    )
+
+
+# ── Local Composition Search ──
+
+@app.route('/api/search/compositions', methods=['POST'])
+def search_compositions():
+    """
+    API Endpoint: Field-value search over the local JSONB mirror of submitted
+    compositions (ehr_documents). Does not touch EHRbase.
+
+    Request body:
+    {
+        "fields": { "<flat path>": <value>, ... },   # all must match (JSONB containment)
+        "template_id": "Vitals.v0",                  # optional
+        "ehr_id": "uuid-...",                        # optional
+        "patients_only": false,                      # optional: one row per patient
+        "limit": 50, "offset": 0
+    }
+
+    NOTE: The mirror is write-behind and only contains compositions submitted
+    through this backend; EHRbase/AQL remains authoritative.
+    """
+    if not request.json:
+        abort(400, description="Missing JSON body.")
+
+    data = request.json
+    fields = data.get('fields')
+    template_id = data.get('template_id')
+    if not fields or not isinstance(fields, dict):
+        abort(400, description="'fields' must be a non-empty object of flat path -> value.")
+    if any(isinstance(v, (dict, list)) for v in fields.values()):
+        abort(400, description="'fields' values must be scalars.")
+    if template_id is not None and not validate_template_id(template_id):
+        abort(400, description="Invalid 'template_id'.")
+    ehr_id = data.get('ehr_id')
+    if ehr_id is not None and (not isinstance(ehr_id, str) or not UUID_PATTERN.match(ehr_id)):
+        abort(400, description="Invalid 'ehr_id'.")
+
+    limit = data.get('limit', 50)
+    offset = data.get('offset', 0)
+    if not isinstance(limit, int) or not 1 <= limit <= 500:
+        abort(400, description="'limit' must be an integer between 1 and 500.")
+    if not isinstance(offset, int) or offset < 0:
+        abort(400, description="'offset' must be a non-negative integer.")
+
+    rows = db.search_composition_documents(
+        {sanitize_string(k, max_length=500): v for k, v in fields.items()},
+        template_id=template_id,
+        ehr_id=ehr_id,
+        patients_only=bool(data.get('patients_only')),
+        limit=limit,
+        offset=offset,
+    )
+    if rows is None:
+        abort(503, description="Local composition search is unavailable.")
+
+    for row in rows:
+        for key, value in row.items():
+            if isinstance(value, datetime):
+                row[key] = value.isoformat()
+            elif value is not None and not isinstance(value, (str, int, float, bool)):
+                row[key] = str(value)
+
+    logger.info(f"AUDIT: Local composition search - fields={len(fields)}, results={len(rows)}")
+    return jsonify({'results': rows, 'limit': limit, 'offset': offset})
+
+
 # ── AQL Query ──
 
 @app.route('/api/query', methods=['POST'])
@@ -363,18 +960,13 @@ def run_aql_query():
 
     aql = request.json.get('aql', '')
 
-    # SAFETY: Basic AQL injection prevention
-    # AQL should not contain dangerous keywords for data modification
-    dangerous_patterns = ['DELETE', 'UPDATE', 'DROP', 'INSERT', 'ALTER', 'TRUNCATE']
-    aql_upper = aql.upper()
-    for pattern in dangerous_patterns:
-        if pattern in aql_upper:
-            logger.warning(f"AUDIT: Blocked potentially dangerous AQL query containing '{pattern}'")
-            abort(400, description=f"AQL queries containing '{pattern}' are not allowed.")
+    with profiling.stage('validate'):
+        validate_read_only_aql(aql)
 
     try:
         result = ehrbase.query_aql(aql, request.json.get('query_parameters'))
-        return jsonify(result)
+        with profiling.stage('serialize'):
+            return jsonify(result)
     except EHRbaseError as e:
         if e.status_code == 400:
             abort(400, description=f"Invalid AQL query: {e}")
@@ -382,19 +974,255 @@ def run_aql_query():
         abort(502, description="Failed to execute query against EHRbase.")
 
 
-# ─── Run the App ──────────────────────────────────────────────────────
+@app.route('/api/query/named', methods=['GET'])
+def list_named_queries():
+    """
+    API Endpoint: List the registered named AQL queries and their parameters.
+    """
+    return jsonify({'queries': [q.describe() for q in aql_registry.QUERIES.values()]})
 
-if __name__ == '__main__':
-    from db import initialize_database
-    
-    port = int(os.getenv('FLASK_PORT', 9000))
-    debug = os.getenv('FLASK_DEBUG', 'true').lower() == 'true'
 
-    logger.info(f"Starting openEHR backend on http://127.0.0.1:{port}")
+@app.route('/api/query/named/<string:name>', methods=['POST'])
+def run_named_query(name):
+    """
+    API Endpoint: Execute a registered AQL query by name.
+
+    The AQL text lives on the server and was validated at startup, so only the
+    parameters are sent and no per-request keyword scan is needed.
+
+    Request body: { "query_parameters": { "ehr_id": "..." } }
+    Response: { "columns": [...], "rows": [...] }  (X-Cache: HIT | MISS)
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        result, cached = aql_registry.run(ehrbase, name, body.get('query_parameters'))
+    except aql_registry.NamedQueryError as e:
+        abort(404 if name not in aql_registry.QUERIES else 400, description=str(e))
+    except EHRbaseError as e:
+        if e.status_code == 400:
+            abort(400, description=f"Invalid AQL query: {e}")
+        logger.error(f"Named AQL query '{name}' error: {e}")
+        abort(502, description="Failed to execute query against EHRbase.")
+
+    with profiling.stage('serialize'):
+        response = jsonify(result)
+    response.headers['X-Cache'] = 'HIT' if cached else 'MISS'
+    return response
+
+
+@app.route('/api/query/batch', methods=['POST'])
+def run_aql_batch():
+    """
+    API Endpoint: Run several AQL or named queries concurrently.
+
+    Queries run in parallel on a bounded pool, so the response time is that of
+    the slowest query rather than the sum. Each query succeeds or fails on its
+    own; a failed or timed-out query is reported under "errors".
+
+    Request body:
+        {
+          "queries": {
+            "history": { "named": "patient_history", "query_parameters": {"ehr_id": "..."} },
+            "bp":      { "aql": "SELECT ...", "query_parameters": {...} }
+          },
+          "timeout": 10
+        }
+    Response: { "results": { name: {columns, rows} }, "errors": { name: {status, error} } }
+    """
+    body = request.get_json(silent=True) or {}
+    queries = body.get('queries')
+    if not isinstance(queries, dict) or not queries:
+        abort(400, description="'queries' must be a non-empty object of name -> query.")
+    if len(queries) > AQL_BATCH_MAX_QUERIES:
+        abort(400, description=f"At most {AQL_BATCH_MAX_QUERIES} queries per batch.")
+
+    timeout = body.get('timeout', 10)
+    if not isinstance(timeout, (int, float)) or not 0 < timeout <= 60:
+        abort(400, description="'timeout' must be a number of seconds between 0 and 60.")
+
+    errors = {}
+    futures = {}
+    for name, spec in queries.items():
+        if not isinstance(spec, dict) or ('aql' in spec) == ('named' in spec):
+            errors[name] = {'status': 400, 'error': "Each query needs exactly one of 'aql' or 'named'."}
+            continue
+        params = spec.get('query_parameters')
+        if 'named' in spec:
+            futures[name] = aql_batch_pool.submit(aql_registry.run, ehrbase, spec['named'], params)
+            continue
+        try:
+            validate_read_only_aql(spec['aql'])
+        except HTTPException as e:
+            errors[name] = {'status': e.code, 'error': e.description}
+            continue
+        futures[name] = aql_batch_pool.submit(lambda aql, p: (ehrbase.query_aql(aql, p), False), spec['aql'], params)
+
+    done, _ = wait(futures.values(), timeout=timeout)
+
+    results = {}
+    for name, future in futures.items():
+        if future not in done:
+            # Already running on the pool; it finishes in the background but is not waited for
+            future.cancel()
+            errors[name] = {'status': 504, 'error': f"Query did not finish within {timeout}s."}
+            continue
+        try:
+            results[name] = future.result()[0]
+        except aql_registry.NamedQueryError as e:
+            errors[name] = {'status': 400, 'error': str(e)}
+        except EHRbaseError as e:
+            errors[name] = {'status': e.status_code or 502, 'error': str(e)}
+        except Exception as e:
+            logger.error(f"Batch query '{name}' failed: {e}")
+            errors[name] = {'status': 500, 'error': 'Query failed.'}
+
+    logger.info(f"AQL batch: {len(results)} ok, {len(errors)} failed")
+    with profiling.stage('serialize'):
+        return jsonify({'results': results, 'errors': errors})
+
+
+def open_aql_pages():
+    """
+    Validate a paged AQL request body and fetch its first page from EHRbase.
+
+    Request body: { "aql": "...", "query_parameters": {...}, "page_size": 1000 }
+    The first page is fetched before the response starts so upstream errors
+    still map to HTTP status codes.
+
+    Returns:
+        tuple: (aql, page_size, first_page, iterator over the remaining pages)
+    """
+    if not request.json or 'aql' not in request.json:
+        abort(400, description="Missing 'aql' query in request body.")
+
+    aql = request.json.get('aql', '')
+    validate_read_only_aql(aql)
+    if re.search(r'\b(LIMIT|OFFSET)\b', aql, re.IGNORECASE):
+        abort(400, description="Paged queries are paged by the server; remove LIMIT/OFFSET.")
+
+    page_size = request.json.get('page_size', 1000)
+    if not isinstance(page_size, int) or not 1 <= page_size <= 10000:
+        abort(400, description="'page_size' must be an integer between 1 and 10000.")
+
+    pages = ehrbase.iter_aql_pages(aql, request.json.get('query_parameters'), page_size=page_size)
+    try:
+        first_page = next(pages)
+    except EHRbaseError as e:
+        if e.status_code == 400:
+            abort(400, description=f"Invalid AQL query: {e}")
+        logger.error(f"AQL paging error: {e}")
+        abort(502, description="Failed to execute query against EHRbase.")
+    return aql, page_size, first_page, pages
+
+
+@app.route('/api/query/stream', methods=['POST'])
+def stream_aql_query():
+    """
+    API Endpoint: Execute an AQL query and stream the rows as NDJSON.
+
+    EHRbase is paged with offset/fetch under the hood, so memory stays bounded
+    by one page regardless of the result size. If the client disconnects, the
+    generator is closed and no further pages are fetched.
+
+    Request body: { "aql": "SELECT ... ORDER BY ...", "query_parameters": {...}, "page_size": 1000 }
+    Response (application/x-ndjson), one JSON document per line:
+        {"columns": [...]}                      first line
+        [row values...]                         one line per row
+        {"row_count": N, "complete": true}      last line (or {"error": ..., "row_count": N})
+
+    NOTE: Include ORDER BY for a stable order across pages; LIMIT/OFFSET are not allowed.
+    """
+    aql, page_size, first_page, pages = open_aql_pages()
+    logger.info(f"AUDIT: Streaming AQL query (page_size={page_size}): {aql[:100]}...")
+
+    def generate():
+        row_count = 0
+        complete = False
+        try:
+            yield json_provider.dumps({'columns': first_page.get('columns', [])}) + b'\n'
+            page = first_page
+            while True:
+                rows = page.get('rows') or []
+                if rows:
+                    yield b'\n'.join(json_provider.dumps(row) for row in rows) + b'\n'
+                    row_count += len(rows)
+                page = next(pages, None)
+                if page is None:
+                    break
+            complete = True
+            yield json_provider.dumps({'row_count': row_count, 'complete': True}) + b'\n'
+        except EHRbaseError as e:
+            logger.error(f"AQL stream aborted after {row_count} rows: {e}")
+            yield json_provider.dumps({'error': str(e), 'row_count': row_count, 'complete': False}) + b'\n'
+        finally:
+            pages.close()
+            if not complete:
+                logger.warning(f"AQL stream ended early after {row_count} rows")
+            else:
+                logger.info(f"AQL stream completed: {row_count} rows")
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/api/query/export', methods=['POST'])
+def export_aql_query():
+    """
+    API Endpoint: Export AQL results as a CSV or Parquet download.
+
+    Query string: ?format=csv (default) | parquet
+    Request body: same as /api/query/stream, plus optional "batch_size".
+    Rows are paged from EHRbase and encoded in fixed-size batches (Parquet:
+    one row group per batch), so the extract is produced in one streaming pass.
+    """
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in aql_export.FORMATS:
+        abort(400, description=f"Unsupported export format '{fmt}'. Use one of: {', '.join(aql_export.FORMATS)}")
+    if fmt == 'parquet' and not aql_export.parquet_available():
+        abort(501, description="Parquet export is not available on this server (pyarrow is not installed).")
+
+    batch_size = (request.json or {}).get('batch_size', aql_export.DEFAULT_BATCH_SIZE)
+    if not isinstance(batch_size, int) or not 1 <= batch_size <= 100000:
+        abort(400, description="'batch_size' must be an integer between 1 and 100000.")
+
+    aql, page_size, first_page, pages = open_aql_pages()
+    logger.info(f"AUDIT: Exporting AQL query as {fmt} (page_size={page_size}): {aql[:100]}...")
+
+    def generate():
+        try:
+            yield from aql_export.export_chunks(first_page, pages, fmt, batch_size)
+        except EHRbaseError as e:
+            # Headers are already sent; the truncated file is the only signal left
+            logger.error(f"AQL export aborted: {e}")
+        finally:
+            pages.close()
+
+    filename = f"aql_export_{datetime.now().strftime('%Y%m%dT%H%M%S')}.{fmt}"
+    return Response(
+        generate(),
+        mimetype=aql_export.MIMETYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+
+# ─── Lifecycle ────────────────────────────────────────────────────────
+# Importing this module opens no connections. Services (DB pool, EHRbase
+# client, batch pool) are created on first use; these hooks are for servers:
+#   startup()            once per process start: DB schema, EHRbase check
+#   warm_up()            fill the template and catalog caches (in the
+#                        pre-fork master, see wsgi.py, so workers share them)
+#   services.shutdown()  close every created service (also run at exit)
+#   services.reset_after_fork()  drop or repair inherited services in a forked child
+#                        (run automatically through os.register_at_fork)
+
+WARM_UP_MAX_TEMPLATES = int(os.getenv('WARM_UP_MAX_TEMPLATES', '200'))
+
+
+def startup():
+    """Create the PostgreSQL mapping table and verify EHRbase connectivity."""
     logger.info(f"EHRbase URL: {ehrbase.base_url}")
 
     # Initialize PostgreSQL mapping table
-    db_initialized = initialize_database()
+    db_initialized = db.initialize_database()
     if not db_initialized:
         logger.warning("Could not initialize PostgreSQL database. Ensure the container is running or .env is correct.")
 
@@ -404,5 +1232,63 @@ if __name__ == '__main__':
         logger.info(f"EHRbase is healthy. {health.get('template_count', 0)} templates available.")
     else:
         logger.warning(f"EHRbase connectivity issue: {health.get('error', 'unknown')}")
+    return db_initialized
+
+
+def warm_up():
+    """
+    Build what the first requests would otherwise build: the archetype catalog
+    (from the snapshot if there is one), the dependency graph, the template
+    list and its search entries, and for up to WARM_UP_MAX_TEMPLATES templates
+    the serialized web template (default profile) and its path index.
+    EHRbase being unavailable is logged, not fatal.
+    """
+    from archetype_catalog import ensure_built
+
+    started = time.perf_counter()
+    ensure_built()
+    dependency_graph.ensure_loaded()
+    try:
+        templates = with_display_names(ehrbase.list_templates())
+    except EHRbaseError as e:
+        logger.warning(f"Warm-up skipped the templates, EHRbase is unavailable: {e}")
+        return 0
+    search_index.sync_templates(templates)
+
+    warmed = 0
+    for template in templates[:WARM_UP_MAX_TEMPLATES]:
+        template_id = template.get('template_id')
+        if not template_id:
+            continue
+        try:
+            web_template = ehrbase.get_web_template(template_id)
+        except EHRbaseError as e:
+            logger.warning(f"Warm-up could not fetch web template '{template_id}': {e}")
+            continue
+        web_template_profiles.get_projected(template_id, web_template_profiles.DEFAULT_PROFILE, None,
+                                            lambda _: web_template)
+        index = web_template_index.get_index(template_id, lambda _: web_template)
+        dependency_graph.record_flat_paths(template_id, index)
+        warmed += 1
+    logger.info(f"Warm-up done in {(time.perf_counter() - started) * 1000:.0f}ms: "
+                f"{warmed} of {len(templates)} templates")
+    return warmed
+
+
+# ─── Run the App ──────────────────────────────────────────────────────
+
+if __name__ == '__main__':
+    # Development server only; production runs under gunicorn (see wsgi.py)
+    port = int(os.getenv('FLASK_PORT', 9000))
+    debug = os.getenv('FLASK_DEBUG', 'false').lower() == 'true'
+
+    logger.info(f"Starting openEHR backend on http://127.0.0.1:{port}")
+    startup()
+
+    # Live archetype/OPT updates (in the reloader child only, when debugging)
+    if os.getenv('ARCHETYPE_WATCH', 'false').lower() == 'true' and (
+            not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        import catalog_watcher
+        catalog_watcher.start(upload=ehrbase.upload_template)
 
-    app.run(debug=debug, port=port)
\ No newline at end of file
+    app.run(debug=debug, port=port)
@@ -0,0 +1,24 @@
+"""
+Performance Benchmarks
+
+Benchmarks that run without live services:
+
+- fake_ehrbase:  an in-process EHRbase stand-in serving web templates derived
+                 from the OPTs in opt_upload_folder, EHR/composition writes and
+                 synthetic AQL results, with configurable latency.
+- bench_routes:  drives every backend.py route against the fake at a
+                 controlled concurrency and reports throughput and p50/p99.
+- bench_parser:  micro-benchmarks for OPT parsing, web template derivation,
+                 serialization and flat-JSON cleaning.
+
+results/ holds routes_baseline.json and parser_baseline.json, recorded with
+the default options on a reference machine (1 CPU, no PostgreSQL, no
+archetype catalog). --baseline flags cases whose p50 is more than 25% slower
+than the baseline; on other hardware, record a local baseline first with
+--out benchmarks/results/<name>_baseline.json. Other result files are not
+tracked.
+
+Run from the backend directory, e.g.:
+    python -m benchmarks.bench_routes --concurrency 16 --requests 400
+    python -m benchmarks.bench_parser --baseline benchmarks/results/parser_baseline.json
+"""
@@ -0,0 +1,110 @@
+"""
+Parser Micro-benchmarks
+
+Times the CPU-bound template work for every OPT in opt_upload_folder:
+
+    parse_xml            XML parse of the OPT
+    derive_web_template  OPT -> web template tree (as served by the fake EHRbase)
+    serialize_json       json.dumps of the web template
+    clean_flat_json      EHRbaseClient._clean_flat_json over a synthetic flat
+                         composition covering every leaf of the template
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_parser --repeat 20
+    python -m benchmarks.bench_parser --baseline benchmarks/results/parser_baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import xml.etree.ElementTree as ET
+
+from benchmarks.common import OPT_DIR, summarize, write_results, compare_to_baseline, print_table
+from benchmarks.fake_ehrbase import opt_to_web_template
+
+
+def synthetic_flat_composition(tree):
+    """
+    Build a FLAT composition with a value for every input of every leaf, plus
+    the empty and orphaned entries real forms produce, from a web template tree.
+    """
+    flat = {}
+
+    def walk(node, prefix):
+        repeats = node.get('max') == -1 or (node.get('max') or 1) > 1
+        path = f"{prefix}/{node['id']}{':0' if repeats else ''}" if prefix else node['id']
+        for item in node.get('inputs', []):
+            suffix = item.get('suffix')
+            key = f"{path}|{suffix}" if suffix else path
+            options = item.get('list') or []
+            flat[key] = options[0]['value'] if options else '1'
+            if suffix == 'code':
+                flat[f"{path}|value"] = options[0].get('label', '') if options else ''
+                flat[f"{path}|terminology"] = 'local'
+        if node.get('inputs') and not node.get('children'):
+            flat[f"{path}/_null_flavour|code"] = ''
+        for child in node.get('children', []):
+            walk(child, path)
+
+    walk(tree, '')
+    return flat
+
+
+def _time(func, repeat):
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10, help='iterations per case')
+    parser.add_argument('--opt-dir', default=OPT_DIR)
+    parser.add_argument('--out', help='results JSON path (default: benchmarks/results/)')
+    parser.add_argument('--baseline', help='baseline results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='allowed p50 slowdown vs baseline')
+    args = parser.parse_args(argv)
+
+    from ehrbase_client import EHRbaseClient
+
+    results = {}
+    for name in sorted(f for f in os.listdir(args.opt_dir) if f.endswith('.opt')):
+        path = os.path.join(args.opt_dir, name)
+        _, body = opt_to_web_template(path)
+        flat = synthetic_flat_composition(body['webTemplate']['tree'])
+        size_kb = round(os.path.getsize(path) / 1024, 1)
+
+        cases = {
+            'parse_xml': lambda: ET.parse(path),
+            'derive_web_template': lambda: opt_to_web_template(path),
+            'serialize_json': lambda: json.dumps(body),
+            'clean_flat_json': lambda: EHRbaseClient._clean_flat_json(flat),
+        }
+        for case, func in cases.items():
+            stats = _time(func, args.repeat)
+            stats.update({'opt_kb': size_kb, 'flat_fields': len(flat)})
+            results[f"{case}[{name}]"] = stats
+
+    print_table(results)
+    out = write_results('parser', results, args.out)
+    print(f"\nResults written to {out}")
+
+    if args.baseline:
+        regressions = compare_to_baseline(results, args.baseline, threshold=args.threshold)
+        if regressions:
+            print("\nREGRESSIONS:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\nNo regressions against baseline.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
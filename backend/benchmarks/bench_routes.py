@@ -0,0 +1,239 @@
+"""
+Route Benchmark
+
+Serves backend.py with a threaded WSGI server, points it at an in-process
+FakeEHRbase, and drives each API route at a fixed concurrency. Reports
+throughput and p50/p99 latency per route and writes the results as JSON.
+
+PostgreSQL is used if reachable with the usual LOCAL_DB_* settings; otherwise
+the DB-backed steps run in their degraded (no mapping) mode, which is still
+representative of the HTTP/EHRbase path. Routes that need the database
+(bulk EHR creation, EHR lookup, composition search) answer 503 without it,
+and those samples count as errors.
+
+The archetype routes use the catalog under ARCHETYPE_ROOT_DIR; with no
+archetypes there, the form and slot cases are skipped. The profile routes
+are served to requests signed with a benchmark-only PROFILE_SECRET; a signed
+request is itself profiled, so those cases include the profiler's overhead.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_routes --concurrency 16 --requests 400 --latency 0.02
+    python -m benchmarks.bench_routes --baseline benchmarks/results/routes_baseline.json
+"""
+
+import os
+import sys
+import time
+import uuid
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import summarize, write_results, compare_to_baseline, print_table
+from benchmarks.fake_ehrbase import FakeEHRbase
+
+
+def _build_cases(base, template_ids, ehr_id, composition_uid, archetype_ids, form_ids, profile_id):
+    """route rule -> (label, request function(session, i), ok statuses)."""
+    import profiling
+
+    def signed():
+        return {profiling.HEADER: profiling.sign()}
+
+    def web_template(session, i):
+        return session.get(f"{base}/api/web-template/{template_ids[i % len(template_ids)]}")
+
+    def create_ehr(session, i):
+        return session.post(f"{base}/api/ehr", json={'patient_id': f"BENCH-{uuid.uuid4().hex[:12]}"})
+
+    def submit(session, i):
+        return session.post(f"{base}/api/composition", json={
+            'ehr_id': ehr_id,
+            'template_id': template_ids[i % len(template_ids)],
+            'composition': {
+                'vitals/vital_signs/blood_pressure/any_event:0/systolic|magnitude': 120 + i % 40,
+                'vitals/vital_signs/blood_pressure/any_event:0/systolic|unit': 'mm[Hg]',
+                'vitals/vital_signs/blood_pressure/any_event:0/comment': f"benchmark {i}",
+                'vitals/vital_signs/blood_pressure/any_event:0/position|code': '',
+            },
+        })
+
+    def query(session, i):
+        return session.post(f"{base}/api/query", json={
+            'aql': "SELECT c/uid/value FROM EHR e CONTAINS COMPOSITION c",
+        })
+
+    cases = {
+        '/api/health': ('health', lambda s, i: s.get(f"{base}/api/health"), {200}),
+        '/api/templates': ('templates', lambda s, i: s.get(f"{base}/api/templates"), {200}),
+        '/api/web-template/<path:template_id>': ('web_template', web_template, {200}),
+        '/api/web-template/<path:template_id>/outline': ('web_template_outline', lambda s, i: s.get(
+            f"{base}/api/web-template/{template_ids[i % len(template_ids)]}/outline"), {200}),
+        '/api/web-template/<path:template_id>/node': ('web_template_node', lambda s, i: s.get(
+            f"{base}/api/web-template/{template_ids[i % len(template_ids)]}/node", params={'path': ''}), {200}),
+        '/api/search': ('search', lambda s, i: s.get(
+            f"{base}/api/search", params={'q': ('vital', 'blod pres', 'diagnosis')[i % 3]}), {200}),
+        '/api/ehr': ('create_ehr', create_ehr, {201}),
+        '/api/ehr/bulk': ('bulk_ehr', lambda s, i: s.post(f"{base}/api/ehr/bulk", json={
+            'patient_ids': [f"BENCH-BULK-{uuid.uuid4().hex[:12]}" for _ in range(20)]}), {200}),
+        '/api/ehr/lookup': ('lookup_ehrs', lambda s, i: s.post(f"{base}/api/ehr/lookup", json={
+            'patient_ids': [f"BENCH-LOOKUP-{n}" for n in range(60)]}), {200}),
+        '/api/ehr/<string:patient_id>': (
+            'get_ehr', lambda s, i: s.get(f"{base}/api/ehr/BENCH-LOOKUP-{i % 50}"), {200, 404}),
+        '/api/composition': ('submit_composition', submit, {201}),
+        '/api/composition/<string:composition_uid>': ('get_composition', lambda s, i: s.get(
+            f"{base}/api/composition/{composition_uid}", params={'ehr_id': ehr_id}), {200}),
+        '/api/query': ('query', query, {200}),
+        '/api/query/stream': ('query_stream', lambda s, i: s.post(f"{base}/api/query/stream", json={
+            'aql': "SELECT c/uid/value FROM EHR e CONTAINS COMPOSITION c ORDER BY c/uid/value",
+            'page_size': 100,
+        }), {200}),
+        '/api/query/export': ('query_export', lambda s, i: s.post(f"{base}/api/query/export?format=csv", json={
+            'aql': "SELECT c/uid/value FROM EHR e CONTAINS COMPOSITION c ORDER BY c/uid/value",
+            'page_size': 100,
+        }), {200}),
+        '/api/query/named': ('named_queries', lambda s, i: s.get(f"{base}/api/query/named"), {200}),
+        '/api/query/named/<string:name>': ('named_query', lambda s, i: s.post(
+            f"{base}/api/query/named/patient_history",
+            json={'query_parameters': {'ehr_id': ehr_id}}), {200}),
+        '/api/query/batch': ('query_batch', lambda s, i: s.post(f"{base}/api/query/batch", json={'queries': {
+            f"q{n}": {'aql': "SELECT c/uid/value FROM EHR e CONTAINS COMPOSITION c"} for n in range(5)
+        }}), {200}),
+        '/api/search/compositions': ('search_compositions', lambda s, i: s.post(
+            f"{base}/api/search/compositions",
+            json={'fields': {'ctx/composer_name': 'Clinical System'}, 'limit': 20}), {200}),
+        '/api/templates/<path:template_id>/dependencies': ('template_dependencies', lambda s, i: s.get(
+            f"{base}/api/templates/{template_ids[i % len(template_ids)]}/dependencies"), {200}),
+        '/api/archetypes': ('archetypes', lambda s, i: s.get(f"{base}/api/archetypes"), {200}),
+        '/api/profiles': ('profiles', lambda s, i: s.get(f"{base}/api/profiles", headers=signed()), {200}),
+        '/api/profiles/<string:profile_id>': ('profile', lambda s, i: s.get(
+            f"{base}/api/profiles/{profile_id}", headers=signed()), {200}),
+        '/metrics': ('metrics', lambda s, i: s.get(f"{base}/metrics"), {200}),
+    }
+    if form_ids:
+        cases['/api/archetype/form/<path:archetype_id>'] = ('archetype_form', lambda s, i: s.get(
+            f"{base}/api/archetype/form/{form_ids[i % len(form_ids)]}"), {200})
+    if archetype_ids:
+        cases['/api/archetype/slots/<path:archetype_id>'] = ('archetype_slots', lambda s, i: s.get(
+            f"{base}/api/archetype/slots/{archetype_ids[i % len(archetype_ids)]}"), {200})
+    return cases
+
+
+def _run_case(func, ok_statuses, total, concurrency):
+    import requests
+
+    local = threading.local()
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def one(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = func(session, i)
+            ok = response.status_code in ok_statuses
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    return summarize(latencies, time.perf_counter() - started, errors[0])
+
+
+def main(argv=None):
+    import requests
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--latency', type=float, default=0.01, help='fake EHRbase latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='fake EHRbase latency jitter (s)')
+    parser.add_argument('--aql-rows', type=int, default=500)
+    parser.add_argument('--only', action='append', help='run only these case labels')
+    parser.add_argument('--out', help='results JSON path (default: benchmarks/results/)')
+    parser.add_argument('--baseline', help='baseline results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='allowed p50 slowdown vs baseline')
+    args = parser.parse_args(argv)
+
+    with FakeEHRbase(latency=args.latency, jitter=args.jitter, aql_rows=args.aql_rows) as fake:
+        os.environ['EHRBASE_BASE_URL'] = fake.base_url
+        # Signed-request profiling only, so the /api/profiles cases can authenticate
+        os.environ['PROFILE_SECRET'] = uuid.uuid4().hex
+        os.environ['PROFILE_SAMPLE_RATE'] = '0'
+        os.environ['PROFILE_DIR'] = tempfile.mkdtemp(prefix='bench-profiles-')
+        # Both signed cases write a profile per request; rotation must not delete the one read back
+        os.environ['PROFILE_KEEP'] = str(2 * args.requests + 10)
+        from werkzeug.serving import make_server
+        import backend
+        import profiling
+        import archetype_catalog
+
+        # Per-request INFO audit lines would dominate the measurement
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        if backend.limiter:
+            backend.limiter.enabled = False
+
+        server = make_server('127.0.0.1', 0, backend.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}"
+
+        # One EHR to submit compositions against
+        ehr_id = backend.ehrbase.create_ehr(f"BENCH-{uuid.uuid4().hex[:12]}")['ehr_id']['value']
+        composition_uid = backend.ehrbase.submit_composition(
+            ehr_id, sorted(fake.web_templates)[0], {'ctx/language': 'en'})['compositionUid']
+        # One profile to read back, and the archetypes to request forms and slots for
+        requests.get(f"{base}/api/health", headers={profiling.HEADER: profiling.sign()})
+        profile_id = profiling.list_summaries(1)[0]['id']
+        archetype_catalog.ensure_built()
+        archetype_ids = sorted(archetype_catalog.ARCHETYPE_CACHE)[:50]
+        # Forms only for archetypes the parser turns into a non-empty form (others answer 422)
+        form_ids = [i for i in archetype_ids if archetype_catalog.get_form(i)]
+        if not archetype_ids:
+            print(f"NOTE: no archetypes under {archetype_catalog.ARCHETYPE_ROOT_DIR}; "
+                  f"skipping the archetype form and slot cases")
+        cases = _build_cases(base, sorted(fake.web_templates), ehr_id, composition_uid,
+                             archetype_ids, form_ids, profile_id)
+
+        covered = set(cases)
+        uncovered = sorted(r.rule for r in backend.app.url_map.iter_rules()
+                           if r.rule not in covered and r.endpoint != 'static')
+        if uncovered:
+            print(f"NOTE: routes without a benchmark case: {', '.join(uncovered)}")
+
+        results = {}
+        for rule, (label, func, ok_statuses) in cases.items():
+            if args.only and label not in args.only:
+                continue
+            results[label] = _run_case(func, ok_statuses, args.requests, args.concurrency)
+            results[label].update({'route': rule, 'concurrency': args.concurrency})
+
+        server.shutdown()
+
+    print_table(results)
+    path = write_results('routes', results, args.out)
+    print(f"\nResults written to {path}")
+
+    if args.baseline:
+        regressions = compare_to_baseline(results, args.baseline, threshold=args.threshold)
+        if regressions:
+            print("\nREGRESSIONS:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\nNo regressions against baseline.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
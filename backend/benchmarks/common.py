@@ -0,0 +1,88 @@
+"""
+Shared helpers for the benchmark scripts: latency summaries, JSON result
+files and regression checks against a stored baseline.
+"""
+
+import os
+import json
+import math
+import platform
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+OPT_DIR = os.path.join(BACKEND_DIR, 'opt_upload_folder')
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list (pct in 0-100)."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies, elapsed, errors=0):
+    """Summarize per-call latencies (seconds) measured over `elapsed` wall seconds."""
+    ordered = sorted(latencies)
+    count = len(ordered)
+    return {
+        'count': count,
+        'errors': errors,
+        'throughput_rps': round(count / elapsed, 2) if elapsed > 0 else 0.0,
+        'mean_ms': round(sum(ordered) / count * 1000, 3) if count else 0.0,
+        'p50_ms': round(percentile(ordered, 50) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 99) * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3) if count else 0.0,
+    }
+
+
+def write_results(name, results, out_path=None):
+    """Write a results document (with environment metadata) as JSON; returns the path."""
+    document = {
+        'benchmark': name,
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if out_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        out_path = os.path.join(RESULTS_DIR, f"{name}_{stamp}.json")
+    with open(out_path, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+    return out_path
+
+
+def compare_to_baseline(results, baseline_path, metric='p50_ms', threshold=1.25):
+    """
+    Compare results against a baseline results file.
+
+    Returns:
+        list[str]: One message per case whose `metric` grew by more than
+                   `threshold` x the baseline value.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f).get('results', {})
+    regressions = []
+    for case, stats in results.items():
+        before = baseline.get(case, {}).get(metric)
+        after = stats.get(metric)
+        if not before or after is None:
+            continue
+        if after > before * threshold:
+            regressions.append(f"{case}: {metric} {before} -> {after} ({after / before:.2f}x)")
+    return regressions
+
+
+def print_table(results):
+    """Print a fixed-width summary table of per-case results."""
+    width = max([len(case) for case in results] + [20])
+    print(f"{'case':<{width}} {'count':>7} {'rps':>10} {'p50 ms':>10} {'p99 ms':>10} {'errors':>7}")
+    print('-' * (width + 48))
+    for case, stats in results.items():
+        print(
+            f"{case:<{width}} {stats['count']:>7} {stats['throughput_rps']:>10} "
+            f"{stats['p50_ms']:>10} {stats['p99_ms']:>10} {stats['errors']:>7}"
+        )
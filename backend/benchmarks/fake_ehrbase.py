@@ -0,0 +1,382 @@
+"""
+In-Process EHRbase Stand-in
+
+A threaded HTTP server implementing the subset of the EHRbase REST API that
+ehrbase_client.py uses, backed by the OPTs in opt_upload_folder:
+
+    GET  /rest/openehr/v1/definition/template/adl1.4   template list
+    POST /rest/openehr/v1/definition/template/adl1.4   template upload (accepted)
+    GET  /rest/ecis/v1/template/<id>                   web template derived from the OPT
+    POST /rest/openehr/v1/ehr                          create EHR
+    GET  /rest/openehr/v1/ehr/<ehr_id>                 get EHR
+    POST /rest/ecis/v1/composition                     submit FLAT composition
+    GET  /rest/ecis/v1/composition/<uid>               get composition
+    POST /rest/openehr/v1/query/aql                    synthetic rows (honours offset/fetch)
+
+Every response is delayed by `latency` seconds (plus optional uniform jitter)
+to emulate network and CDR time. The web templates are a simplified but
+structurally faithful rendering of the OPT (ids, rmTypes, occurrences,
+localized names, aqlPaths, inputs), enough to exercise the backend's
+template handling.
+
+Usage:
+    with FakeEHRbase(latency=0.02) as fake:
+        os.environ['EHRBASE_BASE_URL'] = fake.base_url
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import random
+import threading
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+from benchmarks.common import OPT_DIR
+
+OPENEHR_NS = '{http://schemas.openehr.org/v1}'
+
+_INPUTS_BY_TYPE = {
+    'DV_TEXT': [{'type': 'TEXT'}],
+    'DV_COUNT': [{'type': 'INTEGER'}],
+    'DV_BOOLEAN': [{'type': 'BOOLEAN'}],
+    'DV_DATE_TIME': [{'type': 'DATETIME'}],
+    'DV_DATE': [{'type': 'DATE'}],
+    'DV_TIME': [{'type': 'TIME'}],
+    'DV_DURATION': [{'type': 'TEXT'}],
+    'DV_PROPORTION': [{'suffix': 'numerator', 'type': 'DECIMAL'}, {'suffix': 'denominator', 'type': 'DECIMAL'}],
+    'DV_IDENTIFIER': [{'suffix': 'id', 'type': 'TEXT'}],
+    'DV_URI': [{'type': 'TEXT'}],
+}
+
+
+def _tag(name):
+    return OPENEHR_NS + name
+
+
+def _text(elem, name, default=None):
+    child = elem.find(_tag(name))
+    return child.text.strip() if child is not None and child.text else default
+
+
+def _snake(label):
+    slug = re.sub(r'[^0-9a-zA-Z]+', '_', label or '').strip('_').lower()
+    return slug or 'node'
+
+
+# ─── OPT → Web Template ───────────────────────────────────────────────
+
+def _term_map(archetype_root):
+    """at-code -> (text, description) for one C_ARCHETYPE_ROOT."""
+    terms = {}
+    for definition in archetype_root.findall(_tag('term_definitions')):
+        code = definition.get('code')
+        text = description = None
+        for item in definition.findall(_tag('items')):
+            if item.get('id') == 'text':
+                text = (item.text or '').strip()
+            elif item.get('id') == 'description':
+                description = (item.text or '').strip()
+        if code:
+            terms[code] = (text or code, description or '')
+    return terms
+
+
+def _occurrences(elem):
+    occ = elem.find(_tag('occurrences'))
+    if occ is None:
+        return 0, 1
+    lower = int(_text(occ, 'lower', '0'))
+    if _text(occ, 'upper_unbounded') == 'true':
+        return lower, -1
+    return lower, int(_text(occ, 'upper', '1'))
+
+
+def _value_inputs(value_elem, terms, languages):
+    rm_type = _text(value_elem, 'rm_type_name', '')
+    if rm_type == 'DV_QUANTITY':
+        units = [u.text for u in value_elem.iter(_tag('units')) if u.text]
+        return [
+            {'suffix': 'magnitude', 'type': 'DECIMAL'},
+            {'suffix': 'unit', 'type': 'CODED_TEXT', 'list': [{'value': u, 'label': u} for u in units]},
+        ]
+    if rm_type == 'DV_CODED_TEXT':
+        options = []
+        for code_list in value_elem.iter(_tag('code_list')):
+            code = (code_list.text or '').strip()
+            if not code:
+                continue
+            label, description = terms.get(code, (code, ''))
+            options.append({
+                'value': code,
+                'label': label,
+                'localizedLabels': {lang: label for lang in languages},
+                'localizedDescriptions': {lang: description for lang in languages},
+            })
+        return [{'suffix': 'code', 'type': 'CODED_TEXT', 'list': options}]
+    return [dict(i) for i in _INPUTS_BY_TYPE.get(rm_type, [{'type': 'TEXT'}])]
+
+
+def _build_node(elem, attribute, parent_path, terms, languages, annotate):
+    rm_type = _text(elem, 'rm_type_name', '')
+    node_id = _text(elem, 'node_id', '')
+    archetype_id = elem.find(_tag('archetype_id'))
+    if archetype_id is not None:
+        # C_ARCHETYPE_ROOT (or the template definition): switch to its own term definitions
+        terms = _term_map(elem)
+        archetype_id = _text(archetype_id, 'value', node_id)
+        path_predicate = archetype_id
+        node_id = archetype_id
+    else:
+        path_predicate = node_id
+
+    label, description = terms.get(_text(elem, 'node_id', ''), (rm_type.replace('_', ' ').lower(), ''))
+    minimum, maximum = _occurrences(elem)
+    if not attribute:
+        aql_path = ''  # template root
+    elif path_predicate:
+        aql_path = f"{parent_path}/{attribute}[{path_predicate}]"
+    else:
+        aql_path = f"{parent_path}/{attribute}"
+
+    node = {
+        'id': _snake(label),
+        'name': label,
+        'localizedName': label,
+        'rmType': rm_type,
+        'nodeId': node_id,
+        'min': minimum,
+        'max': maximum,
+        'localizedNames': {lang: label for lang in languages},
+        'localizedDescriptions': {lang: description for lang in languages},
+        'aqlPath': aql_path,
+    }
+    if annotate and description:
+        node['annotations'] = {'comment': description}
+
+    if rm_type == 'ELEMENT':
+        value_attr = next((a for a in elem.findall(_tag('attributes'))
+                           if _text(a, 'rm_attribute_name') == 'value'), None)
+        values = value_attr.findall(_tag('children')) if value_attr is not None else []
+        if len(values) == 1:
+            # Single data type: collapse onto the ELEMENT, as EHRbase does
+            node['rmType'] = _text(values[0], 'rm_type_name', 'DV_TEXT')
+            node['inputs'] = _value_inputs(values[0], terms, languages)
+        elif values:
+            node['children'] = [{
+                'id': _snake(_text(v, 'rm_type_name', 'value')),
+                'name': _text(v, 'rm_type_name', 'value'),
+                'rmType': _text(v, 'rm_type_name', 'DV_TEXT'),
+                'min': 0, 'max': 1,
+                'aqlPath': f"{aql_path}/value",
+                'inputs': _value_inputs(v, terms, languages),
+            } for v in values]
+        return node
+
+    children, seen = [], {}
+    for attr in elem.findall(_tag('attributes')):
+        attr_name = _text(attr, 'rm_attribute_name', '')
+        for child in attr.findall(_tag('children')):
+            child_rm = _text(child, 'rm_type_name', '')
+            # Skip leaf constraints on structural attributes (e.g. CODE_PHRASE on category)
+            if not child_rm or child_rm.startswith('DV_') or child_rm == 'CODE_PHRASE':
+                continue
+            child_node = _build_node(child, attr_name, aql_path, terms, languages, annotate)
+            count = seen.get(child_node['id'], 0)
+            seen[child_node['id']] = count + 1
+            if count:
+                child_node['id'] = f"{child_node['id']}{count + 1}"
+            children.append(child_node)
+    if children:
+        node['children'] = children
+    return node
+
+
+def opt_to_web_template(opt_path, languages=('en',), annotate=True):
+    """
+    Derive a simplified EHRbase-style web template from an OPT file.
+
+    Returns:
+        (template_id, dict): The template id and the ECIS response body
+                             ({'webTemplate': {..., 'tree': {...}}}).
+    """
+    root = ET.parse(opt_path).getroot()
+    template_id = _text(root.find(_tag('template_id')), 'value')
+    definition = root.find(_tag('definition'))
+    tree = _build_node(definition, '', '', {}, list(languages), annotate)
+    tree['id'] = _snake(template_id)
+    return template_id, {
+        'webTemplate': {
+            'templateId': template_id,
+            'version': '2.3',
+            'defaultLanguage': languages[0],
+            'languages': list(languages),
+            'tree': tree,
+        }
+    }
+
+
+def load_web_templates(opt_dir=OPT_DIR, languages=('en',)):
+    """Derive web templates for every .opt in opt_dir. Returns {template_id: body}."""
+    templates = {}
+    for name in sorted(os.listdir(opt_dir)):
+        if name.endswith('.opt'):
+            template_id, body = opt_to_web_template(os.path.join(opt_dir, name), languages)
+            templates[template_id] = body
+    return templates
+
+
+# ─── HTTP Server ──────────────────────────────────────────────────────
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'FakeEHRbase/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):  # keep benchmark output clean
+        pass
+
+    def _delay(self):
+        fake = self.server.fake
+        delay = fake.latency + (random.uniform(0, fake.jitter) if fake.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _send(self, status, body=None, content_type='application/json'):
+        payload = b'' if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        self._delay()
+        fake = self.server.fake
+        url = urlparse(self.path)
+        path = url.path[len(fake.prefix):]
+        if path == '/rest/openehr/v1/definition/template/adl1.4':
+            return self._send(200, fake.template_list())
+        match = re.match(r'^/rest/ecis/v1/template/(.+)$', path)
+        if match:
+            body = fake.web_template_bytes.get(unquote(match.group(1)))
+            return self._send(200, body) if body else self._send(404, {'error': 'template not found'})
+        match = re.match(r'^/rest/openehr/v1/ehr/([^/]+)$', path)
+        if match:
+            ehr_id = match.group(1)
+            if ehr_id not in fake.ehrs:
+                return self._send(404, {'error': 'EHR not found'})
+            return self._send(200, {'ehr_id': {'value': ehr_id}, 'system_id': {'value': 'fake'}})
+        match = re.match(r'^/rest/ecis/v1/composition/(.+)$', path)
+        if match:
+            composition = fake.compositions.get(unquote(match.group(1)))
+            if composition is None:
+                return self._send(404, {'error': 'composition not found'})
+            return self._send(200, {'compositionUid': unquote(match.group(1)), 'composition': composition})
+        self._send(404, {'error': f'no fake route for GET {path}'})
+
+    def do_POST(self):
+        body = self._body()
+        self._delay()
+        fake = self.server.fake
+        url = urlparse(self.path)
+        path = url.path[len(fake.prefix):]
+        if path == '/rest/openehr/v1/definition/template/adl1.4':
+            return self._send(201)
+        if path == '/rest/openehr/v1/ehr':
+            ehr_id = str(uuid.uuid4())
+            fake.ehrs.add(ehr_id)
+            return self._send(201, {'ehr_id': {'value': ehr_id}})
+        if path == '/rest/ecis/v1/composition':
+            params = parse_qs(url.query)
+            if params.get('ehrId', [''])[0] not in fake.ehrs:
+                return self._send(404, {'error': 'EHR not found'})
+            uid = f"{uuid.uuid4()}::fake.ehrbase::1"
+            fake.compositions[uid] = json.loads(body or b'{}')
+            return self._send(201, {'compositionUid': uid, 'ehrId': params['ehrId'][0]})
+        if path == '/rest/openehr/v1/query/aql':
+            return self._send(200, fake.aql_result(json.loads(body or b'{}')))
+        self._send(404, {'error': f'no fake route for POST {path}'})
+
+
+class FakeEHRbase:
+    """
+    Threaded fake EHRbase server. Use as a context manager or call start()/stop().
+
+    Args:
+        latency: Seconds added to every response.
+        jitter: Extra uniformly random seconds (0..jitter) per response.
+        aql_rows: Total rows the synthetic AQL result set contains.
+        languages: Languages to emit in web template localized names.
+        opt_dir: Directory of .opt files to derive web templates from.
+    """
+
+    prefix = '/ehrbase'
+
+    def __init__(self, latency=0.0, jitter=0.0, aql_rows=1000, languages=('en',), opt_dir=OPT_DIR):
+        self.latency = latency
+        self.jitter = jitter
+        self.aql_rows = aql_rows
+        self.web_templates = load_web_templates(opt_dir, languages)
+        # Pre-encode once: the fake should not be the bottleneck it measures
+        self.web_template_bytes = {k: json.dumps(v).encode() for k, v in self.web_templates.items()}
+        self.ehrs = set()
+        self.compositions = {}
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}{self.prefix}"
+
+    def template_list(self):
+        return [{
+            'template_id': template_id,
+            'concept': template_id,
+            'archetype_id': body['webTemplate']['tree']['nodeId'],
+            'created_timestamp': '2026-01-01T00:00:00Z',
+        } for template_id, body in self.web_templates.items()]
+
+    def aql_result(self, body):
+        offset = int(body.get('offset', 0) or 0)
+        fetch = body.get('fetch')
+        end = self.aql_rows if fetch is None else min(self.aql_rows, offset + int(fetch))
+        rows = [[f"{uuid.UUID(int=i)}::fake.ehrbase::1", 'Vitals.v0',
+                 '2026-01-01T00:00:00Z', 120.0 + i % 40] for i in range(offset, max(offset, end))]
+        return {
+            'q': body.get('q', ''),
+            'columns': [
+                {'name': 'uid', 'path': 'c/uid/value'},
+                {'name': 'template_id', 'path': 'c/name/value'},
+                {'name': 'start_time', 'path': 'c/context/start_time/value'},
+                {'name': 'systolic', 'path': 'o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude'},
+            ],
+            'rows': rows,
+        }
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
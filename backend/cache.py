@@ -0,0 +1,134 @@
+"""
+In-Process Caches
+
+Thread-safe, bounded caches shared by the backend modules.
+
+- LRUCache: a size-bounded least-recently-used map. Used for payloads that are
+  cheap to keep but expensive to fetch (e.g. last good EHRbase responses).
+- DiskCache: a directory of JSON files, one per key. Used as an optional
+  second level for immutable payloads (e.g. versioned compositions) so they
+  survive restarts and are shared by worker processes.
+
+SAFETY NOTE: Cached values are shared between request threads. Store values
+that callers will not mutate, or copy them on the way out.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    A thread-safe least-recently-used cache with a fixed maximum size.
+
+    Args:
+        maxsize: Maximum number of entries kept; the least recently used
+                 entry is evicted when the limit is exceeded.
+        name: Human-readable cache name (used in logs and the /metrics hit ratio).
+    """
+
+    def __init__(self, maxsize=128, name='cache'):
+        self.maxsize = maxsize
+        self.name = name
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        metrics.track_cache(self)
+
+    def get(self, key, default=None):
+        """Return the cached value for key (marking it recently used), or default."""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Insert or replace key, evicting the least recently used entry if full."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove key and return its value, or default if absent."""
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        """Snapshot of the current keys, least recently used first."""
+        with self._lock:
+            return list(self._data.keys())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class DiskCache:
+    """
+    A JSON-file cache for immutable values, shared by all processes using the directory.
+
+    Keys are hashed into file names; writes go to a temp file and are renamed
+    into place, so readers never see a partial entry. Files are created
+    owner-readable only (they may hold clinical data). There is no eviction:
+    only use it for values that never change, and prune the directory externally.
+
+    Args:
+        directory: Cache directory (created if missing)
+        name: Human-readable cache name (used in logs)
+    """
+
+    def __init__(self, directory, name='disk_cache'):
+        self.directory = directory
+        self.name = name
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, key, default=None):
+        """Return the stored value for key, or default if absent or unreadable."""
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+        except (OSError, ValueError) as e:
+            logger.warning(f"{self.name}: unreadable entry for {key!r}: {e}")
+            return default
+
+    def put(self, key, value):
+        """Atomically write value (must be JSON-serializable) for key."""
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning(f"{self.name}: could not write entry for {key!r}: {e}")
@@ -0,0 +1,223 @@
+"""
+Memory-Mapped Catalog Snapshot
+
+With several pre-forked workers, every worker used to scan and parse the
+archetype catalog and the OPTs for itself: N copies of the same data and N
+warm-ups. A snapshot is the parsed catalog packed once into a single
+immutable file that every worker maps read-only, so the bytes live once in
+the OS page cache no matter how many workers there are.
+
+File layout (little-endian):
+    MAGIC (8 bytes) | generation (u64) | index length (u64)
+    index   UTF-8 JSON: per archetype its header, signature, slot definitions
+            and (offset, length) references to its blobs; plus extra blobs
+    blobs   per archetype: the form as response-ready JSON (default
+            language) and its search fields; extras: the dependency graph
+
+Not in the snapshot: ontology terms and forms in languages other than
+ARCHETYPE_LANGUAGE (each worker reads those from the archetype XML on first
+use, see term_store.py), and web template path indexes, which are derived
+from EHRbase's web templates rather than from files the build can read.
+Under gunicorn's preload those are shared copy-on-write from the master's
+warm-up instead (see wsgi.py).
+
+A rebuild writes a new generation to a temporary file and renames it over the
+old one (atomic on POSIX). Workers notice the new inode within
+CATALOG_SNAPSHOT_CHECK_INTERVAL seconds and remap; readers of the previous
+mapping are unaffected, as it stays valid until dropped.
+
+Build one with:
+    python catalog_snapshot.py [--out PATH]
+
+Configuration:
+    CATALOG_SNAPSHOT                  snapshot file path (unset: snapshots disabled)
+    CATALOG_SNAPSHOT_CHECK_INTERVAL   seconds between checks for a new generation (default 5)
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import logging
+import argparse
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.getenv('CATALOG_SNAPSHOT') or None
+CHECK_INTERVAL = float(os.getenv('CATALOG_SNAPSHOT_CHECK_INTERVAL', '5'))
+
+MAGIC = b'OEHRCAT1'
+_HEADER = struct.Struct('<8sQQ')
+
+
+class SnapshotError(Exception):
+    """The file is missing, truncated or not a catalog snapshot."""
+
+
+def write(path, archetypes, blobs, extras=None):
+    """
+    Write a new snapshot generation atomically.
+
+    Args:
+        path: Destination file
+        archetypes: {archetype_id: dict} index entries (JSON-serialisable)
+        blobs: {archetype_id: {blob name: bytes}}
+        extras: {name: bytes} snapshot-wide blobs
+
+    Returns:
+        int: The generation written
+    """
+    generation = 1
+    try:
+        generation = Snapshot(path).generation + 1
+    except SnapshotError:
+        pass
+
+    sections = []
+    offset = 0
+
+    def place(data):
+        nonlocal offset
+        sections.append(data)
+        ref = [offset, len(data)]
+        offset += len(data)
+        return ref
+
+    index = {'generation': generation, 'created': time.time(), 'archetypes': {}, 'extras': {}}
+    for archetype_id, entry in archetypes.items():
+        entry = dict(entry)
+        for name, data in blobs.get(archetype_id, {}).items():
+            entry[name] = place(data)
+        index['archetypes'][archetype_id] = entry
+    for name, data in (extras or {}).items():
+        index['extras'][name] = place(data)
+    index_bytes = json.dumps(index, separators=(',', ':')).encode('utf-8')
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.catalog-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, generation, len(index_bytes)))
+            f.write(index_bytes)
+            for data in sections:
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    logger.info(f"Wrote catalog snapshot generation {generation} to {path}: "
+                f"{len(archetypes)} archetypes, {_HEADER.size + len(index_bytes) + offset} bytes")
+    return generation
+
+
+class Snapshot:
+    """A read-only mapping of one snapshot generation."""
+
+    def __init__(self, path):
+        try:
+            with open(path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size < _HEADER.size:
+                    raise SnapshotError(f"{path} is truncated")
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError as e:
+            raise SnapshotError(str(e)) from e
+
+        magic, self.generation, index_length = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or _HEADER.size + index_length > len(self._mm):
+            raise SnapshotError(f"{path} is not a catalog snapshot")
+        index = json.loads(self._mm[_HEADER.size:_HEADER.size + index_length])
+        self._base = _HEADER.size + index_length
+        self.path = path
+        self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.created = index['created']
+        self.archetypes = index['archetypes']
+        self.extras = index['extras']
+
+    def blob(self, ref):
+        """Bytes of one blob reference ([offset, length])."""
+        offset, length = ref
+        start = self._base + offset
+        return self._mm[start:start + length]
+
+    def extra(self, name):
+        ref = self.extras.get(name)
+        return None if ref is None else self.blob(ref)
+
+
+_current = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def _identity(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def current():
+    """
+    The mapped snapshot at CATALOG_SNAPSHOT, remapped when a new generation
+    has been renamed into place; None if snapshots are disabled or unreadable.
+    """
+    global _current, _checked_at
+    if not SNAPSHOT_PATH:
+        return None
+    now = time.monotonic()
+    if _current is not None and now - _checked_at < CHECK_INTERVAL:
+        return _current
+    with _lock:
+        if _current is not None and now - _checked_at < CHECK_INTERVAL:
+            return _current
+        _checked_at = now
+        identity = _identity(SNAPSHOT_PATH)
+        if identity is None or (_current is not None and identity == _current.identity):
+            return _current
+        try:
+            started = time.perf_counter()
+            # The previous mapping is not closed: requests still holding it
+            # keep reading the old generation until they drop it
+            _current = Snapshot(SNAPSHOT_PATH)
+            logger.info(f"Mapped catalog snapshot generation {_current.generation} "
+                        f"({len(_current.archetypes)} archetypes) in "
+                        f"{(time.perf_counter() - started) * 1000:.1f}ms")
+        except SnapshotError as e:
+            logger.warning(f"Ignoring catalog snapshot {SNAPSHOT_PATH}: {e}")
+        return _current
+
+
+def reset():
+    """Forget the current mapping (e.g. in a freshly forked worker)."""
+    global _current, _checked_at
+    with _lock:
+        _current = None
+        _checked_at = 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the memory-mapped archetype catalog snapshot.')
+    parser.add_argument('--out', default=SNAPSHOT_PATH, help='Snapshot path (default: $CATALOG_SNAPSHOT)')
+    args = parser.parse_args(argv)
+    if not args.out:
+        parser.error('--out is required when CATALOG_SNAPSHOT is not set')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    import archetype_catalog
+    generation = archetype_catalog.export_snapshot(args.out)
+    print(f"Catalog snapshot generation {generation} written to {args.out}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
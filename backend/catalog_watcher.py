@@ -0,0 +1,254 @@
+"""
+Archetype / OPT Watch Mode
+
+Watches ARCHETYPE_ROOT_DIR (*.xml) and OPT_UPLOAD_DIR (*.opt) and applies
+changes while the server runs, so new CKM exports and templates go live
+without a restart or a full rescan:
+
+- File events are debounced: a batch is applied once the directories have
+  been quiet for ARCHETYPE_WATCH_DEBOUNCE seconds (editors and unzip write
+  files in bursts).
+- Only the changed files are re-parsed (archetype_catalog.refresh_file /
+  remove_file). Each archetype's new header, forms, search entry and slots
+  are swapped in under the catalog lock; readers never see a half-updated
+  archetype or a cold cache.
+- Changed .opt files update the dependency graph and invalidate that
+  template's caches (dependency_graph.template_changed); with
+  OPT_AUTO_UPLOAD they are uploaded to EHRbase first.
+
+Events come from inotify through the optional `watchdog` package; without
+it, the directories are polled every ARCHETYPE_WATCH_POLL_INTERVAL seconds.
+
+Configuration:
+    ARCHETYPE_WATCH                 'true' to start the watcher with the server (default false)
+    ARCHETYPE_WATCH_DEBOUNCE        quiet period before applying a batch, seconds (default 1.0)
+    ARCHETYPE_WATCH_POLL_INTERVAL   polling fallback interval, seconds (default 2.0)
+    OPT_AUTO_UPLOAD                 'true' to upload changed .opt files to EHRbase (default false)
+"""
+
+import os
+import glob
+import time
+import logging
+import threading
+
+import archetype_catalog
+import dependency_graph
+from ehrbase_client import EHRbaseError
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # inotify via watchdog is optional; fall back to polling
+    Observer = None
+    FileSystemEventHandler = object
+
+logger = logging.getLogger(__name__)
+
+WATCH_ENABLED = os.getenv('ARCHETYPE_WATCH', 'false').lower() == 'true'
+DEBOUNCE = float(os.getenv('ARCHETYPE_WATCH_DEBOUNCE', '1.0'))
+POLL_INTERVAL = float(os.getenv('ARCHETYPE_WATCH_POLL_INTERVAL', '2.0'))
+AUTO_UPLOAD = os.getenv('OPT_AUTO_UPLOAD', 'false').lower() == 'true'
+
+SUFFIXES = ('.xml', '.opt')
+_WRITE_EVENTS = {'created', 'modified', 'deleted', 'moved', 'closed'}
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        # Ignore directory events and read-only ones ('opened', 'closed_no_write'),
+        # which our own re-parsing would otherwise trigger
+        if event.is_directory or event.event_type not in _WRITE_EVENTS:
+            return
+        self.watcher.notify(event.src_path)
+        dest_path = getattr(event, 'dest_path', None)
+        if dest_path:
+            self.watcher.notify(dest_path)
+
+
+class CatalogWatcher:
+    """
+    Debounced watcher over the archetype and OPT directories.
+
+    Args:
+        archetype_dir: Directory of archetype XML files (recursive)
+        opt_dir: Directory of .opt files
+        upload: Callable(opt_xml_bytes) used when auto_upload is on
+        auto_upload: Upload changed .opt files before invalidating
+        debounce: Quiet period, in seconds, before a batch is applied
+    """
+
+    def __init__(self, archetype_dir=None, opt_dir=None, upload=None, auto_upload=AUTO_UPLOAD,
+                 debounce=DEBOUNCE, poll_interval=POLL_INTERVAL):
+        self.archetype_dir = os.path.abspath(archetype_dir or archetype_catalog.ARCHETYPE_ROOT_DIR)
+        self.opt_dir = os.path.abspath(opt_dir or dependency_graph.OPT_UPLOAD_DIR)
+        self.upload = upload
+        self.auto_upload = auto_upload and upload is not None
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._pending = set()
+        self._last_event = 0.0
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._threads = []
+        self._observer = None
+
+    # ─── Lifecycle ────────────────────────────────────────────────────
+
+    def start(self):
+        """Start watching (inotify if watchdog is installed, else polling)."""
+        archetype_catalog.ensure_built()
+        dependency_graph.ensure_loaded()
+        if Observer is not None:
+            self._observer = Observer()
+            handler = _EventHandler(self)
+            for directory, recursive in ((self.archetype_dir, True), (self.opt_dir, False)):
+                if os.path.isdir(directory):
+                    self._observer.schedule(handler, directory, recursive=recursive)
+            self._observer.daemon = True
+            self._observer.start()
+            mode = 'inotify'
+        else:
+            self._spawn(self._poll, 'catalog-watch-poll')
+            mode = f'polling every {self.poll_interval}s'
+        self._spawn(self._run, 'catalog-watch-apply')
+        logger.info(f"Watching {self.archetype_dir} and {self.opt_dir} ({mode}, "
+                    f"debounce {self.debounce}s, auto-upload {'on' if self.auto_upload else 'off'})")
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout=5)
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def _spawn(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    # ─── Events ───────────────────────────────────────────────────────
+
+    def notify(self, path):
+        """Queue a changed, created or deleted file (other suffixes are ignored)."""
+        if not path.endswith(SUFFIXES):
+            return
+        with self._cond:
+            self._pending.add(os.path.abspath(path))
+            self._last_event = time.monotonic()
+            self._cond.notify_all()
+
+    def _snapshot(self):
+        files = glob.glob(os.path.join(self.archetype_dir, '**', '*.xml'), recursive=True)
+        files += glob.glob(os.path.join(self.opt_dir, '*.opt'))
+        mtimes = {}
+        for path in files:
+            try:
+                mtimes[os.path.abspath(path)] = os.path.getmtime(path)
+            except OSError:
+                continue
+        return mtimes
+
+    def _poll(self):
+        previous = self._snapshot()
+        while not self._stopped.wait(self.poll_interval):
+            current = self._snapshot()
+            for path in set(previous) | set(current):
+                if previous.get(path) != current.get(path):
+                    self.notify(path)
+            previous = current
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._cond:
+                while not self._pending and not self._stopped.is_set():
+                    self._cond.wait()
+                # Wait until no new events have arrived for `debounce` seconds
+                while self._pending and not self._stopped.is_set():
+                    remaining = self._last_event + self.debounce - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, set()
+            if batch and not self._stopped.is_set():
+                self.apply(batch)
+
+    # ─── Applying Changes ─────────────────────────────────────────────
+
+    def apply(self, paths):
+        """
+        Apply one batch of changed paths: archetypes first, then OPTs.
+
+        Returns:
+            dict: {'archetypes': [ids refreshed or removed], 'templates': [ids]}
+        """
+        started = time.perf_counter()
+        archetypes, templates = [], []
+        for path in sorted(p for p in paths if p.endswith('.xml')):
+            try:
+                if os.path.exists(path):
+                    archetype_id = archetype_catalog.refresh_file(path)
+                    archetypes.extend([archetype_id] if archetype_id else [])
+                else:
+                    archetypes.extend(archetype_catalog.remove_file(path))
+            except Exception as e:
+                logger.error(f"Watcher: could not apply {path}: {e}")
+        for path in sorted(p for p in paths if p.endswith('.opt')):
+            try:
+                template_id = self._apply_opt(path)
+                if template_id:
+                    templates.append(template_id)
+            except Exception as e:
+                logger.error(f"Watcher: could not apply {path}: {e}")
+        logger.info(f"Watcher applied {len(paths)} file changes in "
+                    f"{(time.perf_counter() - started) * 1000:.0f}ms: "
+                    f"{len(archetypes)} archetypes, {len(templates)} templates")
+        return {'archetypes': archetypes, 'templates': templates}
+
+    def _apply_opt(self, path):
+        if not os.path.exists(path):
+            template_id = dependency_graph.GRAPH.template_for_source(path)
+            if template_id:
+                dependency_graph.GRAPH.remove_template(template_id)
+                logger.info(f"Watcher: {os.path.basename(path)} removed; "
+                            f"'{template_id}' is no longer tracked (EHRbase keeps it)")
+            return template_id
+
+        if self.auto_upload:
+            with open(path, 'rb') as f:
+                opt_xml = f.read()
+            try:
+                self.upload(opt_xml)
+                logger.info(f"AUDIT: Watcher uploaded {os.path.basename(path)} to EHRbase")
+            except EHRbaseError as e:
+                # e.g. 409: EHRbase keeps the existing version; local caches are still refreshed
+                logger.warning(f"Watcher: upload of {os.path.basename(path)} failed: {e}")
+        template_id, _ = dependency_graph.parse_opt(path)
+        if template_id:
+            dependency_graph.template_changed(template_id, path)
+        return template_id
+
+
+_watcher = None
+
+
+def start(upload=None):
+    """Start the process-wide watcher (once)."""
+    global _watcher
+    if _watcher is None:
+        _watcher = CatalogWatcher(upload=upload).start()
+    return _watcher
+
+
+def stop():
+    global _watcher
+    if _watcher is not None:
+        _watcher.stop()
+        _watcher = None
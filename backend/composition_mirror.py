@@ -0,0 +1,103 @@
+"""
+Write-Behind Composition Mirror (PostgreSQL JSONB)
+
+After EHRbase accepts a composition, the backend hands the FLAT JSON to this
+module, which stores it in the local `ehr_documents` table on a background
+thread. Field-value searches ("find patients with X") can then be answered
+from the JSONB GIN index in milliseconds instead of running AQL on the CDR.
+
+SAFETY NOTE: EHRbase remains the system of record. The mirror is best-effort:
+writes happen after the clinical save has succeeded, never block or fail the
+submission, and a dropped mirror write is logged (not retried). Search results
+from the mirror may lag the CDR by the queue delay.
+
+Configuration:
+    COMPOSITION_MIRROR_ENABLED     'true' (default) / 'false'
+    COMPOSITION_MIRROR_QUEUE_SIZE  max pending writes before new ones are dropped (default 1000)
+"""
+
+import os
+import queue
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv('COMPOSITION_MIRROR_ENABLED', 'true').lower() == 'true'
+
+_queue = queue.Queue(maxsize=int(os.getenv('COMPOSITION_MIRROR_QUEUE_SIZE', '1000')))
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def enqueue(ehr_id, template_id, composition_uid, flat_json):
+    """
+    Queue a successfully saved composition for mirroring. Never blocks.
+
+    Returns:
+        bool: False if mirroring is disabled or the queue is full.
+    """
+    if not ENABLED or not composition_uid or composition_uid == 'unknown':
+        return False
+    _ensure_worker()
+    try:
+        _queue.put_nowait((ehr_id, template_id, composition_uid, dict(flat_json)))
+        return True
+    except queue.Full:
+        logger.error(f"Composition mirror queue full; not mirroring {composition_uid}")
+        return False
+
+
+def flush(timeout=5.0):
+    """Wait (up to timeout seconds) for queued mirror writes to finish."""
+    done = threading.Event()
+
+    def waiter():
+        _queue.join()
+        done.set()
+
+    threading.Thread(target=waiter, daemon=True).start()
+    return done.wait(timeout)
+
+
+def pending():
+    """Number of mirror writes waiting in the queue."""
+    return _queue.qsize()
+
+
+def _ensure_worker():
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name='composition-mirror', daemon=True)
+            _worker.start()
+
+
+def _run():
+    from db import get_patient_id_for_ehr, save_composition_document
+    from ehrbase_client import EHRbaseClient
+
+    while True:
+        ehr_id, template_id, composition_uid, flat_json = _queue.get()
+        try:
+            # Store what EHRbase actually received: the cleaned flat JSON
+            data = EHRbaseClient._clean_flat_json(flat_json)
+            patient_id = get_patient_id_for_ehr(ehr_id) or 'UNKNOWN'
+            if save_composition_document(
+                ehr_id, template_id, composition_uid, patient_id,
+                data.get('ctx/composer_name'), data
+            ):
+                logger.info(f"Mirrored composition {composition_uid} for EHR {ehr_id}")
+        except Exception as e:
+            logger.error(f"Composition mirror write failed: {e}")
+        finally:
+            _queue.task_done()
+
+
+@atexit.register
+def _drain_on_exit():
+    if _worker is not None and _worker.is_alive():
+        flush(timeout=5.0)
@@ -9,39 +9,76 @@ Connections are managed via context managers to prevent leaks.
 """
 
 import os
+import time
 import logging
 from contextlib import contextmanager
 import psycopg2
 from psycopg2 import pool
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, Json, execute_values
 from dotenv import load_dotenv
 
+import metrics
+from services import LazyService
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
-# Initialize connection pool
-try:
-    db_pool = psycopg2.pool.SimpleConnectionPool(
-        1, 10,
-        host=os.getenv('LOCAL_DB_HOST', 'localhost'),
-        port=os.getenv('LOCAL_DB_PORT', '5433'),
-        database=os.getenv('LOCAL_DB_NAME', 'OpenEHR_db'),
-        user=os.getenv('LOCAL_DB_USER', 'postgres'),
-        password=os.getenv('LOCAL_DB_PASSWORD', 'sreena7')
-    )
-    if db_pool:
-        logger.info("PostgreSQL connection pool created successfully")
-except Exception as e:
-    logger.error(f"Failed to create PostgreSQL connection pool: {e}")
-    db_pool = None
+DB_POOL_RETRY_SECONDS = float(os.getenv('DB_POOL_RETRY_SECONDS', '30'))
+
+
+def _create_pool():
+    try:
+        db_pool = psycopg2.pool.SimpleConnectionPool(
+            1, 10,
+            host=os.getenv('LOCAL_DB_HOST', 'localhost'),
+            port=os.getenv('LOCAL_DB_PORT', '5433'),
+            database=os.getenv('LOCAL_DB_NAME', 'OpenEHR_db'),
+            user=os.getenv('LOCAL_DB_USER', 'postgres'),
+            password=os.getenv('LOCAL_DB_PASSWORD', 'sreena7')
+        )
+    except Exception as e:
+        logger.error(f"Failed to create PostgreSQL connection pool: {e}")
+        raise
+    logger.info("PostgreSQL connection pool created successfully")
+    return db_pool
+
+
+# Connection pool, opened on first use rather than at import (see services.py);
+# after a failure, connecting is retried at most every DB_POOL_RETRY_SECONDS
+POOL = LazyService('db_pool', _create_pool, close=lambda p: p.closeall(), retry_after=DB_POOL_RETRY_SECONDS)
+
+
+def get_pool():
+    """The connection pool, or None if PostgreSQL is unreachable."""
+    try:
+        return POOL.get()
+    except Exception:
+        return None
+
+
+def close_pool():
+    """Close every pooled connection (server shutdown); the next use reconnects."""
+    POOL.close()
 
 @contextmanager
 def get_db_connection():
     """Context manager for safely acquiring and releasing database connections."""
+    db_pool = get_pool()
     if not db_pool:
         raise Exception("Database connection pool is not initialized")
     
-    conn = db_pool.getconn()
+    # SimpleConnectionPool never blocks: a checkout either reuses an idle
+    # connection, opens a new one, or raises PoolError once all are in use
+    start = time.perf_counter()
+    try:
+        conn = db_pool.getconn()
+    except Exception as e:
+        metrics.DB_POOL_FAILURES.inc()
+        if isinstance(e, pool.PoolError):
+            metrics.DB_POOL_EXHAUSTED.inc()
+        raise
+    metrics.DB_POOL_CHECKOUT.observe(time.perf_counter() - start)
+    metrics.DB_POOL_IN_USE.inc()
     try:
         yield conn
         # Commit by default if no exception was raised
@@ -50,13 +87,14 @@ def get_db_connection():
         conn.rollback()
         raise e
     finally:
+        metrics.DB_POOL_IN_USE.dec()
         db_pool.putconn(conn)
 
 def initialize_database():
     """
     Creates necessary tables on startup if they don't exist.
     """
-    if not db_pool:
+    if not get_pool():
         logger.warning("Skipping DB initialization due to missing connection pool")
         return False
         
@@ -72,18 +110,83 @@ def initialize_database():
                     );
                 """)
                 logger.info("Database table 'patient_mapping' initialized successfully")
+
+                # Local JSONB mirror of submitted FLAT compositions (see composition_mirror.py).
+                # Matches postgreSQL/create query.sql, plus the keys the mirror writes by.
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS ehr_documents (
+                        id BIGSERIAL PRIMARY KEY,
+                        archetype_id TEXT,
+                        patient_id TEXT NOT NULL,
+                        recorded_by TEXT,
+                        recorded_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL,
+                        data JSONB NOT NULL
+                    );
+                """)
+                cur.execute("""
+                    ALTER TABLE ehr_documents
+                        ALTER COLUMN archetype_id DROP NOT NULL,
+                        ADD COLUMN IF NOT EXISTS ehr_id UUID,
+                        ADD COLUMN IF NOT EXISTS template_id TEXT,
+                        ADD COLUMN IF NOT EXISTS composition_uid TEXT;
+                """)
+                cur.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS idx_ehr_documents_composition_uid
+                        ON ehr_documents (composition_uid);
+                    CREATE INDEX IF NOT EXISTS idx_ehr_documents_data_path_ops
+                        ON ehr_documents USING GIN (data jsonb_path_ops);
+                    CREATE INDEX IF NOT EXISTS idx_ehr_documents_ehr_template
+                        ON ehr_documents (ehr_id, template_id);
+                    CREATE INDEX IF NOT EXISTS idx_ehr_documents_template_id
+                        ON ehr_documents (template_id);
+                """)
+                logger.info("Database table 'ehr_documents' initialized successfully")
         return True
     except Exception as e:
         logger.error(f"Failed to initialize database tables: {e}")
         return False
 
-def get_ehr_id_for_patient(patient_id):
+@contextmanager
+def _connection(conn=None):
+    """Use the caller's connection (and transaction) if given, else a pooled one."""
+    if conn is not None:
+        yield conn
+    else:
+        with get_db_connection() as pooled_conn:
+            yield pooled_conn
+
+@contextmanager
+def patient_advisory_lock(patient_id):
+    """
+    Serialize EHR creation for one patient across threads AND worker processes.
+
+    Holds a transaction-scoped Postgres advisory lock keyed on the patient_id and
+    yields the locked connection, so the caller can re-check and write the
+    mapping inside the same transaction. The lock is released on commit/rollback.
+
+    Yields None (no lock) if the pool is unavailable, matching the degraded
+    behaviour of the other helpers in this module.
+    """
+    if not get_pool():
+        logger.warning(f"No DB pool; creating EHR for {patient_id} without advisory lock")
+        yield None
+        return
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT pg_advisory_xact_lock(hashtext(%s))",
+                (f"patient_mapping:{patient_id}",)
+            )
+        yield conn
+
+def get_ehr_id_for_patient(patient_id, conn=None):
     """
     Fetch the ehr_id for a given patient_id from the database.
     Returns None if not found.
     """
     try:
-        with get_db_connection() as conn:
+        with _connection(conn) as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 cur.execute(
                     "SELECT ehr_id FROM patient_mapping WHERE patient_id = %s",
@@ -95,12 +198,12 @@ def get_ehr_id_for_patient(patient_id):
         logger.error(f"Error querying patient map for {patient_id}: {e}")
         return None
 
-def save_patient_ehr_link(patient_id, ehr_id):
+def save_patient_ehr_link(patient_id, ehr_id, conn=None):
     """
     Save the patient_id -> ehr_id link into the database using UPSERT.
     """
     try:
-        with get_db_connection() as conn:
+        with _connection(conn) as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     INSERT INTO patient_mapping (patient_id, ehr_id)
@@ -113,6 +216,152 @@ def save_patient_ehr_link(patient_id, ehr_id):
         logger.error(f"Error saving patient map for {patient_id} ({ehr_id}): {e}")
         return False
 
+def get_ehr_ids_for_patients(patient_ids, conn=None):
+    """
+    Batch lookup: map each known patient_id to its ehr_id in one indexed query.
+    Patients without a mapping are absent from the result. Returns None on DB error.
+    """
+    try:
+        with _connection(conn) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT patient_id, ehr_id FROM patient_mapping WHERE patient_id = ANY(%s)",
+                    (list(patient_ids),)
+                )
+                return {patient_id: str(ehr_id) for patient_id, ehr_id in cur.fetchall()}
+    except Exception as e:
+        logger.error(f"Error batch querying patient map for {len(patient_ids)} patients: {e}")
+        return None
+
+def save_patient_ehr_links(links, conn=None):
+    """
+    Insert many (patient_id, ehr_id) links with a single multi-row statement.
+
+    Existing mappings are never overwritten (ON CONFLICT DO NOTHING).
+    Returns the set of patient_ids actually inserted, or None on DB error.
+    """
+    if not links:
+        return set()
+    try:
+        with _connection(conn) as conn:
+            with conn.cursor() as cur:
+                inserted = execute_values(cur, """
+                    INSERT INTO patient_mapping (patient_id, ehr_id)
+                    VALUES %s
+                    ON CONFLICT (patient_id) DO NOTHING
+                    RETURNING patient_id
+                """, list(links), page_size=len(links), fetch=True)
+        return {row[0] for row in inserted}
+    except Exception as e:
+        logger.error(f"Error saving {len(links)} patient map links: {e}")
+        return None
+
+@contextmanager
+def patient_advisory_locks(patient_ids):
+    """
+    Bulk variant of patient_advisory_lock: lock every patient_id in one transaction.
+
+    Uses the same lock keys as patient_advisory_lock, taken in sorted order so
+    that concurrent bulk runs cannot deadlock each other. Yields None if the
+    pool is unavailable.
+    """
+    if not get_pool():
+        logger.warning("No DB pool; bulk creating EHRs without advisory locks")
+        yield None
+        return
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT pg_advisory_xact_lock(hashtext('patient_mapping:' || pid)) "
+                "FROM unnest(%s::text[]) AS pid",
+                (sorted(set(patient_ids)),)
+            )
+        yield conn
+
+def get_patient_id_for_ehr(ehr_id):
+    """
+    Reverse lookup: the patient_id mapped to an ehr_id, or None.
+    """
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT patient_id FROM patient_mapping WHERE ehr_id = %s",
+                    (str(ehr_id),)
+                )
+                result = cur.fetchone()
+                return result[0] if result else None
+    except Exception as e:
+        logger.error(f"Error querying patient for EHR {ehr_id}: {e}")
+        return None
+
+def save_composition_document(ehr_id, template_id, composition_uid, patient_id, recorded_by, data):
+    """
+    Upsert one mirrored FLAT composition into ehr_documents, keyed by composition_uid.
+    """
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO ehr_documents
+                        (ehr_id, template_id, composition_uid, patient_id, recorded_by, data)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (composition_uid) DO UPDATE
+                    SET data = EXCLUDED.data,
+                        recorded_by = EXCLUDED.recorded_by,
+                        recorded_at = NOW();
+                """, (str(ehr_id), template_id, composition_uid, patient_id, recorded_by, Json(data)))
+        return True
+    except Exception as e:
+        logger.error(f"Error mirroring composition {composition_uid} for EHR {ehr_id}: {e}")
+        return False
+
+def search_composition_documents(fields, template_id=None, ehr_id=None, patients_only=False,
+                                 limit=50, offset=0):
+    """
+    Find mirrored compositions whose FLAT data contains all `fields` (path -> value).
+
+    Uses JSONB containment (data @> ...), which is served by the
+    jsonb_path_ops GIN index. Returns a list of dicts, or None on DB error.
+    With patients_only=True, returns one row per matching patient instead.
+    """
+    conditions = ["data @> %s"]
+    params = [Json(fields)]
+    if template_id:
+        conditions.append("template_id = %s")
+        params.append(template_id)
+    if ehr_id:
+        conditions.append("ehr_id = %s")
+        params.append(str(ehr_id))
+    where = " AND ".join(conditions)
+
+    if patients_only:
+        sql = f"""
+            SELECT patient_id, ehr_id, COUNT(*) AS matches, MAX(recorded_at) AS last_recorded_at
+            FROM ehr_documents WHERE {where}
+            GROUP BY patient_id, ehr_id
+            ORDER BY last_recorded_at DESC
+            LIMIT %s OFFSET %s
+        """
+    else:
+        sql = f"""
+            SELECT composition_uid, ehr_id, patient_id, template_id, recorded_by, recorded_at
+            FROM ehr_documents WHERE {where}
+            ORDER BY recorded_at DESC
+            LIMIT %s OFFSET %s
+        """
+    params.extend([limit, offset])
+
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(sql, params)
+                return [dict(row) for row in cur.fetchall()]
+    except Exception as e:
+        logger.error(f"Error searching mirrored compositions: {e}")
+        return None
+
 def check_db_health():
     """
     Simple health check query.
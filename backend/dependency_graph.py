@@ -0,0 +1,298 @@
+"""
+Template -> Archetype Dependency Graph
+
+Records which archetypes each operational template (OPT) embeds, and where:
+the AQL path of every archetype root, parsed from the OPT files, and the
+FLAT path prefixes, taken from the web template once it has been indexed.
+With the graph, an update invalidates only what depends on it:
+
+    template_changed(template_id)   the template's web template index,
+                                    projections and stale copy, plus the
+                                    template search entries
+    archetype_changed(archetype_id) the archetype's parsed forms and search
+                                    entry (done by archetype_catalog), and
+                                    the caches of every template embedding it
+
+Cache owners that are not module-level (e.g. the EHRbase client's stale
+copies) subscribe with add_listener().
+
+Configuration:
+    OPT_UPLOAD_DIR   directory of .opt files (default ./opt_upload_folder)
+"""
+
+import os
+import glob
+import logging
+import threading
+
+from lxml import etree
+
+import search_index
+import web_template_index
+import web_template_profiles
+
+logger = logging.getLogger(__name__)
+
+NS = {'openEHR': 'http://schemas.openehr.org/v1'}
+XSI_TYPE = '{http://www.w3.org/2001/XMLSchema-instance}type'
+OPT_UPLOAD_DIR = os.getenv(
+    'OPT_UPLOAD_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opt_upload_folder')
+)
+
+
+def parse_opt(source):
+    """
+    Template id and embedded archetypes of an OPT.
+
+    Args:
+        source: File path, or the OPT XML as bytes
+
+    Returns:
+        tuple: (template_id, {archetype_id: [AQL paths]}); template_id is None
+               if the document has none
+    """
+    if isinstance(source, bytes):
+        root = etree.fromstring(source)
+    else:
+        root = etree.parse(source).getroot()
+
+    template_id = root.findtext('openEHR:template_id/openEHR:value', namespaces=NS)
+    definition = root.find('openEHR:definition', namespaces=NS)
+    archetypes = {}
+    if definition is not None:
+        _collect_roots(definition, '', archetypes)
+    return (template_id.strip() if template_id else None), archetypes
+
+
+def _collect_roots(node, path, archetypes):
+    """Walk C_OBJECT/C_ATTRIBUTE nesting, recording the AQL path of each archetype root."""
+    if node.get(XSI_TYPE) == 'C_ARCHETYPE_ROOT' or node.tag == f"{{{NS['openEHR']}}}definition":
+        archetype_id = node.findtext('openEHR:archetype_id/openEHR:value', namespaces=NS)
+        if archetype_id:
+            archetypes.setdefault(archetype_id.strip(), []).append(path or '/')
+    for attribute in node.findall('openEHR:attributes', namespaces=NS):
+        name = attribute.findtext('openEHR:rm_attribute_name', namespaces=NS)
+        for child in attribute.findall('openEHR:children', namespaces=NS):
+            if child.get(XSI_TYPE) == 'C_ARCHETYPE_ROOT':
+                predicate = child.findtext('openEHR:archetype_id/openEHR:value', namespaces=NS)
+            else:
+                predicate = child.findtext('openEHR:node_id', namespaces=NS)
+            step = f"{path}/{name}[{predicate.strip()}]" if predicate else f"{path}/{name}"
+            _collect_roots(child, step, archetypes)
+
+
+class DependencyGraph:
+    """Template <-> archetype edges with the paths of each embedding."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._archetypes = {}   # template_id -> {archetype_id: [AQL paths]}
+        self._flat_paths = {}   # template_id -> {archetype_id: [FLAT path prefixes]}
+        self._templates = {}    # archetype_id -> {template_ids}
+        self._sources = {}      # template_id -> OPT file path (when loaded from disk)
+
+    def set_template(self, template_id, archetypes, source=None):
+        """
+        Record (or replace) the archetypes of one template.
+
+        Returns:
+            tuple: (added, removed) archetype id sets versus the previous version
+        """
+        with self._lock:
+            previous = set(self._archetypes.get(template_id, {}))
+            for archetype_id in previous - set(archetypes):
+                users = self._templates.get(archetype_id)
+                if users is not None:
+                    users.discard(template_id)
+                    if not users:
+                        del self._templates[archetype_id]
+            for archetype_id in archetypes:
+                self._templates.setdefault(archetype_id, set()).add(template_id)
+            if self._archetypes.get(template_id) != archetypes:
+                self._flat_paths.pop(template_id, None)
+            self._archetypes[template_id] = archetypes
+            if source:
+                self._sources[template_id] = source
+        return set(archetypes) - previous, previous - set(archetypes)
+
+    def remove_template(self, template_id):
+        self.set_template(template_id, {})
+        with self._lock:
+            self._archetypes.pop(template_id, None)
+            self._sources.pop(template_id, None)
+
+    def set_flat_paths(self, template_id, flat_paths):
+        with self._lock:
+            self._flat_paths[template_id] = flat_paths
+
+    def clear_flat_paths(self, template_id):
+        with self._lock:
+            self._flat_paths.pop(template_id, None)
+
+    def has_flat_paths(self, template_id):
+        return template_id in self._flat_paths
+
+    def templates_using(self, archetype_id):
+        """Template ids that embed an archetype."""
+        with self._lock:
+            return sorted(self._templates.get(archetype_id, ()))
+
+    def template_for_source(self, path):
+        with self._lock:
+            for template_id, source in self._sources.items():
+                if source == path:
+                    return template_id
+        return None
+
+    def describe(self, template_id):
+        """
+        Dependencies of one template, or None if unknown.
+
+        Returns:
+            dict: {'template_id', 'source', 'archetypes': {archetype_id: {'aql_paths', 'flat_paths'}}}
+        """
+        with self._lock:
+            archetypes = self._archetypes.get(template_id)
+            if archetypes is None:
+                return None
+            flat = self._flat_paths.get(template_id, {})
+            return {
+                'template_id': template_id,
+                'source': os.path.basename(self._sources[template_id]) if template_id in self._sources else None,
+                'archetypes': {
+                    archetype_id: {'aql_paths': paths, 'flat_paths': flat.get(archetype_id, [])}
+                    for archetype_id, paths in sorted(archetypes.items())
+                },
+            }
+
+    def stats(self):
+        with self._lock:
+            return {'templates': len(self._archetypes), 'archetypes': len(self._templates),
+                    'edges': sum(len(users) for users in self._templates.values())}
+
+
+GRAPH = DependencyGraph()
+_listeners = {'template': [], 'archetype': []}
+_loaded = False
+
+
+def add_listener(kind, callback):
+    """Call callback(id) whenever a 'template' or 'archetype' is invalidated."""
+    _listeners[kind].append(callback)
+
+
+def _notify(kind, item_id):
+    for callback in _listeners[kind]:
+        try:
+            callback(item_id)
+        except Exception as e:
+            logger.warning(f"Invalidation listener {callback!r} failed for {kind} '{item_id}': {e}")
+
+
+def load_opt_dir(directory=None):
+    """(Re)load the graph from every .opt file in OPT_UPLOAD_DIR."""
+    global _loaded
+    directory = directory or OPT_UPLOAD_DIR
+    count = 0
+    for opt_file in sorted(glob.glob(os.path.join(directory, '*.opt'))):
+        try:
+            template_id, archetypes = parse_opt(opt_file)
+        except (etree.XMLSyntaxError, OSError) as e:
+            logger.warning(f"Dependency graph: skipping {opt_file}: {e}")
+            continue
+        if template_id:
+            GRAPH.set_template(template_id, archetypes, source=opt_file)
+            count += 1
+    _loaded = True
+    logger.info(f"Dependency graph loaded from {count} OPTs: {GRAPH.stats()}")
+    return count
+
+
+def ensure_loaded():
+    if not _loaded:
+        load_opt_dir()
+
+
+def export_graph():
+    """The OPT-derived graph as a JSON-ready dict (for catalog snapshots)."""
+    ensure_loaded()
+    with GRAPH._lock:
+        return {template_id: {'archetypes': archetypes, 'source': GRAPH._sources.get(template_id)}
+                for template_id, archetypes in GRAPH._archetypes.items()}
+
+
+def load_graph(exported):
+    """Replace the graph with an export_graph() dict instead of parsing the OPTs."""
+    global _loaded
+    for template_id in set(GRAPH._archetypes) - set(exported):
+        GRAPH.remove_template(template_id)
+    for template_id, entry in exported.items():
+        GRAPH.set_template(template_id, entry['archetypes'], source=entry.get('source'))
+    _loaded = True
+
+
+def record_flat_paths(template_id, index):
+    """
+    Record the FLAT path prefix of each embedded archetype from a
+    web_template_index.WebTemplateIndex (archetype roots carry the archetype
+    id as nodeId). Cheap no-op once recorded for a template version.
+    """
+    ensure_loaded()
+    if GRAPH.has_flat_paths(template_id):
+        return
+    flat_paths = {}
+    for path, node in index.nodes.items():
+        node_id = node.get('nodeId') or ''
+        if node_id.startswith('openEHR-'):
+            flat_paths.setdefault(node_id, []).append(path)
+    GRAPH.set_flat_paths(template_id, flat_paths)
+
+
+def template_changed(template_id, source=None, archetypes=None):
+    """
+    A template was (re-)uploaded: re-read its OPT (file path or XML bytes, if
+    given) and drop only that template's caches. `archetypes` instead of a
+    source records an already parsed OPT (e.g. from template_invalidations.py).
+
+    Returns:
+        tuple: (added, removed) archetype ids versus the previous version
+    """
+    added, removed = set(), set()
+    path = None
+    if source is not None:
+        parsed_id, archetypes = parse_opt(source)
+        template_id = template_id or parsed_id
+        path = source if isinstance(source, str) else None
+    if archetypes is not None:
+        added, removed = GRAPH.set_template(template_id, archetypes, source=path)
+    _invalidate_template(template_id)
+    search_index.mark_templates_stale()
+    logger.info(f"Template '{template_id}' changed: invalidated its caches "
+                f"(+{len(added)} / -{len(removed)} archetypes)")
+    return added, removed
+
+
+def archetype_changed(archetype_id):
+    """
+    An archetype XML changed: drop the caches of every template embedding it.
+    (The archetype's own forms and search entry are refreshed by archetype_catalog.)
+
+    Returns:
+        list: The affected template ids
+    """
+    ensure_loaded()
+    templates = GRAPH.templates_using(archetype_id)
+    for template_id in templates:
+        _invalidate_template(template_id)
+    _notify('archetype', archetype_id)
+    if templates:
+        logger.info(f"Archetype '{archetype_id}' changed: invalidated {len(templates)} templates")
+    return templates
+
+
+def _invalidate_template(template_id):
+    web_template_index.invalidate(template_id)
+    web_template_profiles.invalidate(template_id)
+    GRAPH.clear_flat_paths(template_id)
+    _notify('template', template_id)
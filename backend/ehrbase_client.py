@@ -9,13 +9,46 @@ for audit trail purposes. No clinical data is silently discarded.
 """
 
 import os
+import re
 import json
+import time
 import logging
 import requests
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import profiling
+from cache import LRUCache, DiskCache
+from resilience import SingleFlight, CircuitBreaker
 
 logger = logging.getLogger(__name__)
 
+# Collapse identifiers out of request paths so metrics are labelled by endpoint,
+# never by patient/EHR/composition id.
+_PATH_TEMPLATES = [
+    (re.compile(r'^/rest/ecis/v1/template/[^/]+$'), '/rest/ecis/v1/template/{template_id}'),
+    (re.compile(r'^/rest/ecis/v1/composition/[^/]+$'), '/rest/ecis/v1/composition/{uid}'),
+    (re.compile(r'^/rest/openehr/v1/ehr/[^/]+$'), '/rest/openehr/v1/ehr/{ehr_id}'),
+    (re.compile(r'^/rest/openehr/v1/ehr/[^/]+/(.+)$'), r'/rest/openehr/v1/ehr/{ehr_id}/\1'),
+]
+
+
+def path_template(path):
+    """Map a concrete EHRbase request path to its endpoint template."""
+    for pattern, template in _PATH_TEMPLATES:
+        if pattern.match(path):
+            return pattern.sub(template, path)
+    return path
+
+
+_VERSIONED_UID = re.compile(r'^[0-9a-fA-F-]{36}::[^:/]+::\d+$')
+
+
+def is_versioned_uid(composition_uid):
+    """True for '<uuid>::<system>::<version>' uids, which identify one immutable version."""
+    return bool(_VERSIONED_UID.match(composition_uid or ''))
+
 
 class EHRbaseError(Exception):
     """Custom exception for EHRbase API errors."""
@@ -34,47 +67,133 @@ class EHRbaseClient:
     - EHR creation and lookup
     - Composition submission (Flat JSON format)
     - AQL querying
+
+    Concurrent identical reads (and concurrent EHR creation for the same
+    subject) are coalesced through a single-flight layer, so N simultaneous
+    callers cost one upstream request.
+
+    All requests pass through a circuit breaker: while EHRbase is failing, calls
+    fail fast with a 503 instead of waiting on connections and timeouts. The last
+    good template list and web templates are retained so read endpoints can
+    serve them (flagged as stale) during an outage.
     """
 
     def __init__(self, base_url=None, username=None, password=None):
         self.base_url = (base_url or os.getenv('EHRBASE_BASE_URL', 'http://localhost:8080/ehrbase')).rstrip('/')
         self.username = username or os.getenv('EHRBASE_USER', 'admin')
         self.password = password or os.getenv('EHRBASE_PASSWORD', 'password')
-        self.session = requests.Session()
-        self.session.auth = (self.username, self.password)
-        self.session.headers.update({
+        self.session = self._new_session()
+        self._single_flight = SingleFlight(
+            on_shared=lambda key, waiters: metrics.EHRBASE_COALESCED.inc(waiters, operation=key[0])
+        )
+        self.circuit = CircuitBreaker(
+            name='ehrbase',
+            failure_rate=float(os.getenv('EHRBASE_CB_FAILURE_RATE', '0.5')),
+            min_calls=int(os.getenv('EHRBASE_CB_MIN_CALLS', '10')),
+            window=float(os.getenv('EHRBASE_CB_WINDOW_SECONDS', '30')),
+            reset_timeout=float(os.getenv('EHRBASE_CB_RESET_SECONDS', '15')),
+        )
+        # Last successful read payloads, served stale while EHRbase is unavailable
+        self._last_good = LRUCache(maxsize=int(os.getenv('EHRBASE_STALE_CACHE_SIZE', '256')), name='ehrbase_stale')
+        # Versioned compositions never change: memory LRU plus an optional shared disk cache
+        self._compositions = LRUCache(maxsize=int(os.getenv('COMPOSITION_CACHE_SIZE', '512')), name='compositions')
+        cache_dir = os.getenv('COMPOSITION_CACHE_DIR')
+        self._composition_disk = DiskCache(cache_dir, name='compositions_disk') if cache_dir else None
+        logger.info(f"EHRbase client initialized for {self.base_url}")
+
+    def _new_session(self):
+        session = requests.Session()
+        session.auth = (self.username, self.password)
+        session.headers.update({
             'Accept': 'application/json',
         })
-        logger.info(f"EHRbase client initialized for {self.base_url}")
+        return session
+
+    def reset_session(self):
+        """
+        Start a new HTTP session (e.g. in a forked worker process, which must not
+        reuse the parent's pooled connections). Caches are kept.
+        """
+        self.session = self._new_session()
 
     def _request(self, method, path, **kwargs):
         """
         Internal helper for making authenticated requests to EHRbase.
         Raises EHRbaseError on failure with full context for auditing.
+
+        Connection errors, timeouts and 5xx responses count as failures for the
+        circuit breaker; while the circuit is open this raises immediately
+        with status 503 without contacting EHRbase.
         """
+        template = path_template(path)
+        if not self.circuit.allow_request():
+            metrics.EHRBASE_RESPONSES.inc(method=method, path=template, status='circuit_open')
+            logger.warning(f"EHRbase circuit open; rejecting {method} {path} without calling upstream")
+            raise EHRbaseError(
+                f"EHRbase is unavailable (circuit open, retry in {self.circuit.retry_after():.0f}s).",
+                status_code=503
+            )
+
         url = f"{self.base_url}{path}"
+        start = time.perf_counter()
         try:
-            response = self.session.request(method, url, timeout=30, **kwargs)
-            if response.status_code >= 400:
-                error_body = response.text
-                logger.error(
-                    f"EHRbase API error: {method} {path} -> {response.status_code}: {error_body}"
-                )
-                raise EHRbaseError(
-                    f"EHRbase returned {response.status_code}: {error_body}",
-                    status_code=response.status_code,
-                    response_body=error_body
-                )
-            return response
+            with profiling.stage('upstream'):
+                response = self.session.request(method, url, timeout=30, **kwargs)
         except requests.exceptions.ConnectionError:
+            self._record_outcome(method, template, start, 'connection_error', failed=True)
             logger.critical(f"Cannot connect to EHRbase at {self.base_url}")
             raise EHRbaseError(
                 "Cannot connect to EHRbase. Is the Docker container running?",
                 status_code=503
             )
         except requests.exceptions.Timeout:
+            self._record_outcome(method, template, start, 'timeout', failed=True)
             logger.error(f"EHRbase request timed out: {method} {path}")
             raise EHRbaseError("EHRbase request timed out.", status_code=504)
+        except requests.exceptions.RequestException as e:
+            self._record_outcome(method, template, start, 'error', failed=True)
+            logger.error(f"EHRbase request failed: {method} {path}: {e}")
+            raise EHRbaseError(f"EHRbase request failed: {e}", status_code=502)
+
+        self._record_outcome(
+            method, template, start, response.status_code,
+            failed=response.status_code >= 500
+        )
+
+        if response.status_code >= 400:
+            error_body = response.text
+            logger.error(
+                f"EHRbase API error: {method} {path} -> {response.status_code}: {error_body}"
+            )
+            raise EHRbaseError(
+                f"EHRbase returned {response.status_code}: {error_body}",
+                status_code=response.status_code,
+                response_body=error_body
+            )
+        return response
+
+    def _record_outcome(self, method, template, start, status, failed):
+        """Feed one upstream call into the circuit breaker and the metrics."""
+        if failed:
+            self.circuit.record_failure()
+        else:
+            self.circuit.record_success()
+        metrics.EHRBASE_LATENCY.observe(time.perf_counter() - start, method=method, path=template)
+        metrics.EHRBASE_RESPONSES.inc(method=method, path=template, status=status)
+        metrics.EHRBASE_CIRCUIT_OPEN.set(0 if self.circuit.state == self.circuit.CLOSED else 1)
+
+    def get_stale(self, *key):
+        """
+        Return the last successfully fetched payload for a read key, or None.
+
+        Keys: ('list_templates',) and ('web_template', template_id).
+        Used by read endpoints to serve stale data while EHRbase is down.
+        """
+        return self._last_good.get(key)
+
+    def forget_web_template(self, template_id):
+        """Drop the last good copy of a web template (it was re-uploaded or its archetypes changed)."""
+        self._last_good.pop(('web_template', template_id))
 
     # ─── Template Management ──────────────────────────────────────────
 
@@ -85,9 +204,13 @@ class EHRbaseClient:
         Returns:
             list[dict]: Each dict has 'template_id', 'concept', 'archetype_id', 'created_timestamp'
         """
+        return self._single_flight.do(('list_templates',), self._fetch_templates)
+
+    def _fetch_templates(self):
         response = self._request('GET', '/rest/openehr/v1/definition/template/adl1.4')
         templates = response.json()
         logger.info(f"Retrieved {len(templates)} templates from EHRbase")
+        self._last_good.put(('list_templates',), templates)
         return templates
 
     def get_web_template(self, template_id):
@@ -99,8 +222,11 @@ class EHRbaseClient:
             template_id: The template identifier (e.g., 'blood_pressure')
 
         Returns:
-            dict: The Web Template JSON
+            dict: The Web Template JSON (shared between coalesced callers; do not mutate)
         """
+        return self._single_flight.do(('web_template', template_id), self._fetch_web_template, template_id)
+
+    def _fetch_web_template(self, template_id):
         response = self._request(
             'GET',
             f'/rest/ecis/v1/template/{template_id}',
@@ -108,6 +234,7 @@ class EHRbaseClient:
         )
         web_template = response.json()
         logger.info(f"Retrieved web template for '{template_id}'")
+        self._last_good.put(('web_template', template_id), web_template)
         return web_template
 
     def upload_template(self, opt_xml_content):
@@ -140,16 +267,85 @@ class EHRbaseClient:
 
         SAFETY: Every patient MUST have exactly one EHR. This method checks
         the PostgreSQL mapping if an EHR already exists before creating a new one.
+        Concurrent calls for the same subject are coalesced in-process, and the
+        check-create-save sequence runs under a Postgres advisory lock so that
+        other worker processes cannot race it either. If no pooled connection
+        is free for the lock, it raises EHRbaseError with status 503. If the
+        mapping is lost after the EHR was created, the link is retried
+        outside the lock and the EHR id is logged at AUDIT level.
         """
-        # First check persistent Postgres mapping for existing EHR
-        from db import get_ehr_id_for_patient, save_patient_ehr_link
-        
+        return self._single_flight.do(('create_ehr', subject_id), self._create_ehr, subject_id)
+
+    def _create_ehr(self, subject_id):
+        import psycopg2
+        from db import get_ehr_id_for_patient, save_patient_ehr_link, patient_advisory_lock
+
+        # Fast path: check persistent Postgres mapping for existing EHR without locking
         existing_ehr_id = get_ehr_id_for_patient(subject_id)
         if existing_ehr_id:
             logger.info(f"EHR already exists in Postgres for subject {subject_id}: {existing_ehr_id}")
             return {'ehr_id': {'value': str(existing_ehr_id)}}
 
-        # Create a new blank EHR
+        result = None
+        locked = linked = False
+        try:
+            with patient_advisory_lock(subject_id) as conn:
+                locked = conn is not None
+                # Re-check under the lock: another worker may have just created it
+                existing_ehr_id = get_ehr_id_for_patient(subject_id, conn=conn)
+                if existing_ehr_id:
+                    logger.info(f"EHR created concurrently for subject {subject_id}: {existing_ehr_id}")
+                    return {'ehr_id': {'value': str(existing_ehr_id)}}
+
+                result = self._post_ehr()
+                ehr_id = result.get('ehr_id', {}).get('value', 'unknown')
+
+                # Store the patient-to-EHR mapping persistently in PostgreSQL
+                # (same transaction as the lock, so it is visible before the lock is released)
+                if ehr_id != 'unknown':
+                    linked = save_patient_ehr_link(subject_id, ehr_id, conn=conn)
+                    if not linked:
+                        logger.error(f"Failed to persist EHR link for {subject_id} to {ehr_id}")
+        except psycopg2.Error as e:
+            if result is None:
+                # Every pooled connection is checked out (or PostgreSQL is unreachable);
+                # the lock is held across the EHRbase POST, so this happens under load
+                logger.error(f"Could not take the patient mapping lock for {subject_id}: {e}")
+                raise EHRbaseError("Patient mapping database is busy", status_code=503)
+            # The EHR exists in EHRbase, but the transaction holding its mapping did not commit
+            logger.error(f"Mapping transaction for subject {subject_id} failed after creating EHR {ehr_id}: {e}")
+            linked = False
+
+        if locked and ehr_id != 'unknown' and not linked:
+            return self._relink_ehr(subject_id, ehr_id, result)
+
+        logger.info(f"Created new EHR for subject {subject_id}: {ehr_id}")
+        return result
+
+    def _relink_ehr(self, subject_id, ehr_id, result):
+        """
+        Retry the mapping of a created EHR outside the lock, never overwriting
+        a mapping saved meanwhile. An EHR left unmapped is logged for cleanup.
+        """
+        from db import get_ehr_id_for_patient, save_patient_ehr_links
+
+        logger.error(f"AUDIT: EHR {ehr_id} was created for subject {subject_id} without a saved mapping; "
+                     f"retrying the link")
+        inserted = save_patient_ehr_links([(subject_id, ehr_id)])
+        if inserted is None:
+            logger.error(f"AUDIT: EHR {ehr_id} for subject {subject_id} is orphaned: the mapping could not be saved")
+            return result
+        if subject_id not in inserted:
+            mapped = get_ehr_id_for_patient(subject_id)
+            logger.error(f"AUDIT: EHR {ehr_id} is orphaned: subject {subject_id} was mapped to {mapped} meanwhile")
+            if mapped:
+                return {'ehr_id': {'value': str(mapped)}}
+            return result
+        logger.info(f"AUDIT: Linked EHR {ehr_id} to subject {subject_id} on retry")
+        return result
+
+    def _post_ehr(self):
+        """Create a new blank EHR in EHRbase (no mapping bookkeeping)."""
         response = self._request(
             'POST',
             '/rest/openehr/v1/ehr',
@@ -158,18 +354,93 @@ class EHRbaseClient:
                 'Prefer': 'return=representation'
             }
         )
+        return response.json()
 
-        result = response.json()
-        ehr_id = result.get('ehr_id', {}).get('value', 'unknown')
+    def bulk_create_ehrs(self, subject_ids, chunk_size=200, max_workers=8, progress=None):
+        """
+        Ensure every subject has an EHR, creating the missing ones in bulk.
 
-        # Store the patient-to-EHR mapping persistently in PostgreSQL
-        if ehr_id != 'unknown':
-            success = save_patient_ehr_link(subject_id, ehr_id)
-            if not success:
-                logger.error(f"Failed to persist EHR link for {subject_id} to {ehr_id}")
+        Per chunk: one `= ANY` lookup in patient_mapping, then (under advisory
+        locks for the missing subjects, the same locks create_ehr takes) a
+        re-check, concurrent EHR creation on a bounded pool, and one multi-row
+        insert of the new links. Existing mappings are skipped, so re-running
+        with the same list resumes an interrupted run.
 
-        logger.info(f"Created new EHR for subject {subject_id}: {ehr_id}")
-        return result
+        Args:
+            subject_ids: Patient ids (duplicates are ignored)
+            chunk_size: Patients per lookup/lock/insert transaction
+            max_workers: Concurrent EHR creations against EHRbase
+            progress: Optional callable(summary) invoked after every chunk
+
+        Returns:
+            dict: {'total', 'processed', 'existing', 'created', 'ehr_ids': {patient_id: ehr_id},
+                   'failed': {patient_id: error}}
+        """
+        from psycopg2 import OperationalError, pool as db_pool
+        from db import get_ehr_ids_for_patients, save_patient_ehr_links, patient_advisory_locks
+
+        subject_ids = list(dict.fromkeys(subject_ids))
+        summary = {
+            'total': len(subject_ids), 'processed': 0, 'existing': 0, 'created': 0,
+            'ehr_ids': {}, 'failed': {},
+        }
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ehr-bulk') as pool:
+            for start in range(0, len(subject_ids), chunk_size):
+                chunk = subject_ids[start:start + chunk_size]
+                existing = get_ehr_ids_for_patients(chunk)
+                if existing is None:
+                    raise EHRbaseError("Patient mapping database is unavailable", status_code=503)
+
+                missing = [pid for pid in chunk if pid not in existing]
+                if missing:
+                    try:
+                        with patient_advisory_locks(missing) as conn:
+                            if conn is None:
+                                raise EHRbaseError("Patient mapping database is unavailable", status_code=503)
+                            # Re-check under the locks: single creates may have raced us
+                            existing.update(get_ehr_ids_for_patients(missing, conn=conn) or {})
+                            missing = [pid for pid in missing if pid not in existing]
+
+                            created = self._post_ehrs(pool, missing, summary['failed'])
+                            inserted = save_patient_ehr_links(list(created.items()), conn=conn)
+                            if inserted is None:
+                                logger.error(f"Failed to persist {len(created)} bulk EHR links; "
+                                             f"EHRs were created without a mapping: {list(created.values())}")
+                                raise EHRbaseError("Failed to save patient-EHR links", status_code=503)
+                    except (db_pool.PoolError, OperationalError) as e:
+                        # No pooled connection free for the locks, or PostgreSQL went away
+                        logger.error(f"Could not take the patient mapping locks for a bulk chunk: {e}")
+                        raise EHRbaseError("Patient mapping database is busy", status_code=503)
+
+                    summary['created'] += len(created)
+                    summary['ehr_ids'].update(created)
+
+                summary['existing'] += len(existing)
+                summary['ehr_ids'].update(existing)
+                summary['processed'] += len(chunk)
+                logger.info(f"Bulk EHR provisioning: {summary['processed']}/{summary['total']} "
+                            f"({summary['created']} created, {len(summary['failed'])} failed)")
+                if progress:
+                    progress(summary)
+
+        return summary
+
+    def _post_ehrs(self, pool, subject_ids, failed):
+        """Create one EHR per subject concurrently; returns {subject_id: ehr_id}, errors go to failed."""
+        futures = {pid: pool.submit(self._post_ehr) for pid in subject_ids}
+        created = {}
+        for pid, future in futures.items():
+            try:
+                ehr_id = future.result().get('ehr_id', {}).get('value')
+            except EHRbaseError as e:
+                failed[pid] = str(e)
+                continue
+            if ehr_id:
+                created[pid] = ehr_id
+            else:
+                failed[pid] = 'EHRbase returned no ehr_id'
+        return created
 
     def get_ehr_by_subject(self, subject_id, subject_namespace='default'):
         """
@@ -187,6 +458,44 @@ class EHRbaseClient:
                 return None
         return None
 
+    def lookup_ehrs_by_subjects(self, subject_ids, verify=False, max_workers=8):
+        """
+        Batch version of get_ehr_by_subject: resolve many subjects with one
+        `= ANY` query on the Postgres mapping.
+
+        Args:
+            subject_ids: Patient ids
+            verify: Also confirm each mapped EHR exists in EHRbase (concurrent get_ehr calls)
+            max_workers: Concurrent verification requests
+
+        Returns:
+            dict: {'ehr_ids': {subject_id: ehr_id}, 'missing': [subject ids without an EHR],
+                   'unverified': {subject_id: error}} ('unverified' only when verify=True)
+        """
+        from db import get_ehr_ids_for_patients
+
+        subject_ids = list(dict.fromkeys(subject_ids))
+        ehr_ids = get_ehr_ids_for_patients(subject_ids)
+        if ehr_ids is None:
+            raise EHRbaseError("Patient mapping database is unavailable", status_code=503)
+        result = {'ehr_ids': ehr_ids, 'missing': [pid for pid in subject_ids if pid not in ehr_ids]}
+
+        if verify and ehr_ids:
+            result['unverified'] = {}
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ehr-verify') as pool:
+                futures = {pid: pool.submit(self.get_ehr, ehr_id) for pid, ehr_id in ehr_ids.items()}
+                for pid, future in futures.items():
+                    try:
+                        future.result()
+                    except EHRbaseError as e:
+                        if e.status_code == 404:
+                            logger.error(f"EHR mapping exists in DB but EHR not found in CDR for {pid}: {e}")
+                            del ehr_ids[pid]
+                            result['missing'].append(pid)
+                        else:
+                            result['unverified'][pid] = str(e)
+        return result
+
     def get_ehr(self, ehr_id):
         """
         Get an EHR by its ID.
@@ -197,6 +506,9 @@ class EHRbaseClient:
         Returns:
             dict: The EHR object
         """
+        return self._single_flight.do(('get_ehr', ehr_id), self._fetch_ehr, ehr_id)
+
+    def _fetch_ehr(self, ehr_id):
         response = self._request('GET', f'/rest/openehr/v1/ehr/{ehr_id}')
         return response.json()
 
@@ -281,7 +593,8 @@ class EHRbaseClient:
             flat_json['ctx/time'] = datetime.utcnow().isoformat() + 'Z'
 
         # Clean the flat JSON: remove empty values and orphaned coded text sub-paths
-        flat_json = self._clean_flat_json(flat_json)
+        with profiling.stage('clean'):
+            flat_json = self._clean_flat_json(flat_json)
 
         logger.info(
             f"AUDIT: Submitting composition for EHR={ehr_id}, template={template_id}, "
@@ -318,9 +631,35 @@ class EHRbaseClient:
             composition_uid: The composition UID
             fmt: Format - 'FLAT', 'RAW', 'STRUCTURED'
 
+        Versioned uids ('<uuid>::<system>::<version>') are immutable and are
+        served from the composition caches after the first fetch. The caches
+        are keyed by EHR as well, so a cached composition is only ever served
+        for the EHR it was fetched under.
+
         Returns:
             dict: The composition data
         """
+        if not is_versioned_uid(composition_uid):
+            return self._fetch_composition(ehr_id, composition_uid, fmt)
+
+        key = (ehr_id, composition_uid, fmt)
+        cached = self._compositions.get(key)
+        if cached is None and self._composition_disk is not None:
+            cached = self._composition_disk.get(key)
+            if cached is not None:
+                self._compositions.put(key, cached)
+        if cached is not None:
+            return cached
+
+        composition = self._single_flight.do(
+            ('get_composition',) + key, self._fetch_composition, ehr_id, composition_uid, fmt
+        )
+        self._compositions.put(key, composition)
+        if self._composition_disk is not None:
+            self._composition_disk.put(key, composition)
+        return composition
+
+    def _fetch_composition(self, ehr_id, composition_uid, fmt):
         response = self._request(
             'GET',
             f'/rest/ecis/v1/composition/{composition_uid}',
@@ -357,6 +696,41 @@ class EHRbaseClient:
         logger.info(f"AQL query returned {row_count} rows")
         return result
 
+    def iter_aql_pages(self, aql_query, query_params=None, page_size=1000):
+        """
+        Execute an AQL query page by page, using EHRbase's offset/fetch paging.
+
+        Only one page is held in memory at a time. Add an ORDER BY to the query
+        for a stable order across pages; the query itself must not contain
+        LIMIT/OFFSET (paging is applied by this method).
+
+        Args:
+            aql_query: The AQL query string
+            query_params: Optional dict of named query parameters
+            page_size: Rows requested per EHRbase round trip
+
+        Yields:
+            dict: One result page with 'columns' and 'rows'. Iteration stops
+                  after the first page shorter than page_size.
+        """
+        offset = 0
+        while True:
+            body = {"q": aql_query, "offset": offset, "fetch": page_size}
+            if query_params:
+                body["query_parameters"] = query_params
+
+            response = self._request(
+                'POST',
+                '/rest/openehr/v1/query/aql',
+                json=body
+            )
+            page = response.json()
+            rows = page.get('rows') or []
+            yield page
+            if len(rows) < page_size:
+                return
+            offset += len(rows)
+
     # ─── Health Check ─────────────────────────────────────────────────
 
     def health_check(self):
@@ -378,6 +752,7 @@ class EHRbaseClient:
             return {
                 'status': 'unhealthy',
                 'ehrbase_url': self.base_url,
+                'circuit': self.circuit.state,
                 'error': str(e),
                 'timestamp': datetime.utcnow().isoformat() + 'Z'
             }
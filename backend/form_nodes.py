@@ -0,0 +1,104 @@
+"""
+Compact Form Node Model
+
+Parsed archetype forms used to be nested dicts: every field repeated the same
+string keys ('label', 'name', 'type', 'children', ...) and its own copy of
+each at-code and label. Holding thousands of parsed archetypes that way costs
+far more memory than the data itself.
+
+FormNode stores the same information in a `__slots__` object (no per-node
+dict). At-codes, type names, units and labels are interned, so a string such
+as 'at0004' or 'Comment' exists once per process. Coded-text options are
+stored as (value, label) tuples.
+
+Nodes are converted to the familiar JSON dict shape only at the response
+boundary, with to_dict(); the output is identical to the old parser dicts.
+"""
+
+import sys
+
+_intern = sys.intern
+
+
+def intern_text(value):
+    """Intern a string (None and non-strings pass through unchanged)."""
+    return _intern(value) if isinstance(value, str) else value
+
+
+class FormNode:
+    """
+    One form field (or cluster) parsed from an archetype definition.
+
+    Only `label`, `name` and `type` are always present; the optional
+    attributes are None when not applicable and are omitted by to_dict(),
+    except `units`, where an explicit None is kept (see has_units).
+    """
+
+    __slots__ = ('label', 'name', 'type', 'rm_type', 'units', 'has_units',
+                 'step', 'default', 'allows', 'options', 'children')
+
+    def __init__(self, label, name, type=None):
+        self.label = intern_text(label)
+        self.name = intern_text(name)
+        self.type = intern_text(type)
+        self.rm_type = None
+        self.units = None
+        self.has_units = False
+        self.step = None
+        self.default = None
+        self.allows = None
+        self.options = None
+        self.children = None
+
+    def set_units(self, units):
+        self.units = intern_text(units)
+        self.has_units = True
+
+    def add_option(self, value, label):
+        if self.options is None:
+            self.options = []
+        self.options.append((intern_text(value), intern_text(label)))
+
+    def add_child(self, child):
+        if self.children is None:
+            self.children = []
+        self.children.append(child)
+
+    def compact(self):
+        """Shrink growable lists to tuples once parsing is finished (recursively)."""
+        if self.options is not None:
+            self.options = tuple(self.options)
+        if self.children is not None:
+            for child in self.children:
+                child.compact()
+            self.children = tuple(self.children)
+        return self
+
+    def to_dict(self):
+        """The JSON-ready dict for this node and its subtree."""
+        out = {'label': self.label, 'name': self.name}
+        if self.rm_type is not None:
+            out['rm_type'] = self.rm_type
+        if self.type is not None:
+            out['type'] = self.type
+        if self.has_units:
+            out['units'] = self.units
+        if self.step is not None:
+            out['step'] = self.step
+        if self.default is not None:
+            out['default'] = self.default
+        if self.options is not None:
+            out['options'] = [{'value': value, 'label': label} for value, label in self.options]
+        if self.allows is not None:
+            out['allows'] = self.allows
+        if self.children is not None:
+            out['children'] = [child.to_dict() for child in self.children]
+        return out
+
+    def __repr__(self):
+        return f"FormNode({self.name!r}, {self.type!r}, label={self.label!r})"
+
+
+def to_dicts(nodes):
+    """Convert a list of FormNodes to JSON-ready dicts."""
+    return [node.to_dict() for node in nodes]
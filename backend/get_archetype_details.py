@@ -1,53 +1,35 @@
 import xml.etree.ElementTree as ET
 import os
 
+from term_store import load_ontology
+from form_nodes import FormNode, intern_text, to_dicts
+
 # This namespace is critical. The XMLs use it.
 NAMESPACES = {'openEHR': 'http://schemas.openehr.org/v1'}
 
 
-def build_ontology_map(root):
+def build_ontology_map(root, language=None, source=None):
     """
-    Creates a dictionary mapping 'at' codes (e.g., 'at0001') to their
-    human-readable text from the <ontology> section.
+    Returns the archetype's 'at' codes (e.g., 'at0001') mapped to their
+    human-readable text from the <ontology> section, as a dict-like
+    term_store.Ontology backed by the shared, interned term store.
+    `language` defaults to ARCHETYPE_LANGUAGE ('en'), falling back to the
+    first <term_definitions>; other languages load lazily from `source`.
     """
-    ontology_map = {}
     try:
-        # Find the 'en' language term definitions
-        # You could make 'en' a variable if you need to support other languages
-        term_definitions = root.find(
-            ".//openEHR:ontology/openEHR:term_definitions/[openEHR:language/openEHR:code_string='en']",
-            NAMESPACES
-        )
-
-        # Fallback if 'en' isn't found
-        if term_definitions is None:
-            term_definitions = root.find('.//openEHR:ontology/openEHR:term_definitions', NAMESPACES)
-
-        if term_definitions is None:
+        ontology = load_ontology(root, language, source)
+        if not ontology and not ontology.languages:
             print("Warning: Could not find <term_definitions> in ontology.")
-            return {}
-
-        # Iterate over all <items code="...">
-        for item in term_definitions.findall('openEHR:items', NAMESPACES):
-            code = item.get('code')
-            if not code:
-                continue
-
-            # Find the <items id="text"> child for the label
-            text_item = item.find('openEHR:items[@id="text"]', NAMESPACES)
-            if text_item is not None and text_item.text:
-                ontology_map[code] = text_item.text.strip()
-
+        return ontology
     except Exception as e:
         print(f"Error building ontology map: {e}")
-
-    return ontology_map
+        return {}
 
 
 def get_form_field(child, ontology_map):
     """
     Parses a single <children> element from the <definition> and
-    translates it into a form field dictionary.
+    translates it into a FormNode (see form_nodes.py).
     """
     node_id = child.find('openEHR:node_id', NAMESPACES).text
     rm_type = child.find('openEHR:rm_type_name', NAMESPACES).text
@@ -55,37 +37,37 @@ def get_form_field(child, ontology_map):
     # Get the human-readable label from our map
     field_label = ontology_map.get(node_id, node_id)  # Default to node_id if not found
 
-    field = {'label': field_label, 'name': node_id}
+    field = FormNode(field_label, node_id)
 
     # Determine input type based on rm_type_name
     if rm_type == 'DV_TEXT':
-        field['type'] = 'text'
+        field.type = 'text'
 
     elif rm_type == 'DV_QUANTITY':
-        field['type'] = 'number'
+        field.type = 'number'
         try:
             # Try to find defined units
             units = child.find('.//openEHR:units', NAMESPACES).text
-            field['units'] = units
+            field.set_units(units)
         except AttributeError:
-            field['units'] = None
+            field.set_units(None)
 
     elif rm_type == 'DV_DATE_TIME':
-        field['type'] = 'datetime-local'
+        field.type = 'datetime-local'
 
     elif rm_type == 'DV_DATE':
-        field['type'] = 'date'
+        field.type = 'date'
 
     elif rm_type == 'DV_COUNT':
-        field['type'] = 'number'
-        field['step'] = '1'  # Integer only
+        field.type = 'number'
+        field.step = '1'  # Integer only
 
     elif rm_type == 'DV_BOOLEAN':
-        field['type'] = 'checkbox'
+        field.type = 'checkbox'
 
     elif rm_type == 'DV_CODED_TEXT':
-        field['type'] = 'select'  # Dropdown
-        field['options'] = []
+        field.type = 'select'  # Dropdown
+        field.options = []
         try:
             # Find all the <code_list> items
             code_list = child.findall('.//openEHR:code_list', NAMESPACES)
@@ -93,23 +75,23 @@ def get_form_field(child, ontology_map):
                 code_val = code_item.text
                 # Look up the human-readable text for this option
                 option_label = ontology_map.get(code_val, code_val)
-                field['options'].append({'value': code_val, 'label': option_label})
+                field.add_option(code_val, option_label)
         except Exception as e:
             print(f"Warning: Could not parse options for {node_id}: {e}")
 
     elif rm_type == 'ARCHETYPE_SLOT':
         # This is a placeholder for another *entire* archetype.
         # We'll just mark it as a 'slot' for now.
-        field['type'] = 'slot'
+        field.type = 'slot'
         try:
-            field['allows'] = child.find('.//openEHR:includes/openEHR:string_expression', NAMESPACES).text
+            field.allows = child.find('.//openEHR:includes/openEHR:string_expression', NAMESPACES).text
         except AttributeError:
-            field['allows'] = 'any'
+            field.allows = 'any'
 
     else:
-        field['type'] = rm_type  # Default to the RM type if unhandled
+        field.type = intern_text(rm_type)  # Default to the RM type if unhandled
 
-    return field
+    return field.compact()
 
 
 def get_archetype_details(archetype_name):
@@ -133,7 +115,7 @@ def get_archetype_details(archetype_name):
         root = tree.getroot()
 
         # 1. Build the dictionary of all human-readable names
-        ontology_map = build_ontology_map(root)
+        ontology_map = build_ontology_map(root, source=xml_file_path)
         if not ontology_map:
             print(f"Could not build ontology for {safe_name}. Labels may be missing.")
 
@@ -159,8 +141,8 @@ def get_archetype_details(archetype_name):
                 except Exception as e:
                     print(f"Error parsing a child node: {e}")
 
-        # Return the complete list of form fields
-        return {'form_fields': form_fields}
+        # Return the complete list of form fields (converted to dicts only here)
+        return {'form_fields': to_dicts(form_fields)}
 
     except ET.ParseError as e:
         return {'error': f"Error parsing XML file {safe_name}: {e}"}
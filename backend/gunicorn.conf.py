@@ -0,0 +1,91 @@
+"""
+Gunicorn Configuration (production serving)
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Pre-fork workers with the application preloaded in the master (see wsgi.py):
+start-up and cache warm-up run once, and workers share the warmed caches
+copy-on-write. With GUNICORN_THREADS > 1 each worker is a threaded (gthread)
+worker.
+
+Graceful reload: `kill -HUP <master pid>` starts fresh workers and lets the
+old ones finish their in-flight requests (up to GUNICORN_GRACEFUL_TIMEOUT)
+before stopping. Fresh workers are forked from the preloaded master, so they
+pick up configuration changes and new catalog snapshot generations, not new
+code. To deploy new code without dropping requests, send USR2 (starts a
+new master), then WINCH and QUIT to the old one.
+
+Per-worker state: every worker has its own caches. A template uploaded
+with upload_templates.py reaches the workers through a shared invalidation
+log (see template_invalidations.py), set here to a file per master unless
+TEMPLATE_INVALIDATION_LOG is configured (configure a fixed path so that the
+upload script can find it). With ARCHETYPE_WATCH, each worker runs its own
+catalog watcher (started in post_fork); with OPT_AUTO_UPLOAD as well, every
+worker uploads a changed OPT, and all but the first get a logged 409 from
+EHRbase. Metrics are not aggregated either: /metrics reports the answering
+worker's registry only (see metrics.py).
+
+Configuration:
+    GUNICORN_BIND               address to listen on (default 0.0.0.0:$FLASK_PORT, port 9000)
+    GUNICORN_WORKERS            worker processes (default 2 x CPUs + 1)
+    GUNICORN_THREADS            threads per worker (default 4)
+    GUNICORN_TIMEOUT            seconds before a silent worker is restarted (default 60)
+    GUNICORN_GRACEFUL_TIMEOUT   seconds workers get to finish on reload/stop (default 30)
+    GUNICORN_MAX_REQUESTS       restart a worker after this many requests, 0 = never (default 0)
+"""
+
+import os
+import tempfile
+import multiprocessing
+
+bind = os.getenv('GUNICORN_BIND', f"0.0.0.0:{os.getenv('FLASK_PORT', '9000')}")
+# Metrics are per worker (see metrics.py): each /metrics scrape shows the
+# counters and histograms of whichever worker answered it, not the totals
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+
+# Import the app (start-up + warm-up) once in the master, then fork
+preload_app = True
+
+accesslog = '-'
+errorlog = '-'
+
+# Read by template_invalidations when the app is preloaded, so set before that
+_default_invalidation_log = os.path.join(tempfile.gettempdir(), f'openehr-template-invalidations-{os.getpid()}.log')
+if not os.getenv('TEMPLATE_INVALIDATION_LOG'):
+    os.environ['TEMPLATE_INVALIDATION_LOG'] = _default_invalidation_log
+
+WATCH = os.getenv('ARCHETYPE_WATCH', 'false').lower() == 'true'
+
+
+def post_fork(server, worker):
+    # Inherited services were already dropped or given new connections by
+    # services.reset_after_fork (os.register_at_fork); each worker opens its
+    # own DB pool and EHRbase session on first use.
+    server.log.info(f"Worker {worker.pid} forked")
+    if WATCH:
+        # Each worker has its own catalog, so each runs its own watcher
+        import backend
+        import catalog_watcher
+        catalog_watcher.start(upload=backend.ehrbase.upload_template)
+
+
+def worker_exit(server, worker):
+    if WATCH:
+        import catalog_watcher
+        catalog_watcher.stop()
+    import services
+    services.shutdown()
+
+
+def on_exit(server):
+    if os.environ.get('TEMPLATE_INVALIDATION_LOG') == _default_invalidation_log:
+        try:
+            os.remove(_default_invalidation_log)
+        except OSError:
+            pass
@@ -0,0 +1,285 @@
+"""
+Metrics Registry (Prometheus Text Format)
+
+A small, dependency-free metrics subsystem. Modules record measurements into
+the module-level metrics below; backend.py exposes them at GET /metrics in the
+Prometheus text exposition format (version 0.0.4).
+
+Recorded metrics:
+- http_request_duration_seconds   per Flask route (url rule) and method
+- http_responses_total            per route, method and status code
+- ehrbase_request_duration_seconds per EHRbase method and path template
+- ehrbase_responses_total         per EHRbase method, path template and status
+- ehrbase_coalesced_calls_total   callers served by a shared single-flight call
+- ehrbase_circuit_open            1 while the EHRbase circuit breaker is open
+- db_pool_checkout_seconds        time to obtain a connection from db.py's pool
+- db_pool_checkout_failures_total failed pool checkouts
+- db_pool_exhausted_total         checkouts refused because every connection was in use
+- db_pool_connections_in_use      connections currently checked out
+- cache_lookups_total             hits/misses of every LRUCache, by cache name
+
+Metrics live in the memory of one process. Under gunicorn (see
+gunicorn.conf.py) every worker keeps its own registry and a scrape is
+answered by whichever worker accepts it, so /metrics shows one worker's
+counts, not totals across workers, and its series reset when that worker
+is restarted. There is no cross-worker aggregation; run with
+GUNICORN_WORKERS=1 where exact counts matter.
+
+SAFETY NOTE: Labels never contain patient identifiers or EHR ids — only route
+rules and path templates.
+"""
+
+import time
+import threading
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base class: a named metric with a fixed set of label names."""
+    type_name = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A monotonically increasing count."""
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    """Cumulative latency histogram with fixed upper bounds (seconds)."""
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label key -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager observing the elapsed wall time of its body."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        lines = []
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class _CacheCollector:
+    """Reports hit/miss counters of every live LRUCache, summed by cache name."""
+
+    def __init__(self):
+        self._caches = weakref.WeakSet()
+
+    def track(self, cache):
+        self._caches.add(cache)
+
+    def render(self):
+        totals = {}
+        for cache in list(self._caches):
+            hits, misses = totals.get(cache.name, (0, 0))
+            totals[cache.name] = (hits + cache.hits, misses + cache.misses)
+        lines = [
+            "# HELP cache_lookups_total In-process cache lookups by cache name and result.",
+            "# TYPE cache_lookups_total counter",
+        ]
+        for name in sorted(totals):
+            hits, misses = totals[name]
+            lines.append(f'cache_lookups_total{{cache="{_escape(name)}",result="hit"}} {hits}')
+            lines.append(f'cache_lookups_total{{cache="{_escape(name)}",result="miss"}} {misses}')
+        return lines
+
+
+class Registry:
+    """Holds every metric and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+        self.caches = _CacheCollector()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        lines.extend(self.caches.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def track_cache(cache):
+    """Include an LRUCache's hit/miss counters in the /metrics output."""
+    REGISTRY.caches.track(cache)
+
+
+def render():
+    """Render every registered metric in the Prometheus text format."""
+    return REGISTRY.render()
+
+
+# ─── Backend Metrics ──────────────────────────────────────────────────
+
+HTTP_LATENCY = Histogram(
+    'http_request_duration_seconds',
+    'Flask request latency by route and method.',
+    ('route', 'method'),
+)
+HTTP_RESPONSES = Counter(
+    'http_responses_total',
+    'Flask responses by route, method and status code.',
+    ('route', 'method', 'status'),
+)
+EHRBASE_LATENCY = Histogram(
+    'ehrbase_request_duration_seconds',
+    'EHRbase request latency by method and path template.',
+    ('method', 'path'),
+)
+EHRBASE_RESPONSES = Counter(
+    'ehrbase_responses_total',
+    'EHRbase responses by method, path template and status (or error kind).',
+    ('method', 'path', 'status'),
+)
+EHRBASE_COALESCED = Counter(
+    'ehrbase_coalesced_calls_total',
+    'Callers that shared an in-flight EHRbase call instead of issuing their own.',
+    ('operation',),
+)
+EHRBASE_CIRCUIT_OPEN = Gauge(
+    'ehrbase_circuit_open',
+    '1 while the EHRbase circuit breaker is open or half-open, else 0.',
+)
+DB_POOL_CHECKOUT = Histogram(
+    'db_pool_checkout_seconds',
+    'Time spent obtaining a PostgreSQL connection from the pool (near zero for an idle '
+    'pooled connection, the connect time for a new one; the pool never waits).',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+DB_POOL_FAILURES = Counter(
+    'db_pool_checkout_failures_total',
+    'PostgreSQL pool checkouts that raised (pool exhausted or connection failure).',
+)
+DB_POOL_EXHAUSTED = Counter(
+    'db_pool_exhausted_total',
+    'PostgreSQL pool checkouts refused because every connection was in use.',
+)
+DB_POOL_IN_USE = Gauge(
+    'db_pool_connections_in_use',
+    'PostgreSQL connections currently checked out of the pool.',
+)
@@ -0,0 +1,291 @@
+"""
+Opt-in Per-Request Profiling
+
+Profiles a sampled fraction of requests (PROFILE_SAMPLE_RATE) or any request
+carrying a valid signed X-Profile-Request header. A profiled request runs
+under cProfile and records named stage timings (validate, sanitize, clean,
+upstream, serialize). Each profile is written to PROFILE_DIR as a pstats
+dump plus a JSON summary; only the newest PROFILE_KEEP profiles are kept.
+
+Only one request per process runs under cProfile at a time (Python 3.12+
+allows a single active profiler). A request profiled while another one is,
+or while some other profiling tool is active, records its stage timings only:
+its summary has no top functions and no pstats dump is written.
+
+When neither a sample rate nor PROFILE_SECRET is configured, no request hooks
+are installed and stage() returns a shared no-op context manager, so the cost
+when disabled is one global flag check per stage.
+
+Signed header format:
+    X-Profile-Request: <unix_timestamp>.<hex HMAC-SHA256(PROFILE_SECRET, unix_timestamp)>
+Signatures are accepted for PROFILE_SIGNATURE_TTL seconds (default 300).
+
+The /api/profiles endpoints are only served to requests signed with
+PROFILE_SECRET; with sampling but no secret, profiles are written to disk only.
+
+SAFETY NOTE: Summaries record the route rule (e.g. /api/ehr/<string:patient_id>),
+never the concrete URL, so no patient identifiers are written to disk.
+"""
+
+import os
+import io
+import hmac
+import json
+import time
+import random
+import pstats
+import hashlib
+import logging
+import cProfile
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-Profile-Request'
+
+ENABLED = False
+SAMPLE_RATE = 0.0
+SECRET = None
+SIGNATURE_TTL = 300
+PROFILE_DIR = None
+KEEP = 50
+
+_NOOP = nullcontext()
+_local = threading.local()
+_write_lock = threading.Lock()
+_profiler_lock = threading.Lock()
+
+
+class _ProfileSession:
+    """Profiler (None for stage timings only) and stage timings for the request on the current thread."""
+
+    def __init__(self, trigger):
+        self.trigger = trigger
+        self.profiler = None
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    def start_profiler(self):
+        """Run this request under cProfile, unless another profiler is active in the process."""
+        if not _profiler_lock.acquire(blocking=False):
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Python 3.12+: another profiling tool (e.g. a debugger) holds the profiler slot
+            _profiler_lock.release()
+            logger.debug(f"Profiling stage timings only: {e}")
+            return
+        self.profiler = profiler
+
+    def stop_profiler(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+            _profiler_lock.release()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - start)
+
+
+def configure():
+    """Read profiling settings from the environment. Returns True if enabled."""
+    global ENABLED, SAMPLE_RATE, SECRET, SIGNATURE_TTL, PROFILE_DIR, KEEP
+    SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0') or 0)
+    SECRET = os.getenv('PROFILE_SECRET') or None
+    SIGNATURE_TTL = int(os.getenv('PROFILE_SIGNATURE_TTL', '300'))
+    PROFILE_DIR = os.getenv(
+        'PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+    )
+    KEEP = int(os.getenv('PROFILE_KEEP', '50'))
+    ENABLED = SAMPLE_RATE > 0 or SECRET is not None
+    return ENABLED
+
+
+def init_app(app):
+    """
+    Install the profiling request hooks on a Flask app if profiling is enabled.
+    Does nothing (zero per-request overhead) when it is not.
+    """
+    if not configure():
+        return False
+
+    from flask import request
+
+    @app.before_request
+    def _start_profile():
+        trigger = _trigger_for(request.headers.get(HEADER))
+        if trigger is None:
+            return
+        session = _ProfileSession(trigger)
+        _local.session = session
+        session.start_profiler()
+
+    @app.after_request
+    def _add_server_timing(response):
+        session = getattr(_local, 'session', None)
+        if session is not None:
+            response.headers['Server-Timing'] = ', '.join(
+                f"{name};dur={seconds * 1000:.1f}" for name, seconds in session.stages.items()
+            )
+        return response
+
+    @app.teardown_request
+    def _finish_profile(exc):
+        session = getattr(_local, 'session', None)
+        if session is None:
+            return
+        _local.session = None
+        session.stop_profiler()
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        try:
+            _write_profile(session, route, request.method, exc)
+        except Exception as e:
+            logger.error(f"Failed to write request profile for {route}: {e}")
+
+    logger.info(
+        f"Request profiling enabled (sample_rate={SAMPLE_RATE}, "
+        f"signed_header={'on' if SECRET else 'off'}, dir={PROFILE_DIR})"
+    )
+    return True
+
+
+def stage(name):
+    """
+    Context manager timing a named stage of the current request.
+    A shared no-op when profiling is disabled or the request is not sampled.
+    """
+    if not ENABLED:
+        return _NOOP
+    session = getattr(_local, 'session', None)
+    if session is None:
+        return _NOOP
+    return session.stage(name)
+
+
+def sign(timestamp=None, secret=None):
+    """Build a valid X-Profile-Request header value (for operators and tests)."""
+    timestamp = str(int(timestamp if timestamp is not None else time.time()))
+    key = (secret or SECRET or '').encode()
+    digest = hmac.new(key, timestamp.encode(), hashlib.sha256).hexdigest()
+    return f"{timestamp}.{digest}"
+
+
+def verify_signature(header_value):
+    """True if header_value is a fresh signature made with PROFILE_SECRET."""
+    if not SECRET or not header_value or '.' not in header_value:
+        return False
+    timestamp, _, digest = header_value.partition('.')
+    try:
+        age = abs(time.time() - int(timestamp))
+    except ValueError:
+        return False
+    if age > SIGNATURE_TTL:
+        return False
+    expected = hmac.new(SECRET.encode(), timestamp.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, digest)
+
+
+def _trigger_for(header_value):
+    """Decide whether to profile this request; returns the trigger name or None."""
+    if header_value and verify_signature(header_value):
+        return 'signed_header'
+    if SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE:
+        return 'sampled'
+    return None
+
+
+def _write_profile(session, route, method, exc):
+    total = time.perf_counter() - session.started
+    top_functions = []
+    if session.profiler is not None:
+        stats_stream = io.StringIO()
+        stats = pstats.Stats(session.profiler, stream=stats_stream)
+        stats.sort_stats('cumulative')
+        for (filename, line, func), (cc, nc, tt, ct, _) in sorted(
+                stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:25]:
+            top_functions.append({
+                'function': f"{os.path.basename(filename)}:{line}({func})",
+                'calls': nc,
+                'total_time_ms': round(tt * 1000, 3),
+                'cumulative_time_ms': round(ct * 1000, 3),
+            })
+
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    slug = ''.join(c if c.isalnum() else '_' for c in route).strip('_') or 'root'
+    base_name = f"{stamp}_{method}_{slug}"
+
+    summary = {
+        'id': base_name,
+        'route': route,
+        'method': method,
+        'trigger': session.trigger,
+        'profiled': session.profiler is not None,
+        'error': type(exc).__name__ if exc else None,
+        'duration_ms': round(total * 1000, 3),
+        'stages_ms': {name: round(seconds * 1000, 3) for name, seconds in session.stages.items()},
+        'top_functions': top_functions,
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+    }
+
+    with _write_lock:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if session.profiler is not None:
+            session.profiler.dump_stats(os.path.join(PROFILE_DIR, base_name + '.prof'))
+        with open(os.path.join(PROFILE_DIR, base_name + '.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        _rotate()
+
+    logger.info(f"Wrote request profile {base_name} ({summary['duration_ms']} ms)")
+
+
+def _rotate():
+    """Keep only the newest KEEP profiles (caller holds _write_lock)."""
+    names = sorted(f[:-5] for f in os.listdir(PROFILE_DIR) if f.endswith('.json'))
+    for stale in names[:-KEEP] if KEEP > 0 else names:
+        for ext in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, stale + ext))
+            except FileNotFoundError:
+                pass
+
+
+def list_summaries(limit=20, route=None):
+    """
+    Return the newest profile summaries (newest first), without top_functions.
+    Optionally filtered to one route rule.
+    """
+    if not PROFILE_DIR or not os.path.isdir(PROFILE_DIR):
+        return []
+    summaries = []
+    for name in sorted((f for f in os.listdir(PROFILE_DIR) if f.endswith('.json')), reverse=True):
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if route and summary.get('route') != route:
+            continue
+        summary.pop('top_functions', None)
+        summaries.append(summary)
+        if len(summaries) >= limit:
+            break
+    return summaries
+
+
+def get_summary(profile_id):
+    """Return one full profile summary (including top functions), or None."""
+    if not PROFILE_DIR or os.path.basename(profile_id) != profile_id:
+        return None
+    path = os.path.join(PROFILE_DIR, profile_id + '.json')
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
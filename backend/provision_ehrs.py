@@ -0,0 +1,88 @@
+"""
+Bulk EHR Provisioning
+
+Ensures every patient in a list has an EHR in EHRbase and a row in
+patient_mapping, using EHRbaseClient.bulk_create_ehrs (batched lookups,
+concurrent creation, multi-row link inserts).
+
+The input is a text file with one patient id per line, or a CSV file
+(use --column to pick the id column). Patients that already have an EHR
+are skipped, so an interrupted run is resumed by running it again.
+
+Usage (from the backend directory):
+    python provision_ehrs.py clinic_patients.csv --column patient_id --out ehr_links.csv
+    python provision_ehrs.py patients.txt --workers 16 --chunk-size 500
+"""
+
+import re
+import csv
+import sys
+import time
+import argparse
+
+from dotenv import load_dotenv
+
+PATIENT_ID_PATTERN = re.compile(r'^[a-zA-Z0-9._-]{1,64}$')
+
+
+def read_patient_ids(path, column=None):
+    """Read patient ids from a plain list or a CSV column, skipping blanks."""
+    with open(path, newline='') as f:
+        if column:
+            return [row[column].strip() for row in csv.DictReader(f) if row.get(column, '').strip()]
+        return [line.strip() for line in f if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='file with patient ids (one per line, or CSV with --column)')
+    parser.add_argument('--column', help='CSV column holding the patient id')
+    parser.add_argument('--out', help='write patient_id,ehr_id links to this CSV')
+    parser.add_argument('--chunk-size', type=int, default=200, help='patients per batch transaction')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent EHR creations')
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    from ehrbase_client import EHRbaseClient, EHRbaseError
+
+    patient_ids = read_patient_ids(args.input, args.column)
+    invalid = [pid for pid in patient_ids if not PATIENT_ID_PATTERN.match(pid)]
+    valid = [pid for pid in patient_ids if PATIENT_ID_PATTERN.match(pid)]
+    if invalid:
+        print(f"⚠️ Skipping {len(invalid)} invalid patient ids (e.g. {invalid[0]!r})")
+
+    started = time.time()
+
+    def report(summary):
+        elapsed = time.time() - started
+        print(f"  {summary['processed']}/{summary['total']} processed "
+              f"({summary['created']} created, {summary['existing']} existing, "
+              f"{len(summary['failed'])} failed) in {elapsed:.1f}s")
+
+    print(f"Provisioning EHRs for {len(valid)} patients...")
+    try:
+        summary = EHRbaseClient().bulk_create_ehrs(
+            valid, chunk_size=args.chunk_size, max_workers=args.workers, progress=report
+        )
+    except EHRbaseError as e:
+        print(f"❌ Provisioning stopped: {e}. Re-run the same command to resume.")
+        return 1
+
+    if args.out:
+        with open(args.out, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['patient_id', 'ehr_id'])
+            writer.writerows(summary['ehr_ids'].items())
+        print(f"Links written to {args.out}")
+
+    for pid, error in summary['failed'].items():
+        print(f"❌ {pid}: {error}")
+
+    print("-" * 30)
+    print(f"Summary: {summary['created']} created, {summary['existing']} already existed, "
+          f"{len(summary['failed'])} failed, {len(invalid)} invalid.")
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+"""
+Resilience Primitives for Upstream Calls
+
+Small, dependency-free building blocks used by the EHRbase client to protect
+the backend (and EHRbase itself) under concurrent load.
+
+- SingleFlight: coalesces concurrent identical calls so that only one of them
+  reaches the upstream service; every other caller waits for and shares the
+  leader's result (or exception).
+- CircuitBreaker: tracks the upstream failure rate and, once it crosses a
+  threshold, rejects calls immediately instead of letting worker threads queue
+  behind connection attempts and timeouts. After a cool-down it lets a few
+  probe calls through (half-open) to detect recovery.
+
+SAFETY NOTE: Shared results are handed to several request threads at once.
+Callers must treat them as read-only.
+"""
+
+import time
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class _InFlightCall:
+    """A single in-progress call that followers can wait on."""
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Per-key call coalescing ("single-flight").
+
+    While a call for a key is in progress, further calls with the same key do
+    not execute the function again; they block until the first call finishes
+    and receive the same result. Once the call completes the key is forgotten,
+    so this is NOT a cache — the next call after completion goes upstream.
+
+    Usage:
+        flight = SingleFlight()
+        web_template = flight.do(('web_template', template_id), fetch, template_id)
+    """
+
+    def __init__(self, on_shared=None):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # Optional callback(key, waiter_count) invoked when a result was shared
+        self._on_shared = on_shared
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Execute fn(*args, **kwargs) once per concurrent group of callers for key.
+
+        Returns:
+            The function's return value (shared between all coalesced callers).
+
+        Raises:
+            Whatever the leader's call raised, re-raised in every follower.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _InFlightCall()
+                self._calls[key] = call
+                is_leader = True
+            else:
+                call.waiters += 1
+                is_leader = False
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            if call.waiters:
+                logger.info(f"Single-flight {key!r}: shared result with {call.waiters} concurrent caller(s)")
+                if self._on_shared:
+                    self._on_shared(key, call.waiters)
+            call.done.set()
+
+    def in_flight(self):
+        """Number of keys currently being fetched."""
+        with self._lock:
+            return len(self._calls)
+
+
+class CircuitBreaker:
+    """
+    Failure-rate circuit breaker with half-open probing.
+
+    States:
+        closed    — calls flow normally; outcomes are recorded in a rolling window.
+        open      — calls are rejected immediately for `reset_timeout` seconds.
+        half_open — up to `half_open_max_calls` probe calls are allowed through.
+                    A successful probe closes the circuit; a failed one re-opens it.
+
+    The circuit opens when, within the last `window` seconds, at least
+    `min_calls` calls were made and the fraction that failed is at least
+    `failure_rate`.
+
+    Usage:
+        if not breaker.allow_request():
+            raise ...  # fail fast
+        try:
+            result = call()
+        except UpstreamDown:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name='upstream', failure_rate=0.5, min_calls=10, window=30.0,
+                 reset_timeout=15.0, half_open_max_calls=1, clock=time.monotonic):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._outcomes = deque()  # (timestamp, succeeded)
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+
+    @property
+    def state(self):
+        """Current state, accounting for an elapsed open period."""
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def allow_request(self):
+        """
+        Decide whether a call may proceed.
+
+        Returns:
+            bool: False if the circuit is open (caller should fail fast).
+        """
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and self._half_open_in_flight < self.half_open_max_calls:
+                self._half_open_in_flight += 1
+                return True
+            return False
+
+    def retry_after(self):
+        """Seconds until the next probe will be allowed (0 if not open)."""
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0
+            return max(0.0, self._opened_at + self.reset_timeout - self._clock())
+
+    def record_success(self):
+        """Record a successful upstream call."""
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                logger.info(f"Circuit '{self.name}' probe succeeded; closing circuit")
+                self._state = self.CLOSED
+                self._half_open_in_flight = 0
+                self._outcomes.clear()
+                return
+            self._record(True)
+
+    def record_failure(self):
+        """Record a failed upstream call (connection error, timeout or 5xx)."""
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                logger.warning(f"Circuit '{self.name}' probe failed; re-opening circuit")
+                self._open()
+                return
+            self._record(False)
+            if self._state == self.CLOSED and self._should_open():
+                logger.critical(
+                    f"Circuit '{self.name}' OPEN: failure rate over the last {self.window:.0f}s "
+                    f"reached {self.failure_rate:.0%}; failing fast for {self.reset_timeout:.0f}s"
+                )
+                self._open()
+
+    def reset(self):
+        """Force the circuit closed and forget recorded outcomes."""
+        with self._lock:
+            self._state = self.CLOSED
+            self._half_open_in_flight = 0
+            self._outcomes.clear()
+
+    # ─── Internal (caller holds self._lock) ───────────────────────────
+
+    def _record(self, succeeded):
+        now = self._clock()
+        self._outcomes.append((now, succeeded))
+        cutoff = now - self.window
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            self._outcomes.popleft()
+
+    def _should_open(self):
+        total = len(self._outcomes)
+        if total < self.min_calls:
+            return False
+        failures = sum(1 for _, ok in self._outcomes if not ok)
+        return failures / total >= self.failure_rate
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = self._clock()
+        self._half_open_in_flight = 0
+        self._outcomes.clear()
+
+    def _maybe_half_open(self):
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            logger.info(f"Circuit '{self.name}' half-open; allowing probe request(s)")
+            self._state = self.HALF_OPEN
+            self._half_open_in_flight = 0
@@ -0,0 +1,319 @@
+"""
+Catalog Search Index
+
+Server-side full-text search over the archetype catalog and the EHRbase
+template list, so clients no longer download either list to filter it in the
+browser.
+
+Documents are indexed by the tokens of their id, name, description
+(purpose / use / keywords) and ontology term texts, each field with its own
+weight. Matching per query token is, in order of preference:
+    exact     the token itself
+    prefix    any indexed token starting with it (>= MIN_PREFIX characters)
+    fuzzy     indexed tokens one edit away (>= MIN_FUZZY characters), found
+              through a deletion-neighbourhood table, never by a vocabulary scan
+Every query token must match; documents are ranked by the summed field
+weights of their best match per token.
+
+The index is incremental: add()/remove() touch only one document's postings,
+and sync() replaces one kind of document ('archetype' or 'template') with a
+new set, re-indexing only what changed. archetype_catalog keeps archetypes
+in sync as it scans; the backend syncs templates whenever it fetches the
+template list.
+
+Configuration:
+    SEARCH_TEMPLATE_SYNC_TTL   seconds before search refreshes the template list (default 60)
+"""
+
+import os
+import re
+import time
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_SYNC_TTL = float(os.getenv('SEARCH_TEMPLATE_SYNC_TTL', '60'))
+
+NS = {'openEHR': 'http://schemas.openehr.org/v1'}
+KINDS = ('archetype', 'template')
+
+# Field weights: a hit in the name outranks one in the id, which outranks
+# one in the description, which outranks one buried in the term list.
+WEIGHTS = {'name': 8, 'id': 5, 'keywords': 4, 'description': 2, 'terms': 1}
+PREFIX_FACTOR = 0.6
+FUZZY_FACTOR = 0.35
+MIN_PREFIX = 2
+MIN_FUZZY = 4
+MAX_PREFIX_EXPANSION = 200
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+_STOPWORDS = frozenset(('a', 'an', 'and', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is',
+                        'it', 'of', 'on', 'or', 'the', 'this', 'to', 'with'))
+
+
+def tokenize(text):
+    """Lower-case alphanumeric tokens of text, without stopwords and 1-letter tokens."""
+    if not text:
+        return []
+    return [token for token in _TOKEN.findall(text.lower()) if len(token) > 1 and token not in _STOPWORDS]
+
+
+def _deletes(token):
+    """All strings one deletion away from token."""
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+class SearchIndex:
+    """
+    Inverted index over catalog documents.
+
+    A document is identified by (kind, id) and carries a `summary` dict that
+    is returned verbatim in results.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = {}     # token -> {doc_key: weight}
+        self._vocabulary = []   # sorted tokens, for prefix ranges
+        self._neighbours = {}   # deletion variant -> {tokens}
+        self._docs = {}         # doc_key -> (signature, summary, {token: weight})
+
+    # ─── Maintenance ──────────────────────────────────────────────────
+
+    def add(self, kind, doc_id, summary, fields, signature=None):
+        """
+        Index (or re-index) one document.
+
+        Args:
+            kind: 'archetype' or 'template'
+            doc_id: Identifier, unique within kind
+            summary: JSON-ready dict returned for hits
+            fields: {field name: text} for the fields in WEIGHTS
+            signature: Optional change marker; re-adding with the same one is a no-op
+        """
+        key = (kind, doc_id)
+        weights = {}
+        for field, text in fields.items():
+            weight = WEIGHTS[field]
+            for token in tokenize(text):
+                if weights.get(token, 0) < weight:
+                    weights[token] = weight
+
+        with self._lock:
+            existing = self._docs.get(key)
+            if existing is not None:
+                if signature is not None and existing[0] == signature:
+                    return False
+                self._unindex(key, existing[2])
+            self._docs[key] = (signature, summary, weights)
+            for token, weight in weights.items():
+                postings = self._postings.get(token)
+                if postings is None:
+                    postings = self._postings[token] = {}
+                    bisect.insort(self._vocabulary, token)
+                    if len(token) >= MIN_FUZZY:
+                        for variant in _deletes(token):
+                            self._neighbours.setdefault(variant, set()).add(token)
+                postings[key] = weight
+        return True
+
+    def remove(self, kind, doc_id):
+        """Drop one document; returns False if it was not indexed."""
+        key = (kind, doc_id)
+        with self._lock:
+            existing = self._docs.pop(key, None)
+            if existing is None:
+                return False
+            self._unindex(key, existing[2])
+            return True
+
+    def _unindex(self, key, weights):
+        for token in weights:
+            postings = self._postings.get(token)
+            if postings is None:
+                continue
+            postings.pop(key, None)
+            if postings:
+                continue
+            del self._postings[token]
+            position = bisect.bisect_left(self._vocabulary, token)
+            if position < len(self._vocabulary) and self._vocabulary[position] == token:
+                del self._vocabulary[position]
+            if len(token) >= MIN_FUZZY:
+                for variant in _deletes(token):
+                    tokens = self._neighbours.get(variant)
+                    if tokens is not None:
+                        tokens.discard(token)
+                        if not tokens:
+                            del self._neighbours[variant]
+
+    def sync(self, kind, documents):
+        """
+        Make the indexed documents of `kind` exactly `documents`.
+
+        Args:
+            documents: iterable of (doc_id, summary, fields, signature)
+
+        Returns:
+            tuple: (added or changed, removed) counts
+        """
+        changed = 0
+        seen = set()
+        for doc_id, summary, fields, signature in documents:
+            seen.add(doc_id)
+            if self.add(kind, doc_id, summary, fields, signature):
+                changed += 1
+        with self._lock:
+            stale = [doc_id for (doc_kind, doc_id) in self._docs if doc_kind == kind and doc_id not in seen]
+        for doc_id in stale:
+            self.remove(kind, doc_id)
+        return changed, len(stale)
+
+    def count(self, kind=None):
+        with self._lock:
+            if kind is None:
+                return len(self._docs)
+            return sum(1 for doc_kind, _ in self._docs if doc_kind == kind)
+
+    # ─── Querying ─────────────────────────────────────────────────────
+
+    def _candidates(self, token):
+        """{indexed token: match factor} for one query token."""
+        matches = {}
+        if token in self._postings:
+            matches[token] = 1.0
+        if len(token) >= MIN_PREFIX:
+            start = bisect.bisect_left(self._vocabulary, token)
+            for candidate in self._vocabulary[start:start + MAX_PREFIX_EXPANSION]:
+                if not candidate.startswith(token):
+                    break
+                if candidate != token:
+                    # Closer completions ('press' -> 'pressure' over 'pressurised') rank higher
+                    matches[candidate] = PREFIX_FACTOR * len(token) / len(candidate)
+        if len(token) >= MIN_FUZZY and not matches:
+            for variant in _deletes(token) | {token}:
+                for candidate in self._neighbours.get(variant, ()):
+                    matches.setdefault(candidate, FUZZY_FACTOR)
+            for candidate in _deletes(token):
+                if candidate in self._postings:
+                    matches.setdefault(candidate, FUZZY_FACTOR)
+        return matches
+
+    def search(self, query, kind=None, limit=20, offset=0):
+        """
+        Ranked, paginated search.
+
+        An empty query lists every document (of `kind`) by name.
+
+        Returns:
+            dict: {'total', 'results': [summary + 'kind' + 'score']}
+        """
+        tokens = list(dict.fromkeys(tokenize(query)))
+        with self._lock:
+            if not tokens:
+                hits = [(0.0, key) for key in self._docs if kind is None or key[0] == kind]
+            else:
+                scores = None
+                for token in tokens:
+                    token_scores = {}
+                    for candidate, factor in self._candidates(token).items():
+                        for key, weight in self._postings[candidate].items():
+                            if kind is not None and key[0] != kind:
+                                continue
+                            score = weight * factor
+                            if token_scores.get(key, 0) < score:
+                                token_scores[key] = score
+                    if scores is None:
+                        scores = token_scores
+                    else:
+                        scores = {key: scores[key] + score for key, score in token_scores.items() if key in scores}
+                    if not scores:
+                        break
+                hits = [(score, key) for key, score in (scores or {}).items()]
+
+            hits.sort(key=lambda hit: (-hit[0], self._docs[hit[1]][1].get('name') or '', hit[1]))
+            page = [
+                dict(self._docs[key][1], kind=key[0], score=round(score, 3))
+                for score, key in hits[offset:offset + limit]
+            ]
+        return {'total': len(hits), 'results': page}
+
+
+INDEX = SearchIndex()
+_templates_synced_at = 0.0
+
+
+# ─── Document Builders ────────────────────────────────────────────────
+
+def _texts(root, xpath):
+    return ' '.join(node.text for node in root.findall(xpath, namespaces=NS) if node.text)
+
+
+def archetype_document(root, archetype_id, name, language='en'):
+    """
+    Searchable fields of a parsed archetype XML root: id, concept name,
+    description (purpose/use/keywords) and ontology term texts in `language`.
+    """
+    keywords, description = [], []
+    for details in root.findall('.//openEHR:description/openEHR:details', namespaces=NS):
+        if details.findtext('openEHR:language/openEHR:code_string', namespaces=NS) == language:
+            keywords.append(_texts(details, 'openEHR:keywords'))
+            description.append(_texts(details, 'openEHR:purpose'))
+            description.append(_texts(details, 'openEHR:use'))
+    terms = f".//openEHR:ontology/openEHR:term_definitions[@language='{language}']/openEHR:items/openEHR:items[@id='text']"
+    return {
+        'id': archetype_id,
+        'name': name,
+        'keywords': ' '.join(keywords),
+        'description': ' '.join(description),
+        'terms': _texts(root, terms),
+    }
+
+
+def template_documents(templates):
+    """sync() documents for template summaries (as served by /api/templates)."""
+    for template in templates:
+        template_id = template.get('template_id')
+        if not template_id:
+            continue
+        name = template.get('display_name') or template.get('concept') or template_id
+        summary = dict(template, id=template_id, name=name)
+        fields = {
+            'id': template_id,
+            'name': f"{name} {template.get('concept') or ''}",
+            'keywords': template.get('archetype_id') or '',
+        }
+        yield template_id, summary, fields, (name, template.get('archetype_id'), template.get('created_timestamp'))
+
+
+def sync_templates(templates):
+    """Replace the indexed templates with `templates` (display-name enriched summaries)."""
+    global _templates_synced_at
+    changed, removed = INDEX.sync('template', template_documents(templates))
+    _templates_synced_at = time.monotonic()
+    if changed or removed:
+        logger.info(f"Search index: {changed} templates indexed, {removed} removed")
+
+
+def mark_templates_stale():
+    """Make the next search refresh the template documents (e.g. after an upload)."""
+    global _templates_synced_at
+    _templates_synced_at = 0.0
+
+
+def touch_templates():
+    """Keep the indexed template documents for another TEMPLATE_SYNC_TTL (e.g. EHRbase is down)."""
+    global _templates_synced_at
+    _templates_synced_at = time.monotonic()
+
+
+def templates_stale():
+    """True if the template documents are older than TEMPLATE_SYNC_TTL."""
+    return time.monotonic() - _templates_synced_at > TEMPLATE_SYNC_TTL
+
+
+def search(query, kind=None, limit=20, offset=0):
+    """Search the process-wide index (see SearchIndex.search)."""
+    return INDEX.search(query, kind, limit, offset)
@@ -0,0 +1,153 @@
+"""
+Lazily Initialized Service Singletons
+
+Process-wide services (the PostgreSQL pool, the EHRbase client, worker
+thread pools) used to be created as a side effect of importing their module,
+so every import — a worker booting, a test run, a CLI tool — paid for
+connections it might never use. A LazyService creates its instance on first
+use instead, and gives the process explicit lifecycle hooks:
+
+    shutdown()          close every service that was created (registered with
+                        atexit; also for server shutdown hooks)
+    reset_after_fork()  forget every service WITHOUT closing it, so a forked
+                        child builds its own instead of sharing the parent's
+                        sockets and threads (registered with os.register_at_fork);
+                        services with an `after_fork` hook are kept and repaired
+                        by it instead (e.g. a client with warm caches gets a new
+                        HTTP session)
+
+A service whose factory fails is not retried until `retry_after` seconds have
+passed; until then get() re-raises the last error immediately.
+
+Usage:
+    CLIENT = LazyService('ehrbase', EHRbaseClient, close=lambda c: c.session.close())
+    client = CLIENT.get()
+    ehrbase = CLIENT.proxy      # attribute access creates the instance
+"""
+
+import os
+import time
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_registry = []
+# Instances forgotten after a fork. They stay referenced so they are never
+# finalized in the child: closing a psycopg2 connection there would send a
+# terminate message over the parent's socket.
+_orphans = []
+
+
+class _Proxy:
+    """Stands in for a service instance; the first attribute access creates it."""
+    __slots__ = ('_service',)
+
+    def __init__(self, service):
+        object.__setattr__(self, '_service', service)
+
+    def __getattr__(self, name):
+        return getattr(self._service.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._service.get(), name, value)
+
+    def __repr__(self):
+        return f"<lazy {self._service.name}: {self._service.peek()!r}>"
+
+
+class LazyService:
+    """
+    A singleton created by `factory()` on first get().
+
+    Args:
+        name: Service name (used in logs)
+        factory: Zero-argument callable building the instance
+        close: Optional callable(instance) releasing its resources
+        retry_after: Seconds before a failed factory is called again
+        after_fork: Optional callable(instance) that makes an inherited
+                    instance safe to use in a forked child (default: forget it)
+    """
+
+    def __init__(self, name, factory, close=None, retry_after=0.0, after_fork=None):
+        self.name = name
+        self._factory = factory
+        self._close = close
+        self._after_fork = after_fork
+        self._retry_after = retry_after
+        self._lock = threading.Lock()
+        self._instance = None
+        self._error = None
+        self._failed_at = 0.0
+        self.proxy = _Proxy(self)
+        _registry.append(self)
+
+    def get(self):
+        """The instance, created on first call (thread-safe)."""
+        instance = self._instance
+        if instance is not None:
+            return instance
+        with self._lock:
+            if self._instance is None:
+                if self._error is not None and time.monotonic() - self._failed_at < self._retry_after:
+                    raise self._error
+                try:
+                    started = time.perf_counter()
+                    self._instance = self._factory()
+                except Exception as e:
+                    self._error, self._failed_at = e, time.monotonic()
+                    raise
+                self._error = None
+                logger.debug(f"Service '{self.name}' created in {(time.perf_counter() - started) * 1000:.1f}ms")
+            return self._instance
+
+    def peek(self):
+        """The instance if it has been created, else None (never creates it)."""
+        return self._instance
+
+    def close(self):
+        """Close and forget the instance; the next get() creates a new one."""
+        with self._lock:
+            instance, self._instance = self._instance, None
+            self._error = None
+        if instance is not None and self._close is not None:
+            try:
+                self._close(instance)
+            except Exception as e:
+                logger.warning(f"Closing service '{self.name}' failed: {e}")
+
+    def reset(self):
+        """
+        In a forked child: forget the instance without closing it (it belongs
+        to the parent process), or repair it with the after_fork hook.
+        """
+        # The lock may have been held by a parent thread at fork time
+        self._lock = threading.Lock()
+        self._error = None
+        if self._instance is not None and self._after_fork is not None:
+            try:
+                self._after_fork(self._instance)
+                return
+            except Exception as e:
+                logger.warning(f"Service '{self.name}' after-fork hook failed: {e}; recreating it")
+        if self._instance is not None:
+            _orphans.append(self._instance)
+        self._instance = None
+
+
+def shutdown():
+    """Close every created service, most recently registered first."""
+    for service in reversed(_registry):
+        service.close()
+
+
+def reset_after_fork():
+    """Forget every service in a freshly forked child process."""
+    for service in _registry:
+        service.reset()
+
+
+atexit.register(shutdown)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,298 @@
+"""
+Archetype Slot Resolution Index
+
+An ARCHETYPE_SLOT constrains which archetypes may be plugged in at a node
+through include/exclude assertions on the archetype id, e.g.
+    archetype_id/value matches {/openEHR-EHR-CLUSTER\\.device(-[a-zA-Z0-9_]+)*\\.v1/}
+
+Instead of regex-scanning the catalog whenever a slot picker opens, this
+module keeps a precomputed slot -> candidates graph:
+
+- Each distinct pattern is compiled once (the same few patterns recur in
+  hundreds of slots).
+- Slots with identical constraints (RM type, includes, excludes) share one
+  Constraint, so an archetype id is matched once per distinct constraint,
+  not once per slot.
+- The graph is updated incrementally: adding or changing an archetype
+  matches its own slots against the id index and its id against the existing
+  constraints; removing one drops it from both sides. Nothing else is
+  rescanned.
+
+Matching follows the usual ADL 1.4 slot semantics: an archetype fits when its
+RM class is the slot's rm_type_name and it either matches a specific include,
+or the includes allow anything ('.*' or none) and it matches no exclude.
+
+Lookups (candidates(), slots_of()) are plain dictionary reads.
+"""
+
+import re
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+NS = {'openEHR': 'http://schemas.openehr.org/v1'}
+XSI_TYPE = '{http://www.w3.org/2001/XMLSchema-instance}type'
+
+ANY_PATTERN = '.*'
+_STRING_EXPRESSION = re.compile(r'matches\s*\{/(.*)/\}', re.S)
+
+_compiled = {}
+
+
+def compile_pattern(pattern):
+    """Compiled (full-match) regex for an archetype id pattern, shared per pattern string."""
+    regex = _compiled.get(pattern)
+    if regex is None:
+        try:
+            regex = re.compile(f'(?:{pattern})\\Z')
+        except re.error as e:
+            logger.warning(f"Invalid slot pattern {pattern!r}: {e}; treating as literal")
+            regex = re.compile(re.escape(pattern) + '\\Z')
+        _compiled[pattern] = regex
+    return regex
+
+
+def rm_class_of(archetype_id):
+    """RM class of an archetype id ('openEHR-EHR-CLUSTER.device.v1' -> 'CLUSTER'), or None."""
+    qualified = archetype_id.split('.', 1)[0]
+    parts = qualified.split('-')
+    return parts[2] if len(parts) >= 3 else None
+
+
+class Constraint:
+    """The include/exclude patterns of a slot, compiled; shared by identical slots."""
+
+    __slots__ = ('rm_type', 'includes', 'excludes', 'include_any', 'exclude_any', '_includes', '_excludes')
+
+    def __init__(self, rm_type, includes, excludes):
+        self.rm_type = rm_type
+        self.includes = includes
+        self.excludes = excludes
+        self.include_any = not includes or ANY_PATTERN in includes
+        self.exclude_any = ANY_PATTERN in excludes
+        self._includes = tuple(compile_pattern(p) for p in includes if p != ANY_PATTERN)
+        self._excludes = tuple(compile_pattern(p) for p in excludes if p != ANY_PATTERN)
+
+    @property
+    def key(self):
+        return self.rm_type, self.includes, self.excludes
+
+    def accepts(self, archetype_id):
+        if self.rm_type and rm_class_of(archetype_id) != self.rm_type:
+            return False
+        if any(regex.match(archetype_id) for regex in self._includes):
+            return True
+        if self.include_any and not self.exclude_any:
+            return not any(regex.match(archetype_id) for regex in self._excludes)
+        return False
+
+
+def _assertion_patterns(element, tag):
+    """Patterns of the <includes>/<excludes> assertions under a slot element."""
+    patterns = []
+    for assertion in element.findall(f'openEHR:{tag}', namespaces=NS):
+        pattern = assertion.findtext('.//openEHR:pattern', namespaces=NS)
+        if pattern is None:
+            match = _STRING_EXPRESSION.search(assertion.findtext('openEHR:string_expression', default='', namespaces=NS))
+            pattern = match.group(1) if match else None
+        if pattern:
+            patterns.append(pattern.strip())
+    return tuple(sorted(set(patterns)))
+
+
+def is_slot(element):
+    """True for a <children> element that is an ARCHETYPE_SLOT."""
+    return (element.get(XSI_TYPE) == 'ARCHETYPE_SLOT'
+            or element.findtext('openEHR:rm_type_name', namespaces=NS) == 'ARCHETYPE_SLOT')
+
+
+def archetype_slots(root):
+    """
+    Slot definitions of a parsed archetype XML root.
+
+    Returns:
+        dict: {node_id: (rm_type, includes, excludes)} with pattern tuples
+    """
+    slots = {}
+    for element in root.iter('{http://schemas.openehr.org/v1}children'):
+        if not is_slot(element):
+            continue
+        node_id = element.findtext('openEHR:node_id', namespaces=NS)
+        if not node_id:
+            continue
+        rm_type = element.findtext('openEHR:rm_type_name', namespaces=NS)
+        if rm_type == 'ARCHETYPE_SLOT':
+            rm_type = None
+        slots[node_id] = (rm_type, _assertion_patterns(element, 'includes'), _assertion_patterns(element, 'excludes'))
+    return slots
+
+
+class SlotIndex:
+    """
+    Slot -> candidate archetype graph over a set of archetype ids.
+
+    Slots are keyed by (archetype_id, node_id).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = set()            # every known archetype id
+        self._slots = {}             # archetype_id -> {node_id: constraint key}
+        self._constraints = {}       # constraint key -> Constraint
+        self._users = {}             # constraint key -> {(archetype_id, node_id)}
+        self._matches = {}           # constraint key -> sorted tuple of archetype ids
+        self._definitions = {}       # archetype_id -> slot definitions (for change detection)
+
+    def update(self, archetype_id, slots):
+        """
+        Add or replace one archetype (its id and its slot definitions).
+
+        Args:
+            slots: {node_id: (rm_type, includes, excludes)}, see archetype_slots()
+
+        Returns:
+            bool: False if nothing changed
+        """
+        with self._lock:
+            is_new = archetype_id not in self._ids
+            if not is_new and self._definitions.get(archetype_id) == slots:
+                return False
+            self._drop_slots(archetype_id)
+            self._ids.add(archetype_id)
+            self._definitions[archetype_id] = slots
+            if is_new:
+                # The new id may fit slots that already exist
+                for key, constraint in self._constraints.items():
+                    if constraint.accepts(archetype_id):
+                        self._matches[key] = tuple(sorted(self._matches[key] + (archetype_id,)))
+            own = {}
+            for node_id, key in slots.items():
+                key = (key[0], tuple(key[1]), tuple(key[2]))
+                own[node_id] = key
+                self._users.setdefault(key, set()).add((archetype_id, node_id))
+                if key not in self._constraints:
+                    constraint = self._constraints[key] = Constraint(*key)
+                    self._matches[key] = tuple(sorted(i for i in self._ids if constraint.accepts(i)))
+            self._slots[archetype_id] = own
+        return True
+
+    def remove(self, archetype_id):
+        """Forget an archetype: its slots, and its id as a candidate elsewhere."""
+        with self._lock:
+            if archetype_id not in self._ids:
+                return False
+            self._drop_slots(archetype_id)
+            self._ids.discard(archetype_id)
+            self._definitions.pop(archetype_id, None)
+            for key, matched in self._matches.items():
+                if archetype_id in matched:
+                    self._matches[key] = tuple(i for i in matched if i != archetype_id)
+            return True
+
+    def _drop_slots(self, archetype_id):
+        for node_id, key in self._slots.pop(archetype_id, {}).items():
+            users = self._users.get(key)
+            if users is None:
+                continue
+            users.discard((archetype_id, node_id))
+            if not users:
+                # Last slot with this constraint: drop the compiled constraint too
+                del self._users[key]
+                del self._constraints[key]
+                del self._matches[key]
+
+    def sync(self, archetypes):
+        """
+        Make the index cover exactly `archetypes` ({archetype_id: slots}).
+
+        Returns:
+            tuple: (added or changed, removed) counts
+        """
+        changed = sum(1 for archetype_id, slots in archetypes.items() if self.update(archetype_id, slots))
+        with self._lock:
+            stale = [archetype_id for archetype_id in self._ids if archetype_id not in archetypes]
+        for archetype_id in stale:
+            self.remove(archetype_id)
+        return changed, len(stale)
+
+    def export(self):
+        """The whole graph as a JSON-ready dict (for catalog snapshots)."""
+        with self._lock:
+            return {
+                'definitions': {
+                    archetype_id: {node_id: [key[0], list(key[1]), list(key[2])] for node_id, key in slots.items()}
+                    for archetype_id, slots in self._definitions.items()
+                },
+                'matches': [[key[0], list(key[1]), list(key[2]), list(matched)]
+                            for key, matched in self._matches.items()],
+            }
+
+    def load(self, exported):
+        """
+        Replace the graph with an export() dict. Stored matches are reused, so
+        no archetype id is matched against any pattern.
+        """
+        definitions = {
+            archetype_id: {node_id: (rm_type, tuple(includes), tuple(excludes))
+                           for node_id, (rm_type, includes, excludes) in slots.items()}
+            for archetype_id, slots in exported['definitions'].items()
+        }
+        stored = {(rm_type, tuple(includes), tuple(excludes)): tuple(matched)
+                  for rm_type, includes, excludes, matched in exported['matches']}
+        slots, users, constraints, matches = {}, {}, {}, {}
+        for archetype_id, own in definitions.items():
+            slots[archetype_id] = own
+            for node_id, key in own.items():
+                users.setdefault(key, set()).add((archetype_id, node_id))
+                if key not in constraints:
+                    constraints[key] = Constraint(*key)
+                    matches[key] = stored.get(key)
+                    if matches[key] is None:
+                        matches[key] = tuple(sorted(i for i in definitions if constraints[key].accepts(i)))
+        with self._lock:
+            self._ids = set(definitions)
+            self._definitions = definitions
+            self._slots = slots
+            self._users = users
+            self._constraints = constraints
+            self._matches = matches
+
+    # ─── Lookups ──────────────────────────────────────────────────────
+
+    def candidates(self, archetype_id, node_id):
+        """Archetype ids that fit one slot (sorted), or None if there is no such slot."""
+        key = self._slots.get(archetype_id, {}).get(node_id)
+        return None if key is None else self._matches.get(key, ())
+
+    def slots_of(self, archetype_id):
+        """
+        All slots of one archetype with their constraints and candidates.
+
+        Returns:
+            dict | None: {node_id: {'rm_type', 'includes', 'excludes', 'candidates'}}
+        """
+        own = self._slots.get(archetype_id)
+        if own is None:
+            return None if archetype_id not in self._ids else {}
+        return {
+            node_id: {
+                'rm_type': key[0],
+                'includes': list(key[1]),
+                'excludes': list(key[2]),
+                'candidates': list(self._matches.get(key, ())),
+            }
+            for node_id, key in own.items()
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'archetypes': len(self._ids),
+                'slots': sum(len(own) for own in self._slots.values()),
+                'constraints': len(self._constraints),
+                'patterns': len(_compiled),
+            }
+
+
+INDEX = SlotIndex()
@@ -0,0 +1,133 @@
+"""
+Cross-Worker Template Invalidation
+
+Template caches (web template indexes, serialized projections, stale copies,
+the dependency graph) are per process, so a template uploaded with
+upload_templates.py was not invalidated in the running backend workers,
+which kept serving the old version. The uploader and the workers share an
+append-only log file instead:
+
+- publish() appends one JSON line per uploaded template: its id and the
+  archetypes its new OPT embeds.
+- poll() reads the lines appended since its last check (at most every
+  TEMPLATE_INVALIDATION_CHECK_INTERVAL seconds; backend.py calls it before
+  every request) and applies each one with dependency_graph.template_changed,
+  skipping the lines this process wrote.
+
+The read position is taken when this module is imported, i.e. once in the
+gunicorn master under preload. A worker forked later (after
+GUNICORN_MAX_REQUESTS, or to replace a crashed one) inherits the master's
+pre-upload caches, and it replays every upload since start-up on top of
+them.
+
+Changed files in ARCHETYPE_ROOT_DIR and OPT_UPLOAD_DIR are not logged here;
+each worker picks those up through its own watcher (see catalog_watcher.py).
+
+Configuration:
+    TEMPLATE_INVALIDATION_LOG              shared log file (unset: uploads invalidate the
+                                           uploading process only). gunicorn.conf.py defaults
+                                           to a file per master; set a fixed path for both the
+                                           server and upload_templates.py
+    TEMPLATE_INVALIDATION_CHECK_INTERVAL   seconds between checks for new lines (default 1)
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+import dependency_graph
+
+logger = logging.getLogger(__name__)
+
+LOG_PATH = os.getenv('TEMPLATE_INVALIDATION_LOG') or None
+CHECK_INTERVAL = float(os.getenv('TEMPLATE_INVALIDATION_CHECK_INTERVAL', '1'))
+
+_lock = threading.Lock()
+_checked_at = 0.0
+
+
+def _size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+_offset = _size(LOG_PATH) if LOG_PATH else 0
+
+
+def publish(template_id, archetypes):
+    """
+    Tell the running backend workers that a template changed.
+
+    Args:
+        template_id: The uploaded template
+        archetypes: {archetype_id: [AQL paths]} of its new OPT (see dependency_graph.parse_opt)
+    """
+    if not LOG_PATH:
+        return
+    record = {'template_id': template_id, 'archetypes': archetypes, 'pid': os.getpid()}
+    line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+    try:
+        fd = os.open(LOG_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            # One write per line: with O_APPEND, concurrent writers never interleave
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.warning(f"Could not publish the change of template '{template_id}' to the backend workers: {e}")
+
+
+def poll():
+    """
+    Apply the template changes other processes published since the last check.
+
+    Returns:
+        int: The number of changes applied
+    """
+    global _offset, _checked_at
+    if not LOG_PATH:
+        return 0
+    now = time.monotonic()
+    if now - _checked_at < CHECK_INTERVAL:
+        return 0
+    with _lock:
+        if now - _checked_at < CHECK_INTERVAL:
+            return 0
+        _checked_at = now
+        size = _size(LOG_PATH)
+        if size == _offset:
+            return 0
+        if size < _offset:
+            # Truncated or replaced: replaying is safe, invalidations are idempotent
+            _offset = 0
+        try:
+            with open(LOG_PATH, 'rb') as f:
+                f.seek(_offset)
+                data = f.read(size - _offset)
+        except OSError as e:
+            logger.warning(f"Could not read template invalidations from {LOG_PATH}: {e}")
+            return 0
+        # A line still being written has no newline yet; it is read on the next check
+        complete = data.rfind(b'\n') + 1
+        _offset += complete
+
+        applied = 0
+        for line in data[:complete].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning(f"Skipping a malformed line in {LOG_PATH}")
+                continue
+            if record.get('pid') == os.getpid():
+                continue
+            # Applied under the lock, so changes to one template land in log order
+            dependency_graph.ensure_loaded()
+            dependency_graph.template_changed(record['template_id'], archetypes=record.get('archetypes'))
+            applied += 1
+        if applied:
+            logger.info(f"Applied {applied} template changes published by other processes")
+        return applied
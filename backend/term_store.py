@@ -0,0 +1,177 @@
+"""
+Shared Ontology Term Store
+
+Every archetype carries its own ontology (at-code -> text), and the same
+texts ("Comment", "Any event", "Units", ...) recur across thousands of
+archetypes. The TermStore keeps each distinct string once, process-wide, and
+hands out small integer ids. A parsed archetype ontology (Ontology) holds
+only id -> id mappings per language.
+
+Languages: the term definitions for every language are listed when an
+ontology is loaded, but only the requested language is read. Other languages
+are read from the source file on first use.
+
+Configuration:
+    ARCHETYPE_LANGUAGE   default ontology language (default 'en')
+"""
+
+import os
+import sys
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+NAMESPACES = {'openEHR': 'http://schemas.openehr.org/v1'}
+DEFAULT_LANGUAGE = os.getenv('ARCHETYPE_LANGUAGE', 'en')
+
+
+class TermStore:
+    """Process-wide table of distinct strings, addressed by integer id."""
+
+    def __init__(self):
+        self._ids = {}
+        self._texts = []
+        self._lock = threading.Lock()
+
+    def add(self, text):
+        """Return the id of text, adding it if new."""
+        term_id = self._ids.get(text)
+        if term_id is not None:
+            return term_id
+        with self._lock:
+            term_id = self._ids.get(text)
+            if term_id is None:
+                text = sys.intern(text)
+                term_id = len(self._texts)
+                self._texts.append(text)
+                self._ids[text] = term_id
+            return term_id
+
+    def id_of(self, text):
+        """Id of text if it is already stored, else None."""
+        return self._ids.get(text)
+
+    def text(self, term_id):
+        return self._texts[term_id]
+
+    def __len__(self):
+        return len(self._texts)
+
+
+STORE = TermStore()
+
+
+def _language_of(term_definitions):
+    """Language code of a <term_definitions> element (attribute or child form)."""
+    language = term_definitions.get('language')
+    if language:
+        return language
+    code = term_definitions.find('openEHR:language/openEHR:code_string', namespaces=NAMESPACES)
+    return code.text.strip() if code is not None and code.text else None
+
+
+def _read_terms(term_definitions):
+    """{code id: text id} for the <items code=...> of one <term_definitions>."""
+    terms = {}
+    for item in term_definitions.findall('openEHR:items', namespaces=NAMESPACES):
+        code = item.get('code')
+        if not code:
+            continue
+        text_item = item.find('openEHR:items[@id="text"]', namespaces=NAMESPACES)
+        if text_item is not None and text_item.text:
+            terms[STORE.add(code)] = STORE.add(text_item.text.strip())
+    return terms
+
+
+class Ontology:
+    """
+    The at-code -> text terms of one archetype, stored as TermStore ids.
+
+    Behaves like the old ontology dict for lookups: get(code, default),
+    `code in ontology`, len() and truthiness refer to the selected language.
+
+    Args:
+        languages: Language codes present in the source, in document order
+        language: The selected language (terms for it are loaded)
+        source: Path of the XML file, used to load other languages lazily
+    """
+
+    __slots__ = ('languages', 'language', 'source', '_terms')
+
+    def __init__(self, languages, language, source=None):
+        self.languages = tuple(languages)
+        self.language = language
+        self.source = source
+        self._terms = {}
+
+    def _load(self, root, language):
+        terms = {}
+        for term_definitions in root.findall('.//openEHR:ontology/openEHR:term_definitions', namespaces=NAMESPACES):
+            if _language_of(term_definitions) == language:
+                terms = _read_terms(term_definitions)
+                break
+        self._terms[language] = terms
+        return terms
+
+    def _terms_for(self, language):
+        language = language or self.language
+        terms = self._terms.get(language)
+        if terms is None:
+            if language not in self.languages or not self.source:
+                return self._terms.get(self.language, {})
+            from lxml import etree
+            terms = self._load(etree.parse(self.source).getroot(), language)
+        return terms
+
+    def get(self, code, default=None, language=None):
+        """Text for an at-code in `language` (default: the selected language)."""
+        code_id = STORE.id_of(code)
+        if code_id is not None:
+            text_id = self._terms_for(language).get(code_id)
+            if text_id is not None:
+                return STORE.text(text_id)
+        return default
+
+    def as_dict(self, language=None):
+        """Plain {code: text} dict (e.g. for JSON output)."""
+        return {STORE.text(code): STORE.text(text) for code, text in self._terms_for(language).items()}
+
+    def __contains__(self, code):
+        code_id = STORE.id_of(code)
+        return code_id is not None and code_id in self._terms_for(None)
+
+    def __len__(self):
+        return len(self._terms_for(None))
+
+
+def load_ontology(root, language=None, source=None):
+    """
+    Build an Ontology from a parsed archetype/template root element.
+
+    Selects `language` (default ARCHETYPE_LANGUAGE); if absent, falls back to
+    ARCHETYPE_LANGUAGE and then to the first <term_definitions>, as the
+    original parsers did. Only that
+    language is read now; others are read from `source` when asked for.
+    """
+    language = language or DEFAULT_LANGUAGE
+    languages = []
+    for term_definitions in root.findall('.//openEHR:ontology/openEHR:term_definitions', namespaces=NAMESPACES):
+        code = _language_of(term_definitions)
+        if code and code not in languages:
+            languages.append(code)
+
+    if not languages:
+        # Unlabelled <term_definitions>: treat the first one as the only language
+        first = root.find('.//openEHR:ontology/openEHR:term_definitions', namespaces=NAMESPACES)
+        ontology = Ontology([], language, source)
+        ontology._terms[language] = _read_terms(first) if first is not None else {}
+        return ontology
+
+    if language in languages:
+        selected = language
+    else:
+        selected = DEFAULT_LANGUAGE if DEFAULT_LANGUAGE in languages else languages[0]
+    ontology = Ontology(languages, selected, source)
+    ontology._load(root, selected)
+    return ontology
@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import subprocess
+
+# Milliseconds each module may add on top of its third-party dependencies
+# (which are imported first and timed separately). Scale for slow machines
+# with IMPORT_BUDGET_SCALE, e.g. IMPORT_BUDGET_SCALE=2.
+BUDGETS_MS = {
+    'db': 15,
+    'upload_templates': 15,
+    'ehrbase_client': 25,
+    'backend': 80,
+}
+THIRD_PARTY = {
+    'db': ['dotenv', 'psycopg2.pool', 'psycopg2.extras'],
+    'upload_templates': ['dotenv', 'requests'],
+    'ehrbase_client': ['dotenv', 'requests'],
+    'backend': ['dotenv', 'requests', 'psycopg2.pool', 'psycopg2.extras', 'lxml.etree',
+                'flask', 'flask_cors', 'flask_limiter'],
+}
+RUNS = 3
+
+# Runs in a fresh interpreter: time the third-party imports, then the module,
+# and check that importing it opened no connections and loaded no optional
+# heavyweights.
+PROBE = """
+import sys, json, time
+started = time.perf_counter()
+for name in {third_party!r}:
+    __import__(name)
+deps = time.perf_counter()
+module = __import__({module!r})
+done = time.perf_counter()
+side_effects = []
+if 'db' in sys.modules and sys.modules['db'].POOL.peek() is not None:
+    side_effects.append('PostgreSQL pool created')
+if {module!r} == 'backend' and module.EHRBASE.peek() is not None:
+    side_effects.append('EHRbase client created')
+if 'pyarrow' in sys.modules:
+    side_effects.append('pyarrow imported')
+print(json.dumps({{'deps': (deps - started) * 1000, 'own': (done - deps) * 1000, 'side_effects': side_effects}}))
+"""
+
+
+def measure(module):
+    """Best of RUNS fresh-interpreter imports: (deps ms, own ms, side effects)."""
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    best = None
+    for _ in range(RUNS):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE.format(third_party=THIRD_PARTY[module], module=module)],
+            cwd=backend_dir, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result['own'] < best['own']:
+            best = result
+    return best['deps'], best['own'], best['side_effects']
+
+
+def test_import_time():
+    print("Testing module import time...")
+    scale = float(os.getenv('IMPORT_BUDGET_SCALE', '1'))
+    failed = False
+
+    for module, budget in BUDGETS_MS.items():
+        deps, own, side_effects = measure(module)
+        limit = budget * scale
+        print(f"{module}: {own:.1f}ms (budget {limit:.0f}ms) + {deps:.1f}ms third-party = {deps + own:.1f}ms cold")
+        if own > limit:
+            print(f"❌ {module} import exceeds its budget")
+            failed = True
+        if side_effects:
+            print(f"❌ Importing {module} has side effects: {', '.join(side_effects)}")
+            failed = True
+
+    if failed:
+        sys.exit(1)
+    print("✅ All modules import within budget and without side effects")
+
+
+if __name__ == "__main__":
+    test_import_time()
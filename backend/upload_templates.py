@@ -9,6 +9,21 @@ BASE_URL = os.getenv('EHRBASE_BASE_URL', 'http://localhost:8080/ehrbase')
 USER = os.getenv('EHRBASE_USER', 'admin')
 PASSWORD = os.getenv('EHRBASE_PASSWORD', 'password')
 
+def _template_uploaded(file_path):
+    """
+    Invalidate the caches of a (re-)uploaded template (see dependency_graph.py):
+    in this process, and in running backend workers that share this process's
+    TEMPLATE_INVALIDATION_LOG (see template_invalidations.py).
+    """
+    # Imported here so that importing this script stays cheap (test_import_time.py)
+    import dependency_graph
+    import template_invalidations
+
+    template_id, archetypes = dependency_graph.parse_opt(file_path)
+    if template_id:
+        dependency_graph.template_changed(template_id, archetypes=archetypes)
+        template_invalidations.publish(template_id, archetypes)
+
 def upload_templates(template_dir):
     """
     Scans a directory for .opt files and uploads them to EHRbase.
@@ -46,6 +61,7 @@ def upload_templates(template_dir):
             if response.status_code in [201, 204]:
                 print(f"✅ Successfully uploaded {filename}")
                 success += 1
+                _template_uploaded(file_path)
             elif response.status_code == 409:
                 print(f"⚠️ {filename} already exists in EHRbase.")
                 success += 1 # Count as success since it's already there
@@ -0,0 +1,146 @@
+"""
+Path-Addressable Web Template Index
+
+Large templates (e.g. GECCO_core) produce multi-megabyte web templates, but a
+form usually needs one section at a time. This module indexes a web template
+once, by node id path, so the API can return just the outline (top-level
+nodes) or a single subtree without walking or re-sending the whole tree.
+
+Paths are the node ids from the root joined with '/', exactly as they appear
+in FLAT paths without repetition indexes, e.g.
+    vital_signs/vital_signs/blood_pressure/any_event/systolic
+
+Indexes are cached per template for WEB_TEMPLATE_INDEX_TTL seconds (default
+300) and can be dropped explicitly with invalidate() after a template upload.
+
+SAFETY NOTE: Indexed nodes are the original web template dicts, shared between
+requests. Callers must not mutate them.
+"""
+
+import os
+import time
+import logging
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+INDEX_TTL = float(os.getenv('WEB_TEMPLATE_INDEX_TTL', '300'))
+
+# Fields copied into outline entries (the rest of a node stays server-side)
+_OUTLINE_FIELDS = ('id', 'name', 'localizedName', 'rmType', 'nodeId', 'min', 'max', 'aqlPath')
+
+
+class WebTemplateIndex:
+    """
+    Path index over one web template.
+
+    Accepts both the EHRbase response shape ({'webTemplate': {..., 'tree'}})
+    and a bare web template ({..., 'tree'}).
+    """
+
+    def __init__(self, web_template):
+        body = web_template.get('webTemplate', web_template)
+        self.meta = {key: value for key, value in body.items() if key != 'tree'}
+        self.root = body.get('tree') or {}
+        self.nodes = {}
+        self._build()
+
+    def _build(self):
+        root_id = self.root.get('id', '')
+        stack = [(root_id, self.root)]
+        while stack:
+            path, node = stack.pop()
+            if path in self.nodes:
+                logger.warning(f"Duplicate web template path '{path}' in {self.meta.get('templateId')}; keeping first")
+                continue
+            self.nodes[path] = node
+            for child in reversed(node.get('children') or []):
+                stack.append((f"{path}/{child.get('id', '')}", child))
+
+    def get(self, path):
+        """
+        Return the node at `path`, or None. The leading root id is optional,
+        so 'blood_pressure/any_event' and 'vitals/blood_pressure/any_event'
+        both resolve in a 'vitals' template.
+        """
+        path = (path or '').strip('/')
+        root_id = self.root.get('id', '')
+        if not path:
+            return self.root
+        node = self.nodes.get(path)
+        if node is None and root_id:
+            node = self.nodes.get(f"{root_id}/{path}")
+        return node
+
+    def outline(self, path='', depth=1):
+        """
+        Summaries of the nodes below `path`, `depth` levels deep.
+
+        Returns:
+            dict: template metadata plus 'root' and nested 'children' summaries
+                  (each with 'path' and 'childCount'), or None if path is unknown.
+        """
+        node = self.get(path)
+        if node is None:
+            return None
+        base = self.full_path(path)
+        return dict(self.meta, path=base, root=self._summary(node, base, depth))
+
+    def full_path(self, path):
+        """Canonical (root-prefixed) form of a node path."""
+        path = (path or '').strip('/')
+        root_id = self.root.get('id', '')
+        if not path:
+            return root_id
+        return path if path in self.nodes else f"{root_id}/{path}"
+
+    def _summary(self, node, path, depth):
+        children = node.get('children') or []
+        summary = {field: node[field] for field in _OUTLINE_FIELDS if field in node}
+        summary['path'] = path
+        summary['childCount'] = len(children)
+        if depth > 0 and children:
+            summary['children'] = [
+                self._summary(child, f"{path}/{child.get('id', '')}", depth - 1)
+                for child in children
+            ]
+        return summary
+
+
+_indexes = LRUCache(maxsize=int(os.getenv('WEB_TEMPLATE_INDEX_CACHE_SIZE', '64')), name='web_template_index')
+
+
+def get_index(template_id, fetch):
+    """
+    Return the cached index for template_id, building it from fetch() if
+    missing or older than INDEX_TTL.
+
+    Args:
+        template_id: Template identifier (cache key)
+        fetch: Callable returning the web template (e.g. EHRbaseClient.get_web_template)
+    """
+    entry = _indexes.get(template_id)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+
+    started = time.perf_counter()
+    index = WebTemplateIndex(fetch(template_id))
+    _indexes.put(template_id, (time.monotonic() + INDEX_TTL, index))
+    logger.info(f"Indexed web template '{template_id}': {len(index.nodes)} nodes "
+                f"in {(time.perf_counter() - started) * 1000:.1f}ms")
+    return index
+
+
+def get_stale(template_id):
+    """Return the cached index even if expired (for serving during an EHRbase outage), or None."""
+    entry = _indexes.get(template_id)
+    return entry[1] if entry is not None else None
+
+
+def invalidate(template_id=None):
+    """Drop the cached index for one template, or all of them."""
+    if template_id is None:
+        _indexes.clear()
+    else:
+        _indexes.pop(template_id)
@@ -0,0 +1,154 @@
+"""
+Web Template Projection Profiles
+
+EHRbase web templates carry every language's names and descriptions, AQL
+paths, annotations and term bindings for every node. The form renderer uses a
+small fraction of that. A projection profile keeps only the fields a client
+needs, resolves labels into one language, and drops nodes that can never be
+filled in (max == 0). Each (template, profile, language) projection is built
+once, serialized once and cached; so is the unchanged 'full' document, which
+is then served as-is instead of being re-encoded on every request.
+
+Profiles:
+    full     unchanged EHRbase payload (default, see WEB_TEMPLATE_DEFAULT_PROFILE)
+    form     what FormPage renders: ids, names, rmType, cardinality, inputs
+             with their value lists and validation
+    mobile   'form' without validation, nodeId/inContext and list extras,
+             for bandwidth-constrained ward tablets
+
+Configuration:
+    WEB_TEMPLATE_DEFAULT_PROFILE   profile used when the client asks for none (default 'full')
+    WEB_TEMPLATE_PROFILE_TTL       seconds a cached projection is reused (default 300)
+"""
+
+import os
+import time
+import logging
+
+import json_provider
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE = os.getenv('WEB_TEMPLATE_DEFAULT_PROFILE', 'full')
+PROFILE_TTL = float(os.getenv('WEB_TEMPLATE_PROFILE_TTL', '300'))
+
+PROFILES = {
+    'full': None,
+    'form': {
+        'meta': {'templateId', 'version', 'defaultLanguage', 'languages'},
+        'node': {'id', 'name', 'localizedName', 'rmType', 'nodeId', 'min', 'max', 'inContext',
+                 'children', 'inputs'},
+        'input': {'suffix', 'type', 'list', 'listOpen', 'defaultValue', 'validation', 'terminology'},
+        'item': {'value', 'label', 'ordinal', 'validation'},
+    },
+    'mobile': {
+        'meta': {'templateId', 'version', 'defaultLanguage', 'languages'},
+        'node': {'id', 'name', 'localizedName', 'rmType', 'min', 'max', 'children', 'inputs'},
+        'input': {'suffix', 'type', 'list', 'defaultValue'},
+        'item': {'value', 'label'},
+    },
+}
+
+
+def project(web_template, profile, language=None):
+    """
+    Return a slimmed copy of a web template (the input is not modified).
+
+    Args:
+        web_template: EHRbase web template ({'webTemplate': {...}} or bare)
+        profile: Profile name from PROFILES
+        language: Label language (default: the template's defaultLanguage)
+    """
+    spec = PROFILES[profile]
+    wrapped = 'webTemplate' in web_template
+    body = web_template.get('webTemplate', web_template)
+    if spec is None:
+        return web_template
+
+    language = language or body.get('defaultLanguage')
+    projected = {key: body[key] for key in spec['meta'] if key in body}
+    if 'languages' in projected and language:
+        projected['languages'] = [language]
+    projected['tree'] = _project_node(body.get('tree') or {}, spec, language)
+    return {'webTemplate': projected} if wrapped else projected
+
+
+def _project_node(node, spec, language):
+    out = {key: node[key] for key in spec['node'] if key in node and key not in ('children', 'inputs')}
+    localized = (node.get('localizedNames') or {}).get(language)
+    if localized and 'localizedName' in spec['node']:
+        out['localizedName'] = localized
+
+    if 'inputs' in spec['node'] and node.get('inputs'):
+        out['inputs'] = [_project_input(item, spec, language) for item in node['inputs']]
+
+    children = [
+        _project_node(child, spec, language)
+        for child in node.get('children') or []
+        if child.get('max') != 0  # prohibited in the template: can never be filled in
+    ]
+    if children:
+        out['children'] = children
+    return out
+
+
+def _project_input(item, spec, language):
+    out = {key: item[key] for key in spec['input'] if key in item and key != 'list'}
+    if 'list' in spec['input'] and item.get('list'):
+        out['list'] = []
+        for option in item['list']:
+            projected = {key: option[key] for key in spec['item'] if key in option}
+            label = (option.get('localizedLabels') or {}).get(language)
+            if label and 'label' in spec['item']:
+                projected['label'] = label
+            out['list'].append(projected)
+    return out
+
+
+# ─── Projection Cache ────────────────────────────────────────────────
+
+_projections = LRUCache(maxsize=int(os.getenv('WEB_TEMPLATE_PROFILE_CACHE_SIZE', '128')), name='web_template_profiles')
+
+
+def get_projected(template_id, profile, language, fetch):
+    """
+    Serialized projection of one template for a profile/language, built once
+    per PROFILE_TTL from fetch(template_id).
+
+    Returns:
+        bytes: Compact JSON document
+    """
+    key = _key(template_id, profile, language)
+    entry = _projections.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+
+    web_template = fetch(template_id)
+    document = web_template if PROFILES[profile] is None else project(web_template, profile, language)
+    payload = json_provider.dumps(document)
+    _projections.put(key, (time.monotonic() + PROFILE_TTL, payload))
+    logger.info(f"Projected web template '{template_id}' for profile '{profile}' "
+                f"({language or 'default language'}): {len(payload)} bytes")
+    return payload
+
+
+def get_stale(template_id, profile, language):
+    """Return a cached projection even if expired (for EHRbase outages), or None."""
+    entry = _projections.get(_key(template_id, profile, language))
+    return entry[1] if entry is not None else None
+
+
+def _key(template_id, profile, language):
+    # The full document is the same in every language
+    return template_id, profile, None if PROFILES[profile] is None else language
+
+
+def invalidate(template_id=None):
+    """Drop cached projections for one template, or all of them."""
+    if template_id is None:
+        _projections.clear()
+        return
+    for key in _projections.keys():
+        if key[0] == template_id:
+            _projections.pop(key)
@@ -0,0 +1,52 @@
+"""
+Production WSGI Entry Point
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Under gunicorn's preload (gunicorn.conf.py), this module is imported once in
+the master before any worker is forked. The start-up sequence runs here,
+once: DB schema, EHRbase health check, then the cache warm-up (archetype
+catalog, dependency graph, template list, serialized web templates and
+their path indexes). Workers inherit the warmed caches copy-on-write instead
+of each rebuilding them on their first requests.
+
+Before the fork the master closes its PostgreSQL pool and EHRbase
+connections (workers open their own on first use, see services.py) and
+freezes the warmed objects out of the cyclic GC, whose reference-count
+writes would otherwise copy the shared pages into every worker.
+
+Templates uploaded with upload_templates.py are invalidated in every worker
+through template_invalidations.py; ARCHETYPE_WATCH starts a watcher in each
+worker (see gunicorn.conf.py).
+
+`python backend.py` remains the single-process development server.
+
+Configuration:
+    WARM_UP               'false' to skip the cache warm-up (default true)
+    WARM_UP_MAX_TEMPLATES templates warmed at start-up (default 200)
+"""
+
+import gc
+import os
+import logging
+
+import db
+import backend
+
+logger = logging.getLogger('openehr_backend')
+
+app = backend.app
+
+backend.startup()
+if os.getenv('WARM_UP', 'true').lower() == 'true':
+    backend.warm_up()
+
+# Nothing the workers use may share the master's sockets
+db.close_pool()
+client = backend.EHRBASE.peek()
+if client is not None:
+    client.session.close()
+
+gc.collect()
+gc.freeze()
+logger.info("Application preloaded; forking workers")
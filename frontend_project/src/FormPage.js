@@ -77,7 +77,7 @@ function FormPage() {
   // Load the web template on mount
   useEffect(() => {
     setLoading(true);
-    fetch(`${API_URL}/api/web-template/${encodeURIComponent(decodedTemplateId)}`)
+    fetch(`${API_URL}/api/web-template/${encodeURIComponent(decodedTemplateId)}?profile=form`)
       .then(res => {
         if (!res.ok) throw new Error(`Template '${decodedTemplateId}' not found`);
         return res.json();
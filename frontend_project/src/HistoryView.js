@@ -18,22 +18,11 @@ function HistoryView() {
     setLoading(true);
     setError(null);
     try {
-      // Powerful AQL query to find all compositions for this EHR
-      const aql = `
-        SELECT
-            c/uid/value as uid,
-            c/name/value as template_id,
-            c/context/start_time/value as start_time,
-            c/composer/name as composer
-        FROM EHR e [ehr_id/value='${ehrId}']
-        CONTAINS COMPOSITION c
-        ORDER BY c/context/start_time/value DESC
-      `;
-      
-      const res = await fetch(`${API_URL}/api/query`, {
+      // Server-side named AQL query: only the parameters are sent
+      const res = await fetch(`${API_URL}/api/query/named/patient_history`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ aql }),
+        body: JSON.stringify({ query_parameters: { ehr_id: ehrId } }),
       });
       
       const data = await res.json();
@@ -5,6 +5,7 @@ const API_URL = 'http://127.0.0.1:9000';
 
 function SearchPage() {
   const [templates, setTemplates] = useState([]);
+  const [total, setTotal] = useState(0);
   const [searchTerm, setSearchTerm] = useState('');
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState(null);
@@ -16,32 +17,38 @@ function SearchPage() {
       .then(res => res.json())
       .then(data => setEhrbaseStatus(data))
       .catch(() => setEhrbaseStatus({ backend: 'unreachable' }));
-
-    // Fetch templates from EHRbase via backend proxy
-    fetch(`${API_URL}/api/templates`)
-      .then(res => {
-        if (!res.ok) throw new Error('Failed to fetch templates from EHRbase');
-        return res.json();
-      })
-      .then(data => {
-        setTemplates(data || []);
-        setLoading(false);
-      })
-      .catch(err => {
-        console.error('Failed to fetch templates:', err);
-        setError('Failed to load templates. Is EHRbase running?');
-        setTemplates([]);
-        setLoading(false);
-      });
   }, []);
 
-  const filteredTemplates = templates.filter(t => {
-    const name = (t.display_name || t.template_id || '').toLowerCase();
-    const id = (t.template_id || '').toLowerCase();
-    const archetype = (t.archetype_id || '').toLowerCase();
-    const term = searchTerm.toLowerCase();
-    return name.includes(term) || id.includes(term) || archetype.includes(term);
-  });
+  useEffect(() => {
+    // Search templates server-side (debounced); the backend ranks and pages results
+    const controller = new AbortController();
+    const timer = setTimeout(() => {
+      const params = new URLSearchParams({ q: searchTerm, kind: 'template', limit: '50' });
+      fetch(`${API_URL}/api/search?${params}`, { signal: controller.signal })
+        .then(res => {
+          if (!res.ok) throw new Error('Failed to search templates');
+          return res.json();
+        })
+        .then(data => {
+          setTemplates(data.results || []);
+          setTotal(data.total || 0);
+          setError(null);
+          setLoading(false);
+        })
+        .catch(err => {
+          if (err.name === 'AbortError') return;
+          console.error('Failed to search templates:', err);
+          setError('Failed to load templates. Is EHRbase running?');
+          setTemplates([]);
+          setTotal(0);
+          setLoading(false);
+        });
+    }, searchTerm ? 150 : 0);
+    return () => {
+      clearTimeout(timer);
+      controller.abort();
+    };
+  }, [searchTerm]);
 
   return (
     <div className="search-page">
@@ -91,7 +98,7 @@ function SearchPage() {
           </div>
         )}
 
-        {!loading && !error && filteredTemplates.length === 0 && (
+        {!loading && !error && templates.length === 0 && (
           <div className="result-item empty-item">
             {searchTerm
               ? `No templates found matching "${searchTerm}"`
@@ -100,7 +107,7 @@ function SearchPage() {
           </div>
         )}
 
-        {filteredTemplates.map(t => (
+        {templates.map(t => (
           <Link
             key={t.template_id}
             to={`/form/${encodeURIComponent(t.template_id)}`}
@@ -121,7 +128,7 @@ function SearchPage() {
 
       {!loading && !error && (
         <div className="results-count">
-          Showing {filteredTemplates.length} of {templates.length} templates
+          Showing {templates.length} of {total} templates
         </div>
       )}
     </div>
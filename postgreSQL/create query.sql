@@ -1,12 +1,19 @@
 -- Table to store submitted openEHR form data (EHR Documents)
+-- Also used as the write-behind JSONB mirror of compositions saved to EHRbase
+-- (backend/composition_mirror.py); db.initialize_database() applies the same schema.
 CREATE TABLE ehr_documents (
     id BIGSERIAL PRIMARY KEY,
 
     -- Fixed Metadata Columns (Relational for fast lookups)
-    archetype_id TEXT NOT NULL,
+    archetype_id TEXT,
     patient_id TEXT NOT NULL,  -- You will need to pass this from the frontend/context
     recorded_by TEXT,          -- Composer ID/Name
-    
+
+    -- Mirror keys: which EHR / template / composition this document came from
+    ehr_id UUID,
+    template_id TEXT,
+    composition_uid TEXT,
+
     -- Temporal Data
     recorded_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL,
 
@@ -17,6 +24,12 @@ CREATE TABLE ehr_documents (
 -- Index for fast searching *within* the JSONB data (Critical)
 CREATE INDEX idx_ehr_documents_data_gin ON ehr_documents USING GIN (data);
 
+-- Smaller, faster GIN index for containment (data @> '{"path": "value"}') lookups
+CREATE INDEX idx_ehr_documents_data_path_ops ON ehr_documents USING GIN (data jsonb_path_ops);
+
 -- Standard indexes for common relational lookups
 CREATE INDEX idx_ehr_documents_patient_id ON ehr_documents (patient_id);
-CREATE INDEX idx_ehr_documents_archetype_id ON ehr_documents (archetype_id);
\ No newline at end of file
+CREATE INDEX idx_ehr_documents_archetype_id ON ehr_documents (archetype_id);
+CREATE UNIQUE INDEX idx_ehr_documents_composition_uid ON ehr_documents (composition_uid);
+CREATE INDEX idx_ehr_documents_ehr_template ON ehr_documents (ehr_id, template_id);
+CREATE INDEX idx_ehr_documents_template_id ON ehr_documents (template_id);